@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 from optparse import OptionParser
-import math, os, re, subprocess, tempfile
-import pysam
-import ggplot
+import math, os, re, subprocess, sys
+import numpy as np
+import bam_filters, bam_fragments, ggplot, intersect
 
 ################################################################################
 # annotation_bars.py
@@ -38,11 +38,6 @@ def main():
     else:
         parser.error('Genome must specify hg19 or mm9.')
 
-    if options.paired_stranded:
-        # split bam files by strand
-        for bam_file in bam_files:
-            split_bam_xs(bam_file)
-
     annotation_classes = set(options.annotations.split(','))
 
     ############################################
@@ -88,11 +83,6 @@ def main():
             for bam_file in bam_files:
                 intergenic_reads += count_sans_intersection(bam_file, '%s/../gencode.v18.annotation.prerna.gtf' % annotation_dir)
 
-    if options.paired_stranded:
-        for bam_file in bam_files:
-            os.remove(bam_file[:-4] + '_p.bam')
-            os.remove(bam_file[:-4] + '_m.bam')
-
     ############################################
     # table
     ############################################
@@ -178,24 +168,8 @@ def annotation_length(bed_file, assembly_dir):
 #  read_count: Number of aligned fragments.
 ################################################################################
 def count_bam(bam_file, skip_spliced=False):
-    read_count = 0
-
-    bam_in = pysam.Samfile(bam_file, 'rb')
-    for aligned_read in bam_in:
-        # high quality
-        if aligned_read.mapq > 0:
-            # we're not skipping spliced or it's not spliced
-            if not skip_spliced or not spliced(aligned_read):
-                # not a dumb chromosome
-                chrom = bam_in.getrname(aligned_read.tid)
-                if not chrom.startswith('chrUn') and chrom.find('random') == -1 and chrom.find('hap') == -1:
-                    if aligned_read.is_paired:
-                        read_count += 0.5/aligned_read.opt('NH')
-                    else:
-                        read_count += 1.0/aligned_read.opt('NH')
-    bam_in.close()
-
-    return read_count
+    counter = bam_fragments.BamCounter(bam_file, read_filter=count_filter(skip_spliced))
+    return counter.count()
 
 
 ################################################################################
@@ -212,54 +186,80 @@ def count_bam(bam_file, skip_spliced=False):
 #                    overlapping the annotation in the BED file.
 ################################################################################
 def count_intersection(bam_file, bed_file, unstranded, paired_stranded, introns=False):
-    intersect_bam_fd, intersect_bam_file = tempfile.mkstemp(dir='%s/research/scratch/temp' % os.environ['HOME'])
-
     if paired_stranded:
-        # make split bed temp files
-        bedp_fd, bedp_file = tempfile.mkstemp()
-        bedm_fd, bedm_file = tempfile.mkstemp()
-
         # split bed file
-        split_bed(bed_file, bedp_file, bedm_file)
-
-        # get split BAM file names
-        bamp_file = bam_file[:-4] + '_p.bam'
-        bamm_file = bam_file[:-4] + '_m.bam'        
+        bedp_ivs, bedm_ivs = split_bed(bed_file)
 
-        # count +
-        subprocess.call('intersectBed -f 0.5 -abam %s -b %s > %s' % (bamp_file,bedp_file,intersect_bam_file), shell=True)
-        readsp = count_bam(intersect_bam_file, skip_spliced=introns)
+        # count + by XS tag
+        readsp = count_overlapping(bam_file, bedp_ivs, skip_spliced=introns, xs_strand='+')
 
-        # count -
-        subprocess.call('intersectBed -f 0.5 -abam %s -b %s > %s' % (bamm_file,bedm_file,intersect_bam_file), shell=True)
-        readsm = count_bam(intersect_bam_file, skip_spliced=introns)
+        # count - by XS tag
+        readsm = count_overlapping(bam_file, bedm_ivs, skip_spliced=introns, xs_strand='-')
 
         # sum + and -
         reads = readsp + readsm
 
-        # clean temp
-        os.close(bedp_fd)
-        os.remove(bedp_file)
-        os.close(bedm_fd)
-        os.remove(bedm_file)
     else:
-        strand_str = '-s'
-        if unstranded:
-            strand_str = ''
+        bed_ivs = intersect.read_intervals(bed_file)[0]
+        reads = count_overlapping(bam_file, bed_ivs, same_strand=not unstranded, skip_spliced=introns)
 
-        # intersect
-        subprocess.call('intersectBed -f 0.5 %s -abam %s -b %s > %s' % (strand_str,bam_file,bed_file,intersect_bam_file), shell=True)
+    return reads
 
-        # count
-        reads = count_bam(intersect_bam_file, skip_spliced=introns)
 
-    # clean
-    os.close(intersect_bam_fd)
-    os.remove(intersect_bam_file)
-    
+################################################################################
+# count_overlapping
+#
+# Input
+#  bam_file:     Read alignment BAM file
+#  bed_ivs:      Annotation Intervals
+#  same_strand:  Require the read and annotation share a strand
+#  skip_spliced: Ignore spliced reads
+#  invert:       Count the reads not overlapping instead
+#  xs_strand:    Count only the reads with this XS strand
+#
+# Output
+#  reads:        The number of reads (corrected for multi-mappers) overlapping
+#                 an annotation by at least half of the read's span, as in
+#                 intersectBed -f 0.5 -abam.
+################################################################################
+def count_overlapping(bam_file, bed_ivs, same_strand=False, skip_spliced=False, invert=False, xs_strand=None):
+    reads = 0.0
+
+    counter = bam_fragments.BamCounter(bam_file, read_filter=count_filter(skip_spliced, xs_strand), split=False)
+    for blocks in counter.overlaps(bed_ivs):
+        keep = blocks.overlap_bp >= 0.5*blocks.lengths()[blocks.block_idx]
+        if same_strand:
+            keep &= blocks.strands[blocks.block_idx] == bed_ivs.strands[blocks.feature_idx]
+
+        hit = np.zeros(len(blocks), dtype='bool')
+        hit[blocks.block_idx[keep]] = True
+        if invert:
+            hit = ~hit
+
+        reads += blocks.weights()[hit].sum()
+
     return reads
 
 
+################################################################################
+# count_filter
+#
+# Return a read filter keeping counted reads: high quality, on a real
+# chromosome, unspliced if skipping spliced reads, and on the given XS strand.
+################################################################################
+def count_filter(skip_spliced=False, xs_strand=None):
+    read_filters = [bam_filters.chrom_filter(), bam_filters.mapq_filter()]
+
+    # we're not skipping spliced or it's not spliced
+    if skip_spliced:
+        read_filters.append(bam_filters.spliced_filter(False))
+
+    if xs_strand is not None:
+        read_filters.append(bam_filters.strand_filter(xs_strand, xs=True))
+
+    return bam_filters.combine(*read_filters)
+
+
 ################################################################################
 # count_sans_intersection
 #
@@ -272,19 +272,8 @@ def count_intersection(bam_file, bed_file, unstranded, paired_stranded, introns=
 #            the annotation in the BED file.
 ################################################################################
 def count_sans_intersection(bam_file, bed_file):
-    intersect_bam_fd, intersect_bam_file = tempfile.mkstemp(dir='%s/research/scratch/temp' % os.environ['HOME'])
-
-    # intersect
-    subprocess.call('intersectBed -s -v -f 0.5 -abam %s -b %s > %s' % (bam_file,bed_file,intersect_bam_file), shell=True)
-
-    # count
-    reads = count_bam(intersect_bam_file)
-
-    # clean
-    os.close(intersect_bam_fd)
-    os.remove(intersect_bam_file)
-    
-    return reads
+    bed_ivs = intersect.read_intervals(bed_file)[0]
+    return count_overlapping(bam_file, bed_ivs, same_strand=True, invert=True)
     
 
 ################################################################################
@@ -322,59 +311,26 @@ def count_genome(assembly_dir):
     return glength
 
 
-################################################################################
-# spliced
-#
-# Return true if the read is spliced.
-################################################################################
-def spliced(aligned_read):
-    spliced = False
-    for code,size in aligned_read.cigar:
-        if code == 3:
-            spliced = True
-    return spliced
-
-
-################################################################################
-# split_bam_xs
-#
-# Split the alignments in the given BAM file into plus and minus strand.
-################################################################################
-def split_bam_xs(bam_file):
-    bamp_file = bam_file[:-4] + '_p.bam'
-    bamm_file = bam_file[:-4] + '_m.bam'
-
-    bam_in = pysam.Samfile(bam_file, 'rb')
-    bamp_out = pysam.Samfile(bamp_file, 'wb', template=bam_in)
-    bamm_out = pysam.Samfile(bamm_file, 'wb', template=bam_in)
-    
-    for aligned_read in bam_in:
-        if aligned_read.opt('XS') == '+':
-            bamp_out.write(aligned_read)
-        else:
-            bamm_out.write(aligned_read)
-
-    bam_in.close()
-    bamp_out.close()
-    bamm_out.close()
-
-
 ################################################################################
 # split_bed
+#
+# Return Intervals of the plus and minus strand entries of the bed file.
 ################################################################################
-def split_bed(bed_file, bedp_file, bedm_file):
-    bedp_out = open(bedp_file, 'w')
-    bedm_out = open(bedm_file, 'w')
+def split_bed(bed_file):
+    bedp_lines = []
+    bedm_lines = []
 
     for line in open(bed_file):
         a = line.split('\t')
         if a[5] == '+':
-            print >> bedp_out, line,
+            bedp_lines.append(line)
         else:
-            print >> bedm_out, line,
+            bedm_lines.append(line)
+
+    bedp_ivs = intersect.parse_intervals(bedp_lines, gff=False)[0]
+    bedm_ivs = intersect.parse_intervals(bedm_lines, gff=False)[0]
 
-    bedp_out.close()
-    bedm_out.close()
+    return bedp_ivs, bedm_ivs
 
 
 ################################################################################
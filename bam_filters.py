@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+from optparse import OptionParser
+import bisect
+import numpy as np
+import pysam
+import bam_fragments, intersect
+
+################################################################################
+# bam_filters.py
+#
+# Filter the reads of a BAM file as they stream past, in place of writing
+# filtered copies of it to scratch for the next tool to read again.
+#
+# A read filter is a function of an aligned read and the name of its
+# chromosome, or None if it's unmapped, returning True to keep the read, as
+# taken by bam_fragments.BamCounter. The functions below make filters by
+# mapping quality, proper pairing, splicing, strand, NH tag, chromosome,
+# genomic region and the flags samtools mpileup skips, and combine() chains
+# filters into one that stops at the first to reject a read.
+#
+# The command line writes the reads kept by the filters requested to a new
+# BAM file.
+################################################################################
+
+# unmapped, secondary, QC failed, duplicate
+pileup_flags = 0x4 | 0x100 | 0x200 | 0x400
+
+################################################################################
+# main
+################################################################################
+def main():
+    usage = 'usage: %prog [options] <bam in> <bam out>'
+    parser = OptionParser(usage)
+    parser.add_option('-b', dest='bed_file', help='Keep unspliced reads inside and spliced reads overlapping the BED regions')
+    parser.add_option('-m', dest='mapq_t', type='int', default=None, help='Keep reads with mapping quality above this value')
+    parser.add_option('-n', dest='max_nh', type='int', default=None, help='Keep reads with NH tags at most this value')
+    parser.add_option('-p', dest='proper_pairs', default=False, action='store_true', help='Keep properly paired reads [Default: %default]')
+    parser.add_option('-s', dest='strand', help='Keep reads on this strand')
+    parser.add_option('-u', dest='unspliced', default=False, action='store_true', help='Keep unspliced reads [Default: %default]')
+    parser.add_option('-x', dest='xs', default=False, action='store_true', help='Judge strand by the XS tag [Default: %default]')
+    (options,args) = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error('Must provide input and output BAM files')
+    else:
+        bam_file = args[0]
+        out_file = args[1]
+
+    read_filters = []
+    if options.mapq_t is not None:
+        read_filters.append(mapq_filter(options.mapq_t))
+    if options.proper_pairs:
+        read_filters.append(proper_pair_filter())
+    if options.unspliced:
+        read_filters.append(spliced_filter(False))
+    if options.strand:
+        read_filters.append(strand_filter(options.strand, options.xs))
+    if options.max_nh is not None:
+        read_filters.append(nh_filter(options.max_nh))
+    if options.bed_file:
+        read_filters.append(region_filter(intersect.read_intervals(options.bed_file)[0]))
+
+    print filter_bam(bam_file, out_file, combine(*read_filters))
+
+
+################################################################################
+# chrom_filter
+#
+# Keep mapped reads on real chromosomes, not unplaced, random or haplotype
+# contigs.
+################################################################################
+def chrom_filter():
+    def keep(aligned_read, chrom):
+        return chrom is not None and not chrom.startswith('chrUn') and chrom.find('random') == -1 and chrom.find('hap') == -1
+    return keep
+
+
+################################################################################
+# combine
+#
+# Return a filter keeping the reads kept by all of the given filters,
+# ignoring None, or None if there are none.
+################################################################################
+def combine(*read_filters):
+    read_filters = [rf for rf in read_filters if rf is not None]
+
+    if len(read_filters) == 0:
+        return None
+    elif len(read_filters) == 1:
+        return read_filters[0]
+
+    def keep(aligned_read, chrom):
+        for rf in read_filters:
+            if not rf(aligned_read, chrom):
+                return False
+        return True
+    return keep
+
+
+################################################################################
+# filter_bam
+#
+# Write the reads of the BAM file kept by the filter to out_file in one pass
+# and return the number kept.
+################################################################################
+def filter_bam(bam_file, out_file, read_filter=None):
+    bam_in = pysam.Samfile(bam_file, 'rb')
+    bam_out = pysam.Samfile(out_file, 'wb', template=bam_in)
+    chroms = bam_in.references
+
+    kept = 0
+    for aligned_read in bam_in:
+        if aligned_read.is_unmapped:
+            chrom = None
+        else:
+            chrom = chroms[aligned_read.tid]
+
+        if read_filter is None or read_filter(aligned_read, chrom):
+            bam_out.write(aligned_read)
+            kept += 1
+
+    bam_in.close()
+    bam_out.close()
+
+    return kept
+
+
+################################################################################
+# mapq_filter
+#
+# Keep reads with mapping quality above mapq_t.
+################################################################################
+def mapq_filter(mapq_t=0):
+    def keep(aligned_read, chrom):
+        return aligned_read.mapq > mapq_t
+    return keep
+
+
+################################################################################
+# nh_filter
+#
+# Keep reads aligned to at most max_nh loci by their NH tags, by default
+# uniquely aligned reads.
+################################################################################
+def nh_filter(max_nh=1):
+    def keep(aligned_read, chrom):
+        return bam_fragments.read_nh(aligned_read) <= max_nh
+    return keep
+
+
+################################################################################
+# pileup_filter
+#
+# Keep reads as samtools mpileup does by default, skipping unmapped,
+# secondary, QC failed and duplicate reads and pairs that are not properly
+# paired.
+################################################################################
+def pileup_filter():
+    def keep(aligned_read, chrom):
+        return not aligned_read.flag & pileup_flags and (aligned_read.is_proper_pair or not aligned_read.is_paired)
+    return keep
+
+
+################################################################################
+# proper_pair_filter
+#
+# Keep properly paired reads.
+################################################################################
+def proper_pair_filter():
+    def keep(aligned_read, chrom):
+        return aligned_read.is_proper_pair
+    return keep
+
+
+################################################################################
+# region_filter
+#
+# Keep reads in the regions of the Intervals region_ivs as intersectBed -f 1
+# -abam would, unspliced reads whose span lies within a single region, but
+# spliced reads whose span overlaps any region, since their spans include
+# their introns.
+################################################################################
+def region_filter(region_ivs):
+    region_ivs.finalize()
+
+    # per chromosome, sorted region starts and the running maximum of ends
+    chrom_regions = {}
+    for chrom in region_ivs.chroms:
+        chrom_idx = region_ivs.chrom_records[chrom]
+        chrom_regions[chrom] = (region_ivs.starts[chrom_idx].tolist(), np.maximum.accumulate(region_ivs.ends[chrom_idx]).tolist())
+
+    def keep(aligned_read, chrom):
+        if chrom not in chrom_regions:
+            return False
+
+        region_starts, region_max_ends = chrom_regions[chrom]
+        if spliced(aligned_read):
+            # any region starting before the read's end and ending after its start
+            ri = bisect.bisect_left(region_starts, aligned_read.aend) - 1
+            return ri >= 0 and region_max_ends[ri] > aligned_read.pos
+        else:
+            # any region starting at or before the read's start and ending at
+            # or after its end
+            ri = bisect.bisect_right(region_starts, aligned_read.pos) - 1
+            return ri >= 0 and region_max_ends[ri] >= aligned_read.aend
+
+    return keep
+
+
+################################################################################
+# spliced
+#
+# Return true if the read is spliced.
+################################################################################
+def spliced(aligned_read):
+    for code, size in aligned_read.cigar:
+        if code == 3:
+            return True
+    return False
+
+
+################################################################################
+# spliced_filter
+#
+# Keep spliced reads, or unspliced reads if keep_spliced is False.
+################################################################################
+def spliced_filter(keep_spliced=True):
+    def keep(aligned_read, chrom):
+        return spliced(aligned_read) == keep_spliced
+    return keep
+
+
+################################################################################
+# strand_filter
+#
+# Keep reads on the given strand, by their alignment orientation or by their
+# XS tags, counting reads without one as on the - strand.
+################################################################################
+def strand_filter(strand, xs=False):
+    def keep(aligned_read, chrom):
+        if xs:
+            try:
+                read_strand = aligned_read.opt('XS')
+            except KeyError:
+                read_strand = '-'
+            if read_strand != '+':
+                read_strand = '-'
+        elif aligned_read.is_reverse:
+            read_strand = '-'
+        else:
+            read_strand = '+'
+        return read_strand == strand
+    return keep
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+    main()
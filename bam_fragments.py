@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 from optparse import OptionParser
-import os, subprocess, tempfile
+import array, sys
+import numpy as np
 import pysam
+import intersect
 
 ################################################################################
 # bam_fragments.py
 #
 # Count the reads in a BAM file, by relying on the multimap count tag.
+#
+# BamCounter makes a single pass over a BAM file, summing fragments weighted
+# by each read's own NH tag while intersecting the reads' aligned blocks with
+# a set of features in process. Overlaps carry the weights of their reads, so
+# no hash of multi-mapping read names is needed.
 ################################################################################
 
 
@@ -63,33 +70,13 @@ def count(bam_file, filter_mapq=False):
 #       gff entries in between their aligned segments.
 ################################################################################
 def count_gff(bam_file, gff_file, filter_mapq=False):
-    # hash multi-mappers
-    multi_maps = {}
-    paired_poll = {False:0, True:0}
-    for aligned_read in pysam.Samfile(bam_file, 'rb'):
-        if aligned_read.opt('NH') > 1:
-            multi_maps[aligned_read.qname] = aligned_read.opt('NH')
-
-        paired_poll[aligned_read.is_paired] += 1
-
-    # guess paired-ness
-    if paired_poll[True] > 0 and paired_poll[False] > 0:
-        print >> sys.stderr, 'Paired-ness of the reads is ambiguous'
-    if paired_poll[True] > paired_poll[False]:
-        is_paired = True
-    else:
-        is_paired = False
+    gff_ivs = intersect.read_intervals(gff_file, gff=True)[0]
 
     # intersect and count
     bam_count = 0.0
-    p = subprocess.Popen('intersectBed -split -wo -bed -abam %s -b %s' % (bam_file,gff_file), shell=True, stdout=subprocess.PIPE)
-    for line in p.stdout:
-        a = line.split('\t')
-        if is_paired:
-            bam_count += 0.5/multi_maps.get(a[3],1.0)
-        else:
-            bam_count += 1.0/multi_maps.get(a[3],1.0)
-    p.communicate()
+    counter = BamCounter(bam_file, filter_mapq)
+    for blocks in counter.overlaps(gff_ivs):
+        bam_count += blocks.weights()[blocks.block_idx].sum()
 
     return bam_count
 
@@ -97,23 +84,270 @@ def count_gff(bam_file, gff_file, filter_mapq=False):
 ################################################################################
 # count_gtf
 #
+# Count reads in the bam_file whose spans overlap the GTF file, like
+# intersectBed -abam.
+#
 # WARNING:
 #  I'm half assing by not considering strand information.
 ################################################################################
 def count_gtf(bam_file, ref_gtf, filter_mapq=False):
-    ref_bam_fd, ref_bam_file = tempfile.mkstemp(dir='%s/research/scratch/temp' % os.environ['HOME'])
+    ref_ivs = intersect.read_intervals(ref_gtf, gff=True)[0]
 
-    # intersect
-    subprocess.call('intersectBed -abam %s -b %s > %s' % (bam_file, ref_gtf, ref_bam_file), shell=True)
+    # intersect and count each read once
+    bam_count = 0.0
+    counter = BamCounter(bam_file, filter_mapq, split=False)
+    for blocks in counter.overlaps(ref_ivs):
+        hit = np.zeros(len(blocks), dtype='bool')
+        hit[blocks.block_idx] = True
+        bam_count += blocks.weights()[hit].sum()
+
+    return bam_count
+
+
+################################################################################
+# read_blocks
+#
+# Return a list of 0-based, half-open (start, end) tuples of the read's
+# aligned blocks, split at introns like intersectBed -split, or its entire
+# span.
+################################################################################
+def read_blocks(aligned_read, split=True):
+    if not split:
+        return [(aligned_read.pos, aligned_read.aend)]
+
+    blocks = []
+    block_start = aligned_read.pos
+    block_end = aligned_read.pos
+    for code, size in aligned_read.cigar:
+        # M, D, =, X
+        if code in (0, 2, 7, 8):
+            block_end += size
+
+        # N
+        elif code == 3:
+            if block_end > block_start:
+                blocks.append((block_start,block_end))
+            block_start = block_end + size
+            block_end = block_start
+
+    if block_end > block_start:
+        blocks.append((block_start,block_end))
+
+    return blocks
+
+
+################################################################################
+# read_nh
+#
+# Return the read's NH tag, or 1 if it has none.
+################################################################################
+def read_nh(aligned_read):
+    try:
+        return aligned_read.opt('NH')
+    except KeyError:
+        return 1
+
+
+################################################################################
+# BamCounter
+#
+# Count the fragments in a BAM file, optionally filtering reads by mapping
+# quality or a function of the read and its chromosome (see bam_filters.py),
+# and intersect the reads with features in the same pass.
+#
+# Fragments are weighted 0.5/NH for paired reads and 1/NH otherwise, or only
+# counted for properly paired reads if requested. Reads are intersected by
+# their aligned blocks if split, else by their entire span. Given a
+# chromosome, only the reads aligned to it are fetched through the BAM index,
+# or '*' for the unplaced, unmapped reads. Given also a 0-based, half-open
+# start and end, only the reads starting in that region are counted, e.g. to
+# count the shards of bam_shards.py.
+################################################################################
+class BamCounter:
+    def __init__(self, bam_file, filter_mapq=False, read_filter=None, split=True, properly_paired=False, chrom=None, start=None, end=None):
+        self.bam_file = bam_file
+        self.chrom = chrom
+        self.start = start
+        self.end = end
+        self.filter_mapq = filter_mapq
+        self.read_filter = read_filter
+        self.split = split
+        self.properly_paired = properly_paired
+
+        self.fragments = 0.0
+        self.reads = 0
+        self.paired_poll = {False:0, True:0}
 
+    ############################################################################
     # count
-    bam_count = count(ref_bam_file, filter_mapq)
+    #
+    # Count the fragments and return their total.
+    ############################################################################
+    def count(self):
+        for blocks in self.overlaps(None):
+            pass
+        return self.fragments
 
-    # clean
-    os.close(ref_bam_fd)
-    os.remove(ref_bam_file)
+    ############################################################################
+    # is_paired
+    #
+    # Guess the paired-ness of the counted reads.
+    ############################################################################
+    def is_paired(self):
+        if self.paired_poll[True] > 0 and self.paired_poll[False] > 0:
+            print >> sys.stderr, 'Paired-ness of the reads is ambiguous'
+        return self.paired_poll[True] > self.paired_poll[False]
 
-    return bam_count
+    ############################################################################
+    # blocks
+    #
+    # Count the fragments while yielding ReadBlocks of up to chunk_blocks
+    # aligned blocks, without intersecting them.
+    ############################################################################
+    def blocks(self, chunk_blocks=2**20):
+        return self.overlaps(None, chunk_blocks, collect=True)
+
+    ############################################################################
+    # overlaps
+    #
+    # Count the fragments while yielding ReadBlocks of up to chunk_blocks
+    # aligned blocks, intersected with the Intervals feature_ivs. The totals
+    # are complete once the generator is exhausted. Blocks are collected only
+    # if there are features, unless collect says otherwise.
+    ############################################################################
+    def overlaps(self, feature_ivs, chunk_blocks=2**20, collect=None):
+        if collect is None:
+            collect = (feature_ivs is not None)
+
+        self.fragments = 0.0
+        self.reads = 0
+        self.paired_poll = {False:0, True:0}
+
+        bam_in = pysam.Samfile(self.bam_file, 'rb')
+        chroms = bam_in.references
+
+        if self.chrom is None:
+            bam_reads = bam_in
+        else:
+            bam_reads = bam_in.fetch(self.chrom, self.start, self.end)
+
+        blocks = ReadBlocks()
+        for aligned_read in bam_reads:
+            # reads starting before the region belong to an earlier one
+            if self.start is not None and aligned_read.pos < self.start:
+                continue
+
+            if self.filter_mapq and aligned_read.mapq == 0:
+                continue
+
+            if aligned_read.is_unmapped:
+                chrom = None
+            else:
+                chrom = chroms[aligned_read.tid]
+
+            if self.read_filter is not None and not self.read_filter(aligned_read, chrom):
+                continue
+
+            nh = read_nh(aligned_read)
+
+            if self.properly_paired:
+                if aligned_read.is_proper_pair:
+                    weight = 0.5/nh
+                else:
+                    weight = 0.0
+            elif aligned_read.is_paired:
+                weight = 0.5/nh
+            else:
+                weight = 1.0/nh
+
+            self.fragments += weight
+            self.paired_poll[aligned_read.is_paired] += 1
+
+            if collect and chrom is not None:
+                if aligned_read.is_reverse:
+                    strand = '-'
+                else:
+                    strand = '+'
+                for block_start, block_end in read_blocks(aligned_read, self.split):
+                    blocks.add_block(chrom, block_start, block_end, strand, self.reads, nh, aligned_read.is_paired)
+
+                if len(blocks) >= chunk_blocks:
+                    if feature_ivs is not None:
+                        blocks.intersect(feature_ivs)
+                    yield blocks
+                    blocks = ReadBlocks()
+
+            self.reads += 1
+
+        bam_in.close()
+
+        if collect and len(blocks) > 0:
+            if feature_ivs is not None:
+                blocks.intersect(feature_ivs)
+            yield blocks
+
+
+################################################################################
+# ReadBlocks
+#
+# Intervals of aligned read blocks, recording for each block the index of its
+# read in the pass over the BAM file, its NH tag and paired-ness, and after
+# intersect, arrays of the overlapping (block index, feature index, overlap
+# bp).
+################################################################################
+class ReadBlocks(intersect.Intervals):
+    def __init__(self):
+        intersect.Intervals.__init__(self)
+        self.read_col = array.array('l')
+        self.nh_col = array.array('i')
+        self.paired_col = array.array('b')
+
+        self.block_idx = None
+        self.feature_idx = None
+        self.overlap_bp = None
+
+    ############################################################################
+    # add_block
+    ############################################################################
+    def add_block(self, chrom, start, end, strand, read_i, nh, paired):
+        self.add(chrom, start, end, strand)
+        self.read_col.append(read_i)
+        self.nh_col.append(nh)
+        self.paired_col.append(paired)
+
+    ############################################################################
+    # intersect
+    #
+    # Intersect the blocks with the Intervals feature_ivs.
+    ############################################################################
+    def intersect(self, feature_ivs, same_strand=False):
+        self.block_idx, self.feature_idx, self.overlap_bp = intersect.intersect(self, feature_ivs, same_strand)
+
+    ############################################################################
+    # nh
+    #
+    # Return an array of the blocks' read NH tags.
+    ############################################################################
+    def nh(self):
+        return np.frombuffer(self.nh_col, dtype='int32')
+
+    ############################################################################
+    # read_idx
+    #
+    # Return an array of the blocks' read indexes.
+    ############################################################################
+    def read_idx(self):
+        return np.array(self.read_col, dtype='int64')
+
+    ############################################################################
+    # weights
+    #
+    # Return an array of the blocks' read fragment weights, 0.5/NH for paired
+    # reads and 1/NH otherwise.
+    ############################################################################
+    def weights(self):
+        paired = np.frombuffer(self.paired_col, dtype='int8')
+        return np.where(paired, 0.5, 1.0) / self.nh()
 
 
 ################################################################################
@@ -1,14 +1,18 @@
 #!/usr/bin/env python
 from optparse import OptionParser
-import math, os, pdb, random, shutil, stats, subprocess, sys, tempfile
-import pysam
-import count_reads, gff, ggplot
+import math, os, pdb, random, shutil, stats, sys, tempfile
+import numpy as np
+import bam_fragments, bam_shards, count_reads, coverage_cache, gff, ggplot, intersect
 
 ################################################################################
 # bam_heat.py
 #
 # Plot read coverage in a BAM file surrounding the median points of GFF entries
 # as a heatmap.
+#
+# BAM files are read by genome shard (see bam_shards.py), optionally across
+# processes, and the shards' coverage differences summed in order, or their
+# coverage sliced from their coverage caches (see coverage_cache.py).
 ################################################################################
 
 ################################################################################
@@ -22,8 +26,10 @@ def main():
     parser.add_option('-k', dest='gtf_key', default=None, help='GTF key to hash gff entries by')
     parser.add_option('-m', dest='max_features', default=2000, type='int', help='Maximum number of features to plot [Default: %default]')
     parser.add_option('-o', dest='output_pre', default='bam', help='Output prefix [Default: %default]')
+    parser.add_option('-p', dest='processes', default=1, type='int', help='Number of processes to split the genome across [Default: %default]')
     parser.add_option('-s', dest='sorted_gene_files', help='Files of sorted gene lists. Plot heatmaps in their order')
     parser.add_option('-u', dest='range', default=2000, type='int', help='Range around peak middle [Default: %default]')
+    parser.add_option('-x', dest='cache', default=False, action='store_true', help='Slice coverage from the BAM files\' coverage caches [Default: %default]')
     (options,args) = parser.parse_args()
 
     if len(args) != 2:
@@ -65,9 +71,9 @@ def main():
     ############################################
     # compute coverage
     ############################################
-    coverage, fragments = compute_coverage(gff_range_file, bam_files, options.gtf_key)
+    coverage, fragments = compute_coverage(gff_range_file, bam_files, options.gtf_key, options.processes, options.cache)
     if options.control_bam_files:
-        coverage_control, fragments_control = compute_coverage(gff_range_file, control_bam_files, options.gtf_key)
+        coverage_control, fragments_control = compute_coverage(gff_range_file, control_bam_files, options.gtf_key, options.processes, options.cache)
 
     # clean
     os.close(gff_range_fd)
@@ -142,7 +148,7 @@ def main():
                     else:
                         cov = cov / coverage_control[feature_id][i+options.range/2]
 
-                df['Coverage'].append('%.4e' % cov)
+                df['Coverage'].append(cov)
 
         r_script = '%s/bam_heat_heat.r' % os.environ['RDIR']
         if len(features_sorted) == 1:
@@ -152,7 +158,7 @@ def main():
             sorted_gene_pre = os.path.splitext(os.path.split(sorted_gene_file)[-1])[0]
             out_pdf = '%s_heat/%s.pdf' % (options.output_pre,sorted_gene_pre)
 
-        ggplot.plot(r_script, df, [out_pdf, options.control_bam_files!=None], df_file='df_heat.txt')
+        ggplot.plot(r_script, df, [out_pdf, options.control_bam_files!=None], df_file='df_heat.bin')
 
     ############################################
     # plot meta-coverage
@@ -182,115 +188,109 @@ def main():
     r_script = '%s/bam_heat_meta.r' % os.environ['RDIR']
     out_pdf = '%s_meta.pdf' % options.output_pre
 
-    ggplot.plot(r_script, df, [out_pdf], df_file='df_meta.txt')
+    ggplot.plot(r_script, df, [out_pdf], df_file='df_meta.bin')
 
 
 ################################################################################
 # compute_coverage
 #
 # Input:
-#  gff_file: GFF file of equal-sized genome features.
-#  bam_file: BAM file of reads alignments.
-#  gtf_key:  GTF key by which is hash coverage arrays.
+#  gff_file:  GFF file of equal-sized genome features.
+#  bam_file:  BAM file of reads alignments.
+#  gtf_key:   GTF key by which is hash coverage arrays.
+#  processes: Number of processes to split BAM genome shards across.
+#  cache:     Slice coverage from the BAM files' coverage caches.
 ################################################################################
-def compute_coverage(gff_file, bam_files, gtf_key):
-    # initialize counters
-    fragments = 0
-    coverage = {}
-    for line in open(gff_file):
+def compute_coverage(gff_file, bam_files, gtf_key, processes=1, cache=False):
+    # hash features by instance
+    feature_ivs, feature_lines = intersect.read_intervals(gff_file, gff=True)
+    instance_ids = []
+    instance_rows = {}
+    feature_rows = []
+    width = 0
+    for line in feature_lines:
         a = line.split('\t')
 
-        gchrom = a[0]
-        gstart = int(a[3])
-        gend = int(a[4])
-
         if gtf_key == None:
-            instance_id = (gchrom,gstart,gend)
+            instance_id = (a[0],int(a[3]),int(a[4]))
         else:
             instance_id = gff.gtf_kv(a[8])[gtf_key]
 
-        coverage[instance_id] = [0]*(gend-gstart+1)
-
-    # process bam files
-    for bam_file in bam_files:
-        # filter BAM for mapping quality
-        bam_mapq_fd, bam_mapq_file = tempfile.mkstemp(dir='%s/research/scratch/temp' % os.environ['HOME'])
-        bam_in = pysam.Samfile(bam_file, 'rb')
-        bam_mapq_out = pysam.Samfile(bam_mapq_file, 'wb', template=bam_in)
-        for aligned_read in bam_in:
-            if aligned_read.mapq > 0:
-                bam_mapq_out.write(aligned_read)
-        bam_mapq_out.close()
-
-        # count fragments and hash multi-mappers
-        multi_maps = {}
-        paired_reads = False
-        for aligned_read in pysam.Samfile(bam_mapq_file, 'rb'):
-            try:
-                nh_tag = aligned_read.opt('NH')
-            except:
-                nh_tag = 1.0
-
-            if aligned_read.is_paired:
-                paired_reads = True
-                fragments += 0.5/nh_tag
-            else:
-                fragments += 1.0/nh_tag
-
-            if nh_tag > 1:
-                multi_maps[aligned_read.qname] = nh_tag
+        if instance_id not in instance_rows:
+            instance_rows[instance_id] = len(instance_ids)
+            instance_ids.append(instance_id)
+        feature_rows.append(instance_rows[instance_id])
 
-        # count reads
-        p = subprocess.Popen('intersectBed -split -wo -bed -abam %s -b %s' % (bam_mapq_file, gff_file), shell=True, stdout=subprocess.PIPE)
-        for line in p.stdout:
-            a = line.split('\t')
+        width = max(width, int(a[4])-int(a[3])+1)
 
-            rstart = int(a[1])+1  # convert back to 1-based
-            rend = int(a[2])
-            rheader = a[3]
+    feature_ivs.finalize()
+    feature_rows = np.array(feature_rows, dtype='int64')
+    feature_minus = (feature_ivs.strands != intersect.strand_codes['+'])
+    features = (feature_ivs, feature_rows, feature_minus, width)
 
-            # because intersectBed screws up indels near endpoints
-            if rstart < rend:
-                gchrom = a[12]
-                gstart = int(a[15])
-                gend = int(a[16])
-                gstrand = a[18]
+    # coverage differences, summed to coverage at the end
+    coverage = np.zeros((len(instance_ids), width+1))
+    fragments = 0
 
-                if gtf_key == None:
-                    instance_id = (gchrom,gstart,gend)
-                else:
-                    instance_id = gff.gtf_kv(a[20])[gtf_key]
+    # process bam files by genome shard
+    units = []
+    if not cache:
+        for bam_file in bam_files:
+            for shard in bam_shards.bam_shards(bam_file):
+                units.append((bam_file, shard))
 
-                cov_start = max(rstart, gstart)
-                cov_end = min(rend, gend)
+    fragments += bam_shards.merge_row_diffs(bam_shards.map_shards(coverage_unit, units, processes, bam_shards.init_worker, (features,)), coverage)
 
-                if gstrand == '+':
-                    inc_start = cov_start - gstart
-                    inc_end = cov_end - gstart + 1
-                else:
-                    inc_start = gend - cov_end
-                    inc_end = gend - cov_start + 1
+    np.cumsum(coverage, axis=1, out=coverage)
 
-                # find multi-map number, which may require removing a suffix
-                if rheader in multi_maps:
-                    mm = multi_maps[rheader]
-                else:
-                    rheader_base = rheader[:rheader.rfind('/')]
-                    if rheader_base in multi_maps:
-                        mm = multi_maps[rheader_base]
-                    else:
-                        mm = 1.0
+    # or slice them from their coverage caches
+    if cache:
+        for bam_file in bam_files:
+            cov = coverage_cache.coverage_cache(bam_file, filter_mapq=True, processes=processes)
+            fragments += cov.fragments
+            for chrom in feature_ivs.chroms:
+                chrom_idx = feature_ivs.chrom_records[chrom]
+                chrom_coverage = cov.window_coverage(chrom, feature_ivs.starts[chrom_idx], feature_ivs.ends[chrom_idx], feature_minus[chrom_idx], width)
+                np.add.at(coverage, (feature_rows[chrom_idx], slice(0,width)), chrom_coverage)
 
-                for i in range(inc_start, inc_end):
-                    coverage[instance_id][i] += 1.0/mm
+    instance_coverage = {}
+    for ri in range(len(instance_ids)):
+        instance_coverage[instance_ids[ri]] = coverage[ri,:width].tolist()
 
-        p.communicate()
+    return instance_coverage, fragments
 
-        # clean
-        os.close(bam_mapq_fd)
-        os.remove(bam_mapq_file)
 
-    return coverage, fragments
+################################################################################
+# coverage_unit
+#
+# Compute the coverage differences of one (BAM file, genome shard) unit's
+# mapq>0 reads over the (Intervals, instance rows, minus strands, width)
+# features set by bam_shards.init_worker, weighting multi-mappers by their NH
+# tags, and return the fragments counted and bam_shards.shard_row_diffs of the
+# instance rows covered.
+################################################################################
+def coverage_unit((bam_file, shard)):
+    feature_ivs, feature_rows, feature_minus, width = bam_shards.worker_state
+    chrom, start, end = shard
+
+    unit_incs = []
+    counter = bam_fragments.BamCounter(bam_file, filter_mapq=True, chrom=chrom, start=start, end=end)
+    for blocks in counter.overlaps(feature_ivs):
+        # 1-based gff coordinates
+        rstarts = blocks.starts[blocks.block_idx] + 1
+        rends = blocks.ends[blocks.block_idx]
+        gstarts = feature_ivs.starts[blocks.feature_idx] + 1
+        gends = feature_ivs.ends[blocks.feature_idx]
+        gminus = feature_minus[blocks.feature_idx]
+
+        cov_starts = np.maximum(rstarts, gstarts)
+        cov_ends = np.minimum(rends, gends)
+        inc_starts = np.where(gminus, gends - cov_ends, cov_starts - gstarts)
+        inc_ends = np.where(gminus, gends - cov_starts + 1, cov_ends - gstarts + 1)
+
+        unit_incs.append((feature_rows[blocks.feature_idx], inc_starts, inc_ends, 1.0/blocks.nh()[blocks.block_idx]))
+
+    return (counter.fragments,) + bam_shards.shard_row_diffs(unit_incs, width)
 
 
 ################################################################################
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+import bisect, multiprocessing, os
+import numpy as np
+import pysam
+
+################################################################################
+# bam_shards.py
+#
+# Split a pass over an indexed BAM file into shards of the genome, chromosomes
+# cut into tiles of at most tile_size bp, and run the shards across a process
+# pool whose workers each open the BAM file through its index.
+#
+# A shard is a (chrom, start, end) tuple in 0-based, half-open coordinates.
+# Reads belong to the shard holding their alignment start and windows to the
+# shard holding their start, so each is processed exactly once. Unplaced,
+# unmapped reads make a final ('*', None, None) shard, and an unindexed BAM
+# file is a single (None, None, None) shard of the whole file.
+#
+# Results come back in shard order whatever the number of processes, so
+# merging them in that order gives the same answer from run to run and from
+# one to many processes.
+#
+# Coverage over rows of windows, e.g. around features, is passed back from
+# each shard as difference matrices of only the rows it touches, built by
+# shard_row_diffs from (row, start, end, weight) increments and summed into
+# the full matrix by merge_row_diffs.
+################################################################################
+
+# maximum length of the chromosome tiles
+tile_size = 2**25
+
+
+################################################################################
+# bam_shards
+#
+# Return a list of the shards of the BAM file.
+################################################################################
+def bam_shards(bam_file, tile_size=tile_size):
+    if not bam_indexed(bam_file):
+        return [(None, None, None)]
+
+    bam_in = pysam.Samfile(bam_file, 'rb')
+    shards = []
+    for chrom, length in zip(bam_in.references, bam_in.lengths):
+        for start in range(0, length, tile_size):
+            shards.append((chrom, start, min(start+tile_size, length)))
+    bam_in.close()
+
+    # unplaced, unmapped reads
+    shards.append(('*', None, None))
+
+    return shards
+
+
+################################################################################
+# bam_indexed
+#
+# Return True if the BAM file has an index.
+################################################################################
+def bam_indexed(bam_file):
+    return os.path.isfile('%s.bai' % bam_file) or os.path.isfile('%s.bai' % bam_file[:-4])
+
+
+################################################################################
+# init_worker
+#
+# Set the state shared by the units of map_shards, as the initializer of each
+# process in a Pool.
+################################################################################
+worker_state = None
+def init_worker(state):
+    global worker_state
+    worker_state = state
+
+
+################################################################################
+# map_shards
+#
+# Yield unit_func applied to each of the units, in order, across a Pool of
+# the given number of processes, each initialized by initializer(*initargs),
+# or in this process.
+################################################################################
+def map_shards(unit_func, units, processes=1, initializer=None, initargs=()):
+    if processes > 1 and len(units) > 1:
+        pool = multiprocessing.Pool(processes, initializer, initargs)
+        try:
+            for result in pool.imap(unit_func, units):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    else:
+        if initializer is not None:
+            initializer(*initargs)
+        for unit in units:
+            yield unit_func(unit)
+
+
+################################################################################
+# merge_row_diffs
+#
+# Sum the (fragments, rows, row differences, row increments) results of
+# shard units, in order, into the difference matrix diffs and, if given, the
+# array of increment counts, and return the total fragments.
+################################################################################
+def merge_row_diffs(unit_results, diffs, counts=None):
+    fragments = 0
+    for unit_fragments, rows, unit_diffs, unit_counts in unit_results:
+        diffs[rows] += unit_diffs
+        if counts is not None:
+            counts[rows] += unit_counts
+        fragments += unit_fragments
+    return fragments
+
+
+################################################################################
+# shard_row_diffs
+#
+# Return the rows touched by a list of (rows, starts, ends, weights) arrays of
+# increments, a matrix of width+1 differences per row adding each weight over
+# [start, end) of its row, and the number of increments per row.
+################################################################################
+def shard_row_diffs(row_incs, width, dtype='float64'):
+    if row_incs:
+        inc_rows, inc_starts, inc_ends, weights = [np.concatenate([incs[c] for incs in row_incs]) for c in range(4)]
+    else:
+        inc_rows, inc_starts, inc_ends, weights = [np.zeros(0, dtype='int64') for c in range(4)]
+    weights = weights.astype(dtype)
+
+    # hold only the rows touched
+    rows, unit_rows = np.unique(inc_rows, return_inverse=True)
+    diffs = np.zeros((len(rows), width+1), dtype=dtype)
+    np.add.at(diffs, (unit_rows, inc_starts), weights)
+    np.add.at(diffs, (unit_rows, inc_ends), -weights)
+
+    return rows, diffs, np.bincount(unit_rows, minlength=len(rows))
+
+
+################################################################################
+# shard_windows
+#
+# Split windows hashed by chromosome as lists of tuples beginning with their
+# 1-based (start, end) by the shards holding their starts, and return a list
+# of the shards' windows hashed the same way. Windows on chromosomes without
+# shards are dropped.
+################################################################################
+def shard_windows(chrom_windows, shards):
+    chrom_shards = {}
+    for si in range(len(shards)):
+        chrom, start, end = shards[si]
+        if chrom is None:
+            # one shard of the whole file
+            return [chrom_windows]
+        elif start is not None:
+            chrom_shards.setdefault(chrom, ([],[]))
+            chrom_shards[chrom][0].append(start)
+            chrom_shards[chrom][1].append(si)
+
+    windows = [{} for shard in shards]
+    for chrom in chrom_windows:
+        if chrom not in chrom_shards:
+            continue
+
+        shard_starts, shard_idx = chrom_shards[chrom]
+        for window in chrom_windows[chrom]:
+            # windows starting before the chromosome belong to its first shard
+            ti = max(0, bisect.bisect_right(shard_starts, window[0]-1) - 1)
+            windows[shard_idx[ti]].setdefault(chrom,[]).append(window)
+
+    return windows
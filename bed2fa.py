@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 from optparse import OptionParser
-import gzip, os, sys
+import glob, gzip, multiprocessing, os, sys
 import dna
 
 ################################################################################
@@ -9,7 +9,10 @@ import dna
 # Given a bed file and fasta file or chromosome fasta file directory, produce
 # a fasta file of the bed entries.
 #
-# WARNING: Simple first attempt- no block support
+# The bed file is read once and its entries hashed by chromosome. Sequence is
+# fetched through the fasta index for uncompressed fasta files, optionally
+# processing chromosomes in parallel, and streamed for gzipped ones. BED12
+# entries can be spliced to their blocks.
 ################################################################################
 
 
@@ -19,8 +22,10 @@ import dna
 def main():
     usage = 'usage: %prog [options] <bed file>'
     parser = OptionParser(usage)
+    parser.add_option('-b', dest='blocks', default=False, action='store_true', help='Splice BED12 entries to their blocks [Default: %default]')
     parser.add_option('-c', dest='chr_dir', default='', help='Directory of chromosome files named according to the first column of the gff file')
     parser.add_option('-f', dest='fasta_file', default='%s/research/common/data/genomes/hg19/sequence/hg19.fa' % os.environ['HOME'], help='Fasta file [Default: %default]')
+    parser.add_option('-p', dest='processes', type='int', default=1, help='Number of processes to split chromosomes across [Default: %default]')
     (options,args) = parser.parse_args()
 
     if len(args) != 1:
@@ -28,12 +33,14 @@ def main():
     else:
         bed_file = args[0]
 
+    # hash entries by chromosome
+    chrom_features = read_features(bed_file, options.blocks)
+
     if options.fasta_file:
         fasta_files = [options.fasta_file]
     elif options.chr_dir:
-        bed_chrs = set([line.split()[0] for line in open(bed_file)])
         fasta_files = []
-        for chrom in bed_chrs:
+        for chrom in chrom_features:
             fasta_files += glob.glob(options.chr_dir+'/%s*' % chrom)
     else:
         parser.error('Must provide fasta source')
@@ -41,85 +48,149 @@ def main():
     for fasta_file in fasta_files:
         if fasta_file[-3:] == '.gz':
             fasta_open = gzip.open(fasta_file)
+
+            header = ''
+            line = fasta_open.readline()
+            while line:
+                if line[0] == '>':
+                    if header in chrom_features:
+                        header_bed(header, ''.join(seq_lines), chrom_features[header])
+                    header = line[1:].split()[0]
+                    seq_lines = []
+                else:
+                    seq_lines.append(line.rstrip())
+                line = fasta_open.readline()
+            if header in chrom_features:
+                header_bed(header, ''.join(seq_lines), chrom_features[header])
+
         else:
-            fasta_open = open(fasta_file)
-
-        header = ''
-        line = fasta_open.readline()
-        while line:
-            if line[0] == '>':
-                if header:
-                    header_bed(header, seq, bed_file, options)
-                header = line[1:].split()[0]
-                seq = ''
+            fasta = dna.Fasta(fasta_file)
+            chrom_args = [(fasta_file, chrom, chrom_features[chrom]) for chrom in fasta.names if chrom in chrom_features]
+            fasta.close()
+
+            if options.processes > 1:
+                pool = multiprocessing.Pool(options.processes)
+                for fasta_lines in pool.imap(fasta_header_bed, chrom_args):
+                    sys.stdout.write(fasta_lines)
+                pool.close()
+                pool.join()
             else:
-                seq += line.rstrip()
-            line = fasta_open.readline()
-        header_bed(header, seq, bed_file, options)
+                for chrom_arg in chrom_args:
+                    sys.stdout.write(fasta_header_bed(chrom_arg))
 
 
 ################################################################################
-# header_bed
+# fasta_header_bed
 #
-# Print sequence features for the given header and seq from the given bed file.
+# Open the indexed fasta file and return the fasta lines for the entries on
+# the given chromosome, taking a single tuple argument for Pool.imap.
 ################################################################################
-def header_bed(header, seq, bed_file, options):
-    for line in open(bed_file):
-        a = line.split('\t')
-        a[-1] = a[-1].rstrip()
+def fasta_header_bed((fasta_file, chrom, features)):
+    fasta = dna.Fasta(fasta_file)
 
-        if a[0] == header:
-            feat_start = int(a[1])
-            feat_end = int(a[2])
-
-            feat_strand = '+'
-            if len(a) > 5 and  a[5] == '-':
-                feat_strand = '-'
-
-            feat_header = ''
-            if len(a) > 3 and a[3] != '.':
-                feat_header = a[3] + ':'
-            feat_header += '%s:%d-%d:%s' % (header,feat_start,feat_end,feat_strand)
-            
-            if feat_strand == '+':
-                feat_seq = seq[feat_start:feat_end]
-            else:
-                feat_seq = dna.rc(seq[feat_start:feat_end])
+    fasta_lines = []
+    for feat_header, feat_seq in features_seqs(fasta[chrom], features):
+        fasta_lines.append('>%s\n' % feat_header)
+        i = 0
+        while i < len(feat_seq):
+            fasta_lines.append(feat_seq[i:i+60]+'\n')
+            i += 60
 
-            #print '>%s\n%s' % (feat_header, feat_seq)
-            print '>%s' % feat_header
-            i = 0
-            while i < len(feat_seq):
-                print feat_seq[i:i+60]
-                i += 60
+    fasta.close()
+
+    return ''.join(fasta_lines)
+
+
+################################################################################
+# features_seqs
+#
+# Yield (header, sequence) tuples for the entries on a chromosome with
+# sequence seq.
+################################################################################
+def features_seqs(seq, features):
+    for feat_name, feat_header, feat_strand, blocks in features:
+        feat_seq = ''.join([seq[bstart:bend] for (bstart,bend) in blocks])
+        if feat_strand == '-':
+            feat_seq = dna.rc(feat_seq)
+        yield feat_header, feat_seq
+
+
+################################################################################
+# header_bed
+#
+# Print sequence features for the given header and seq from the given bed
+# entries.
+################################################################################
+def header_bed(header, seq, features):
+    for feat_header, feat_seq in features_seqs(seq, features):
+        #print '>%s\n%s' % (feat_header, feat_seq)
+        print '>%s' % feat_header
+        i = 0
+        while i < len(feat_seq):
+            print feat_seq[i:i+60]
+            i += 60
 
 
 ################################################################################
 # header_bed_id
 #
-# Print sequence features for the given header and seq from the given bed file,
-# merging features with the same ID.
+# Print sequence features for the given header and seq from the given bed
+# entries, merging features with the same ID.
 ################################################################################
-def header_bed_id(header, seq, bed_file, options):
+def header_bed_id(header, seq, features):
     header_seqs = {}
+    for head_id, feat_header, feat_strand, blocks in features:
+        feat_seq = ''.join([seq[bstart:bend] for (bstart,bend) in blocks])
+
+        if feat_strand == '+':
+            header_seqs[head_id] = header_seqs.get(head_id,'') + feat_seq
+        else:
+            header_seqs[head_id] = dna.rc(feat_seq) + header_seqs.get(head_id,'')
+
+    for head_id in header_seqs:
+        print '>%s\n%s' % (head_id,header_seqs[head_id])
+
+
+################################################################################
+# read_features
+#
+# Hash the bed entries by chromosome as lists of (name, header, strand, blocks)
+# tuples, where blocks are 0-based, half-open (start, end) tuples covering the
+# entire entry unless splicing BED12 entries to their blocks.
+################################################################################
+def read_features(bed_file, splice_blocks=False):
+    chrom_features = {}
     for line in open(bed_file):
         a = line.split('\t')
         a[-1] = a[-1].rstrip()
 
-        if a[0] == header:
-            feat_start = int(a[1])
-            feat_end = int(a[2])
-            head_id = a[3]
-            
-            feat_seq = seq[feat_start:feat_end]
+        chrom = a[0]
+        feat_start = int(a[1])
+        feat_end = int(a[2])
 
-            if a[5] == '+':
-                header_seqs[head_id] = header_seqs.get(head_id,'') + feat_seq
-            else:
-                header_seqs[head_id] = dna.rc(feat_seq) + header_seqs.get(head_id,'')
+        feat_strand = '+'
+        if len(a) > 5 and  a[5] == '-':
+            feat_strand = '-'
 
-    for head_id in header_seqs:
-        print '>%s\n%s' % (head_id,header_seqs[head_id])
+        feat_header = ''
+        if len(a) > 3 and a[3] != '.':
+            feat_header = a[3] + ':'
+        feat_header += '%s:%d-%d:%s' % (chrom,feat_start,feat_end,feat_strand)
+
+        if splice_blocks and len(a) > 11 and int(a[9]) > 0:
+            block_sizes = [int(x) for x in a[10].split(',') if x]
+            block_starts = [int(x) for x in a[11].split(',') if x]
+            blocks = [(feat_start+block_starts[i], feat_start+block_starts[i]+block_sizes[i]) for i in range(int(a[9]))]
+        else:
+            blocks = [(feat_start,feat_end)]
+
+        feat_name = ''
+        if len(a) > 3:
+            feat_name = a[3]
+
+        chrom_features.setdefault(chrom,[]).append((feat_name, feat_header, feat_strand, blocks))
+
+    return chrom_features
 
 
 ################################################################################
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+from optparse import OptionParser
+import array, gzip, marshal, os
+import numpy as np
+import disk_cache, intersect
+
+################################################################################
+# chain_index.py
+#
+# Index a UCSC chain file as, per reference chromosome, arrays of the
+# alignment blocks' reference start and end, query start and chain, sorted by
+# reference start, saved to disk so repeated liftovers skip parsing the chain
+# file.
+#
+# Query starts are on the query's + strand regardless of the chain's
+# orientation. Intervals are mapped by intersecting them with the blocks using
+# intersect.py.
+#
+# The index is a directory holding a chain table and one .npy file of blocks
+# per reference chromosome, which are memory-mapped when loaded.
+################################################################################
+
+index_version = 1
+
+################################################################################
+# main
+################################################################################
+def main():
+    usage = 'usage: %prog [options] <chain file>'
+    parser = OptionParser(usage)
+    parser.add_option('-i', dest='index_dir', help='Index directory [Default: <chain file>.idx]')
+    (options,args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error('Must provide chain file')
+    else:
+        chain_file = args[0]
+
+    if options.index_dir is None:
+        options.index_dir = '%s.idx' % chain_file
+
+    write_index(parse_chains(chain_file), options.index_dir)
+
+
+################################################################################
+# chain_index
+#
+# Return the ChainIndex for the chain file, loading it from index_dir if it
+# is up to date and otherwise parsing the chain file and saving the index
+# there.
+################################################################################
+def chain_index(chain_file, index_dir=None):
+    def parse():
+        return parse_chains(chain_file)
+
+    if index_dir is None:
+        index_dir = '%s.idx' % chain_file
+
+    return disk_cache.load_or_build(index_dir, chain_file, read_index, parse, write_index, 'chain index')
+
+
+################################################################################
+# parse_chains
+#
+# Parse the chain file into a ChainIndex.
+################################################################################
+def parse_chains(chain_file):
+    if chain_file[-3:] == '.gz':
+        chain_in = gzip.open(chain_file)
+    else:
+        chain_in = open(chain_file)
+
+    chain_ids = []
+    chain_qchroms = []
+    chain_dirs = []
+    chrom_cols = {}
+
+    for line in chain_in:
+        if line.startswith('chain'):
+            a = line.split()
+            rchrom = a[2]
+            rstrand = a[4]
+            qstrand = a[9]
+            if qstrand == '+':
+                qstart = int(a[10])
+                qend = int(a[11])
+            else:
+                qstart = int(a[8]) - int(a[11])
+                qend = int(a[8]) - int(a[10])
+            map_dir = (rstrand == qstrand)
+
+            chain_i = len(chain_ids)
+            chain_ids.append(a[-1])
+            chain_qchroms.append(a[7])
+            chain_dirs.append(map_dir)
+
+            if rchrom not in chrom_cols:
+                chrom_cols[rchrom] = tuple([array.array('l') for c in range(4)])
+            rstart_col, rend_col, qstart_col, chain_col = chrom_cols[rchrom]
+
+            # to follow along w/ alignments in the chain
+            align_rstart = int(a[5])
+            if map_dir:
+                align_qstart = qstart
+            else:
+                align_qend = qend
+
+        elif line[0] != '#' and line.rstrip():
+            a = line.split()
+            align_size = int(a[0])
+            if len(a) > 1:
+                rgap = int(a[1])
+                qgap = int(a[2])
+            else:
+                rgap = 0
+                qgap = 0
+
+            align_rend = align_rstart + align_size
+            if map_dir:
+                align_qend = align_qstart + align_size
+            else:
+                align_qstart = align_qend - align_size
+
+            rstart_col.append(align_rstart)
+            rend_col.append(align_rend)
+            qstart_col.append(align_qstart)
+            chain_col.append(chain_i)
+
+            # get past the gap
+            align_rstart = align_rend + rgap
+            if map_dir:
+                align_qstart = align_qend + qgap
+            else:
+                align_qend = align_qstart - qgap
+
+    chain_in.close()
+
+    chrom_blocks = {}
+    for rchrom in chrom_cols:
+        blocks = np.array(chrom_cols[rchrom], dtype='int64').T
+        chrom_blocks[rchrom] = blocks[np.argsort(blocks[:,0], kind='mergesort')]
+
+    return ChainIndex(chain_ids, chain_qchroms, chain_dirs, chrom_blocks)
+
+
+################################################################################
+# read_index
+#
+# Load the ChainIndex saved in index_dir, memory-mapping the blocks.
+################################################################################
+def read_index(index_dir):
+    index = marshal.load(open('%s/chains' % index_dir, 'rb'))
+    if index.get('version') != index_version:
+        raise ValueError('Unsupported chain index version in %s' % index_dir)
+
+    chrom_blocks = {}
+    for i in range(len(index['chroms'])):
+        chrom_blocks[index['chroms'][i]] = np.load('%s/%d.npy' % (index_dir,i), mmap_mode='r')
+
+    return ChainIndex(index['chain_ids'], index['chain_qchroms'], index['chain_dirs'], chrom_blocks, index_dir)
+
+
+################################################################################
+# write_index
+#
+# Save the ChainIndex to index_dir.
+################################################################################
+def write_index(index, index_dir):
+    def write_chains(tmp_dir):
+        os.makedirs(tmp_dir)
+
+        chroms = sorted(index.chrom_blocks)
+        for i in range(len(chroms)):
+            np.save('%s/%d.npy' % (tmp_dir,i), index.chrom_blocks[chroms[i]])
+
+        index_out = open('%s/chains' % tmp_dir, 'wb')
+        marshal.dump({'version':index_version, 'chroms':chroms, 'chain_ids':index.chain_ids, 'chain_qchroms':index.chain_qchroms, 'chain_dirs':[bool(d) for d in index.chain_dirs]}, index_out, 2)
+        index_out.close()
+
+    disk_cache.write_aside(index_dir, write_chains)
+    index.index_dir = index_dir
+
+
+################################################################################
+# ChainIndex
+#
+# The alignment blocks of a chain file. chrom_blocks maps each reference
+# chromosome to an array of (reference start, reference end, query start,
+# chain) rows, where chains index chain_ids, chain_qchroms and chain_dirs,
+# True if the chain maps the reference and query in the same direction.
+# index_dir is the directory the index is saved in, if any.
+################################################################################
+class ChainIndex:
+    def __init__(self, chain_ids, chain_qchroms, chain_dirs, chrom_blocks, index_dir=None):
+        self.chain_ids = chain_ids
+        self.chain_qchroms = chain_qchroms
+        self.chain_dirs = np.array(chain_dirs, dtype='bool')
+        self.chrom_blocks = chrom_blocks
+        self.index_dir = index_dir
+
+    ############################################################################
+    # map_intervals
+    #
+    # Map the overlapping portions of the intervals in feature_ivs through the
+    # alignment blocks, optionally considering only the chains marked in the
+    # boolean array chain_mask, and return arrays of the feature index, chain
+    # and 0-based, half-open query start and end of each mapping.
+    ############################################################################
+    def map_intervals(self, feature_ivs, chain_mask=None):
+        feature_ivs.finalize()
+
+        map_parts = []
+        for chrom in feature_ivs.chroms:
+            if chrom not in self.chrom_blocks:
+                continue
+
+            blocks = self.chrom_blocks[chrom]
+            if chain_mask is not None:
+                blocks = blocks[chain_mask[blocks[:,3]]]
+
+            block_ivs = intersect.Intervals()
+            block_ivs.extend(chrom, blocks[:,0], blocks[:,1])
+
+            feature_idx, block_idx, bp = intersect.intersect(feature_ivs, block_ivs)
+            hit_blocks = blocks[block_idx]
+
+            # can only map the overlapping portion
+            align_rstart = hit_blocks[:,0]
+            align_rend = hit_blocks[:,1]
+            align_qstart = hit_blocks[:,2]
+            chains = hit_blocks[:,3]
+            map_rstart = np.maximum(align_rstart, feature_ivs.starts[feature_idx])
+            map_rend = np.minimum(align_rend, feature_ivs.ends[feature_idx])
+
+            map_dirs = self.chain_dirs[chains]
+            map_qstart = np.where(map_dirs, align_qstart + (map_rstart - align_rstart), align_qstart + (align_rend - map_rend))
+            map_qend = np.where(map_dirs, align_qstart + (map_rend - align_rstart), align_qstart + (align_rend - map_rstart))
+
+            map_parts.append((feature_idx, chains, map_qstart, map_qend))
+
+        if map_parts:
+            return tuple([np.concatenate([part[c] for part in map_parts]) for c in range(4)])
+        else:
+            return tuple([np.zeros(0, dtype='int64') for c in range(4)])
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 from optparse import OptionParser
-from bx.intervals.intersection import Interval, IntervalTree
-import gzip, pdb, sys
-import gff
+import gzip, multiprocessing, pdb, sys
+import numpy as np
+import chain_index, gff, intersect
 
 ################################################################################
 # chain_map.py
@@ -15,6 +15,13 @@ import gff
 # The chain files are messy and contain overlapping alignment blocks, so
 # I'm separating each chain. To further filter the output, provide a net
 # file, and I'll only map to chains in the net.
+#
+# The chain file is parsed once into an index of alignment blocks saved next
+# to it (see chain_index.py), which later liftovers load instead.
+#
+# A chain aligns a single reference chromosome, so features are mapped and
+# merged one reference chromosome at a time, optionally across processes, and
+# written in chromosome order.
 ################################################################################
 
 
@@ -24,9 +31,11 @@ import gff
 def main():
     usage = 'usage: %prog [options] <chain file> <gff file>'
     parser = OptionParser(usage)
+    parser.add_option('-i', dest='index_dir', help='Chain index directory [Default: <chain file>.idx]')
     parser.add_option('-k', dest='gtf_key', help='Group based on the given gtf key [Default: %default]')
     parser.add_option('-m', dest='merge_t', type='int', default=40, help='Minimum distance between alignment blocks to merge into a single exon [Default: %default]')
     parser.add_option('-n', dest='net_file', help='Net file to filter the chains considered')
+    parser.add_option('-p', dest='processes', type='int', default=1, help='Number of processes to split reference chromosomes across [Default: %default]')
     (options,args) = parser.parse_args()
 
     if len(args) != 2:
@@ -35,9 +44,8 @@ def main():
         chain_file = args[0]
         gff_file = args[1]
 
-    # build interval tree's of gff annotations
-    # map intervals to annotations
-    chr_features, interval_map = gff_intervals(gff_file, options.gtf_key)
+    # hash annotations by reference chromosome
+    chrom_gff_lines = read_gff_chroms(gff_file)
 
     # filter by net chains
     if options.net_file:
@@ -45,64 +53,30 @@ def main():
     else:
         net_chains = None
 
-    # process chain file
-    if chain_file[-3:] == '.gz':
-        chain_in = gzip.open(chain_file)
-    else:
-        chain_in = open(chain_file)
-
-    # header
-    line = chain_in.readline()
-    while line[:2] == '##':
-        line = chain_in.readline()
-
-    # map features
-    mapped_features = {}
-    chain_lines = []
-    while line:
-        if line.startswith('chain'):
-            if chain_lines and (not net_chains or chain_id in net_chains):
-                process_chain(chr_features, interval_map, mapped_features, chain_lines)
-            chain_lines = [line]
-            chain_id = line.split()[-1]
-        elif line.rstrip(): # skip blank lines
-            chain_lines.append(line)
-
-        line = chain_in.readline()
-    chain_in.close()
-
-    if chain_lines and (not net_chains or chain_id in net_chains):
-        process_chain(chr_features, interval_map, mapped_features, chain_lines)
-
-    # merge mapped features as gff lines
-    for feature_id in mapped_features:
-        for chain_id in mapped_features[feature_id]:
-            # sort features
-            mapped_features[feature_id][chain_id].sort(feature_cmp)
+    # index chain file
+    index = chain_index.chain_index(chain_file, options.index_dir)
 
-            # make first line
-            (qchrom,qstart,qend,qstrand) = mapped_features[feature_id][chain_id][0]
-            gff_cols = [[qchrom, 'MyTransMap', 'feature', qstart, qend, '.', qstrand, '.', 'chain_id %s; %s'%(chain_id,feature_id)]]
+    if net_chains:
+        chain_mask = np.array([chain_id in net_chains for chain_id in index.chain_ids], dtype='bool')
+    else:
+        chain_mask = None
 
-            # make the rest of the lines
-            for (qchrom,qstart,qend,qstrand) in mapped_features[feature_id][chain_id][1:]:
+    # map features by reference chromosome
+    chroms = sorted(chrom_gff_lines)
 
-                if gff_cols[-1][0] == qchrom and gff_cols[-1][6] == qstrand and gff_cols[-1][4] + options.merge_t >= qstart:
-                    # large overlaps unexpected
-                    ovl_start = max(gff_cols[-1][3], qstart)
-                    ovl_end = min(gff_cols[-1][4], qend)
-                    if (ovl_end-ovl_start+1) > 50:
-                        print >> sys.stderr, 'Large overlap between features - %s' % feature_id
-
-                    # merge w/ prior
-                    gff_cols[-1][4] = qend
-                else:
-                    # add new
-                    gff_cols.append([qchrom, 'MyTransMap', 'feature', qstart, qend, '.', qstrand, '.', 'chain_id %s; %s'%(chain_id,feature_id)])
+    if options.processes > 1 and index.index_dir is None:
+        print >> sys.stderr, 'WARNING: chain index not saved; mapping in a single process'
+        options.processes = 1
 
-            # print lines
-            for cols in gff_cols:
-                print '\t'.join([str(c) for c in cols])
+    if options.processes > 1:
+        pool = multiprocessing.Pool(options.processes, init_liftover_worker, (index.index_dir, chain_mask, options.gtf_key, options.merge_t))
+        for gff_lines in pool.imap(liftover_unit, [chrom_gff_lines[chrom] for chrom in chroms]):
+            sys.stdout.write(gff_lines)
+        pool.close()
+        pool.join()
+    else:
+        for chrom in chroms:
+            sys.stdout.write(liftover(index, chrom_gff_lines[chrom], options.gtf_key, options.merge_t, chain_mask))
 
 
 ################################################################################
@@ -134,13 +108,15 @@ def get_net_chains(net_file):
 ################################################################################
 # gff_intervals
 #
-# Build interval tree's of gff annotations and map intervals to annotations.
+# Return Intervals of the distinct intervals of the gff lines, in gff
+# coordinates, and a list of the (feature_id, strand) tuples with each.
 ################################################################################
-def gff_intervals(gff_file, gtf_key):
-    chr_features = {}
-    interval_map = {}
+def gff_intervals(gff_lines, gtf_key):
+    feature_ivs = intersect.Intervals()
+    interval_features = []
+    interval_i = {}
 
-    for line in open(gff_file):
+    for line in gff_lines:
         a = line.split('\t')
         a[-1] = a[-1].rstrip()
 
@@ -153,10 +129,12 @@ def gff_intervals(gff_file, gtf_key):
         else:
             feature_id = a[8]
 
-        chr_features.setdefault(chrom,IntervalTree()).insert_interval(Interval(start,end))
-        interval_map.setdefault(chrom,{}).setdefault((start,end),[]).append((feature_id,strand))
+        if (chrom,start,end) not in interval_i:
+            interval_i[(chrom,start,end)] = feature_ivs.add(chrom, start, end)
+            interval_features.append([])
+        interval_features[interval_i[(chrom,start,end)]].append((feature_id,strand))
 
-    return chr_features, interval_map
+    return feature_ivs, interval_features
 
 
 ################################################################################
@@ -191,90 +169,128 @@ def feature_cmp(x, y):
 
     
 ################################################################################
-# process_chain
+# init_liftover_worker
 #
-# Map the annotation features described in chr_features and interval_map
-# from the reference to query genomes described by the alignment chain in
-# chain_lines and save the mappings to mapped_features.
+# Load the chain index and set the mapping parameters used by liftover_unit,
+# as the initializer of each process in a Pool.
 ################################################################################
-def process_chain(chr_features, interval_map, mapped_features, chain_lines):
-    a = chain_lines[0].split()
-    rchrom = a[2]
-    rstrand = a[4]
-    rstart = int(a[5])
-    rend = int(a[6])
-    qchrom = a[7]
-    qstrand = a[9]
-    if qstrand == '+':
-        qstart = int(a[10])
-        qend = int(a[11])
-    else:
-        qstart = int(a[8]) - int(a[11])
-        qend = int(a[8]) - int(a[10])
-    chain_id = a[-1]
-    map_dir = (rstrand == qstrand)
-
-    # to follow along w/ alignments in the chain
-    align_rstart = rstart
-    if map_dir:
-        align_qstart = qstart
-    else:
-        align_qend = qend
-
-    if rchrom in chr_features:
-        for line in chain_lines[1:]:            
-            # get alignment info
-            a = line.split()
-            align_size = int(a[0])
-            if len(a) > 1:
-                rgap = int(a[1])
-                qgap = int(a[2])
-            else:
-                rgap = 0
-                qgap = 0
+def init_liftover_worker(index_dir, chain_mask, gtf_key, merge_t):
+    global worker_index, worker_chain_mask, worker_gtf_key, worker_merge_t
+    worker_index = chain_index.read_index(index_dir)
+    worker_chain_mask = chain_mask
+    worker_gtf_key = gtf_key
+    worker_merge_t = merge_t
 
-            align_rend = align_rstart + align_size
-            if map_dir:
-                align_qend = align_qstart + align_size
-            else:
-                align_qstart = align_qend - align_size
-
-            # search for overlapping feature intervals
-            for feature_interval in chr_features[rchrom].find(align_rstart, align_rend):
-                # can only map the overlapping portion
-                map_rstart = max(align_rstart, feature_interval.start)
-                map_rend = min(align_rend, feature_interval.end)
-
-                # map                
-                if map_dir:
-                    map_qstart = align_qstart + (map_rstart - align_rstart)
-                    map_qend = align_qstart + (map_rend - align_rstart)
+
+################################################################################
+# liftover
+#
+# Map the features in the gff lines, all on one reference chromosome, and
+# return the merged mappings as gff text, sorted by feature and chain.
+################################################################################
+def liftover(index, gff_lines, gtf_key, merge_t, chain_mask=None):
+    feature_ivs, interval_features = gff_intervals(gff_lines, gtf_key)
+    mapped_features = map_features(index, feature_ivs, interval_features, chain_mask)
+    return merge_features(mapped_features, merge_t)
+
+
+################################################################################
+# liftover_unit
+#
+# Map the features in the gff lines of one reference chromosome using the
+# index and parameters set by init_liftover_worker.
+################################################################################
+worker_index = None
+worker_chain_mask = None
+worker_gtf_key = None
+worker_merge_t = None
+def liftover_unit(gff_lines):
+    return liftover(worker_index, gff_lines, worker_gtf_key, worker_merge_t, worker_chain_mask)
+
+
+################################################################################
+# map_features
+#
+# Map the annotation features described by feature_ivs and interval_features
+# from the reference to query genomes through the indexed alignment chains,
+# and return the mappings hashed by feature id and chain id.
+################################################################################
+def map_features(index, feature_ivs, interval_features, chain_mask=None):
+    mapped_features = {}
+
+    feature_idx, chains, map_qstarts, map_qends = index.map_intervals(feature_ivs, chain_mask)
+
+    for i in range(len(feature_idx)):
+        chain_id = index.chain_ids[chains[i]]
+        qchrom = index.chain_qchroms[chains[i]]
+        map_dir = index.chain_dirs[chains[i]]
+
+        # apply to all features w/ this interval
+        for (feature_id,map_rstrand) in interval_features[feature_idx[i]]:
+            map_qstrand = map_rstrand
+            if not map_dir:
+                # flip
+                if map_qstrand == '+':
+                    map_qstrand = '-'
                 else:
-                    map_qstart = align_qstart + (align_rend - map_rend)
-                    map_qend = align_qstart + (align_rend - map_rstart)
-                
-                #log_cols = [chain_id, align_rstart, align_rend, align_qstart, align_qend, feature_interval.start, feature_interval.end, map_rstart, map_rend, map_qstart, map_qend]
-                #print >> sys.stderr, '\t'.join([str(c) for c in log_cols])
-
-                # apply to all features w/ this interval
-                for (feature_id,map_rstrand) in interval_map[rchrom][(feature_interval.start,feature_interval.end)]:
-                    map_qstrand = map_rstrand
-                    if not map_dir:
-                        # flip
-                        if map_qstrand == '+':
-                            map_qstrand = '-'
-                        else:
-                            map_qstrand = '+'
-
-                    # add 1 to start to convert 0-based to 1-based
-                    mapped_features.setdefault(feature_id,{}).setdefault(chain_id,[]).append((qchrom,map_qstart+1,map_qend,map_qstrand))
-
-            # get past the gap
-            align_rstart = align_rend + rgap
-            if map_dir:
-                align_qstart = align_qend + qgap
-            else:
-                align_qend = align_qstart - qgap
+                    map_qstrand = '+'
+
+            # add 1 to start to convert 0-based to 1-based
+            mapped_features.setdefault(feature_id,{}).setdefault(chain_id,[]).append((qchrom,int(map_qstarts[i])+1,int(map_qends[i]),map_qstrand))
+
+    return mapped_features
+
+
+################################################################################
+# merge_features
+#
+# Merge the mapped features of each feature and chain whose mappings lie
+# within merge_t bp and return them as gff text.
+################################################################################
+def merge_features(mapped_features, merge_t):
+    gff_lines = []
+
+    for feature_id in sorted(mapped_features):
+        for chain_id in sorted(mapped_features[feature_id]):
+            # sort features
+            mapped_features[feature_id][chain_id].sort(feature_cmp)
+
+            # make first line
+            (qchrom,qstart,qend,qstrand) = mapped_features[feature_id][chain_id][0]
+            gff_cols = [[qchrom, 'MyTransMap', 'feature', qstart, qend, '.', qstrand, '.', 'chain_id %s; %s'%(chain_id,feature_id)]]
+
+            # make the rest of the lines
+            for (qchrom,qstart,qend,qstrand) in mapped_features[feature_id][chain_id][1:]:
+
+                if gff_cols[-1][0] == qchrom and gff_cols[-1][6] == qstrand and gff_cols[-1][4] + merge_t >= qstart:
+                    # large overlaps unexpected
+                    ovl_start = max(gff_cols[-1][3], qstart)
+                    ovl_end = min(gff_cols[-1][4], qend)
+                    if (ovl_end-ovl_start+1) > 50:
+                        print >> sys.stderr, 'Large overlap between features - %s' % feature_id
+
+                    # merge w/ prior
+                    gff_cols[-1][4] = qend
+                else:
+                    # add new
+                    gff_cols.append([qchrom, 'MyTransMap', 'feature', qstart, qend, '.', qstrand, '.', 'chain_id %s; %s'%(chain_id,feature_id)])
+
+            for cols in gff_cols:
+                gff_lines.append('\t'.join([str(c) for c in cols]) + '\n')
+
+    return ''.join(gff_lines)
+
+
+################################################################################
+# read_gff_chroms
+#
+# Hash the lines of the gff file by chromosome.
+################################################################################
+def read_gff_chroms(gff_file):
+    chrom_gff_lines = {}
+    for line in open(gff_file):
+        chrom_gff_lines.setdefault(line.split('\t')[0],[]).append(line)
+    return chrom_gff_lines
 
 
 ################################################################################
@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 from optparse import OptionParser
-import os, subprocess, sys
+import sys
 import networkx as nx
-import gff
+import gff, intersect
 
 ################################################################################
 # clean_merged_gtf.py
@@ -119,35 +119,29 @@ def main():
 # Compute transcript overlaps and build overlap graph
 ################################################################################
 def make_overlap_graph(mgene_id, merged_g2t, merged_tid_lines):
-    # make temporary gff file for gene
-    tmp_out = open('%s.gff' % mgene_id, 'w')
+    # collect the gene's exons
+    exon_lines = []
+    exon_tids = []
     for tid in merged_g2t[mgene_id]:
         for line in merged_tid_lines[tid]:
             a = line.split('\t')
             if a[2] == 'exon':
-                print >> tmp_out, line,
-    tmp_out.close()
+                exon_lines.append(line)
+                exon_tids.append(tid)
+    exon_ivs = intersect.parse_intervals(exon_lines)[0]
 
     tid_overlap_graph = nx.Graph()
 
     # intersect with self
-    proc = subprocess.Popen('intersectBed -wo -s -a %s.gff -b %s.gff' % (mgene_id,mgene_id), shell=True, stdout=subprocess.PIPE)
-    line = proc.stdout.readline()
-    while line:
-        a = line.split('\t')
-
-        tid1 = gff.gtf_kv(a[8])['transcript_id']
-        tid2 = gff.gtf_kv(a[17])['transcript_id']
+    exon_idx1, exon_idx2, overlap_bp = intersect.intersect(exon_ivs, exon_ivs, same_strand=True)
+    for i in range(len(exon_idx1)):
+        tid1 = exon_tids[exon_idx1[i]]
+        tid2 = exon_tids[exon_idx2[i]]
 
         # ignore same and ignore different ref genes
         if tid1 != tid2:                    
             tid_overlap_graph.add_edge(tid1,tid2)
 
-        line = proc.stdout.readline()
-    proc.communicate()
-
-    os.remove('%s.gff' % mgene_id)
-
     return tid_overlap_graph
 
 
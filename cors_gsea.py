@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 from optparse import OptionParser
 from scipy.stats import norm
-import math, networkx, pdb, random
-import util, fdr
+import math, multiprocessing, networkx, pdb
+import fdr, gsea_kernel, util
 
 ################################################################################
 # cors_gsea.py
@@ -34,6 +34,7 @@ def main():
     parser.add_option('--go_min', dest='go_min', type='int', default=10, help='Minimum number of genes assigned a GO term to consider enrichment of that term')
     parser.add_option('--go_max', dest='go_max', type='int', default=300, help='Maximum number of genes assigned a GO term to consider enrichment of that term')
     parser.add_option('-n', dest='null_samples', type='int', default=50, help='Number of null samples to obtain p-value [Default: %default]')
+    parser.add_option('-p', dest='processes', type='int', default=1, help='Number of processes to split null samples across [Default: %default]')
     (options,args) = parser.parse_args()
 
     if len(args) != 2:
@@ -56,34 +57,36 @@ def main():
     consider_go = [go_term for go_term in go_map if options.go_min <= len(go_map[go_term]) <= options.go_max]
 
     # compute null GO term enrichments
+    init_null_sample([go_map[go_term] for go_term in consider_go])
+    if options.processes > 1:
+        pool = multiprocessing.Pool(options.processes, init_null_sample, (null_go_sets,))
+        sample_enrichments = pool.imap(process_null_sample, read_null_samples(null_file, options.null_samples))
+    else:
+        sample_enrichments = (process_null_sample(ncg) for ncg in read_null_samples(null_file, options.null_samples))
+
     null_go_enrichments = {}
-    header = ''
-    samples = 0
-    for line in open(null_file):
-        if line[0] == '>':
-            if header:
-                if samples < options.null_samples:
-                    process_null_sample(null_correlations_genes, null_go_enrichments, go_map, consider_go)
-                    samples += 1
-            header = line[1:].rstrip()
-            null_correlations_genes = []            
-        else:
-            a = line.split()
-            null_correlations_genes.append((abs(float(a[1])),a[0]))
-    if samples < options.null_samples:
-        process_null_sample(null_correlations_genes, null_go_enrichments, go_map, consider_go)
-        samples += 1
+    for enrichments in sample_enrichments:
+        for gi in range(len(consider_go)):
+            null_go_enrichments.setdefault(consider_go[gi],[]).append(enrichments[gi])
+
+    if options.processes > 1:
+        pool.close()
+        pool.join()
 
     for go_term in consider_go:
         null_out = open('null_%s_%d.txt' % (go_term,len(go_map[go_term])), 'w')
         print >> null_out, '\n'.join([str(enr) for enr in null_go_enrichments[go_term]])
         null_out.close()
 
+    # compute enrichments
+    ranked_genes = gsea_kernel.RankedGenes(correlations_genes)
+    go_enrichments = ranked_genes.enrichments([go_map[go_term] for go_term in consider_go])
+
     # do stats
     output_cols = []
-    for go_term in consider_go:
-        # compute enrichment
-        enrichment = gsea_enrichment(correlations_genes, go_map[go_term])
+    for gi in range(len(consider_go)):
+        go_term = consider_go[gi]
+        enrichment = go_enrichments[gi]
 
         # compute p-value using normal approximation
         #p_val = (1+len([e for e in geneset_size_enrichments[go_size] if e >= enrichment])) / float(options.num_shuffles)
@@ -130,28 +133,15 @@ def genes_from_cdf():
 
 
 ################################################################################
-# gsea_enrichment
+# init_null_sample
 #
-# Compute enrichment score as defined in Subramanian et al 2005.
+# Set the GO term gene sets scored by process_null_sample, e.g. as the
+# initializer of each process in a Pool.
 ################################################################################
-def gsea_enrichment(correlations_genes, term_genes):
-    p_hit = [0.0]*(1+len(correlations_genes))
-    p_miss = [0.0]*(1+len(correlations_genes))
-
-    i = 1
-    for (cor,gene) in correlations_genes:
-        if gene in term_genes:
-            p_hit[i] = p_hit[i-1] + cor
-            p_miss[i] = p_miss[i-1]
-        else:
-            p_hit[i] = p_hit[i-1]
-            p_miss[i] = p_miss[i-1] + 1.0
-        i += 1
-
-    p_hit = [p/p_hit[-1] for p in p_hit]
-    p_miss = [p/p_miss[-1] for p in p_miss]
-
-    return max([p_hit[i]-p_miss[i] for i in range(len(p_hit))])
+null_go_sets = []
+def init_null_sample(go_sets):
+    global null_go_sets
+    null_go_sets = go_sets
 
 
 ################################################################################
@@ -213,9 +203,11 @@ def load_go_graph():
 ################################################################################
 # make_null_dist
 #
-# Make the null distributions for various gene set sizes, spacing them out
+# Make the null distributions for various gene set sizes, spacing them out,
+# using gsea_kernel to generate them in parallel with seeded random sets and
+# cache them on disk.
 ################################################################################
-def make_null_dist(go_min, go_max, num_shuffles, size_skip, go_map, correlations_genes, genes):
+def make_null_dist(go_min, go_max, num_shuffles, size_skip, go_map, ranked_genes, seed=1, processes=1, cache=True):
     # find set sizes
     set_sizes = set()
     for go_term in go_map:
@@ -224,7 +216,7 @@ def make_null_dist(go_min, go_max, num_shuffles, size_skip, go_map, correlations
             set_sizes.add(go_size)
 
     # distribute null distributions evenly in set range
-    geneset_size_enrichments = {}
+    null_sizes = []
     ss_max = max(set_sizes)
     ss = min(set_sizes)
     while ss < ss_max:
@@ -233,12 +225,18 @@ def make_null_dist(go_min, go_max, num_shuffles, size_skip, go_map, correlations
             if x in set_sizes:
                 ss_use = True
         if ss_use:
-            geneset_size_enrichments[ss] = [gsea_enrichment(correlations_genes, random.sample(genes,ss)) for i in range(num_shuffles)]
+            null_sizes.append(ss)
         ss += size_skip
 
     # get the max
-    if not ss_max in geneset_size_enrichments:
-        geneset_size_enrichments[ss_max] = [gsea_enrichment(correlations_genes, random.sample(genes,ss_max)) for i in range(num_shuffles)]
+    if not ss_max in null_sizes:
+        null_sizes.append(ss_max)
+
+    size_enrichments = gsea_kernel.null_enrichments(ranked_genes, null_sizes, num_shuffles, seed, processes, cache)
+
+    geneset_size_enrichments = {}
+    for ss in null_sizes:
+        geneset_size_enrichments[ss] = size_enrichments[ss].tolist()
 
     return geneset_size_enrichments
 
@@ -246,14 +244,12 @@ def make_null_dist(go_min, go_max, num_shuffles, size_skip, go_map, correlations
 ################################################################################
 # process_null_sample
 #
-# Compute GO term enrichments for the given null sample of correlations and
-# add them to the data structure.
+# Compute GO term enrichments for the given null sample of correlations.
 ################################################################################
-def process_null_sample(correlations_genes, go_enrichments, go_map, consider_go):
+def process_null_sample(correlations_genes):
     correlations_genes.sort(reverse=True)
-    for go_term in consider_go:
-        enrichment = gsea_enrichment(correlations_genes, go_map[go_term])
-        go_enrichments.setdefault(go_term,[]).append(enrichment)
+    ranked_genes = gsea_kernel.RankedGenes(correlations_genes)
+    return ranked_genes.enrichments(null_go_sets)
 
 
 ################################################################################
@@ -288,6 +284,29 @@ def read_go(genes):
     return go_map, go_descs
 
 
+################################################################################
+# read_null_samples
+#
+# Yield up to max_samples null samples of (correlation, gene) tuples from the
+# fasta-style null file.
+################################################################################
+def read_null_samples(null_file, max_samples):
+    samples = 0
+    null_correlations_genes = None
+    for line in open(null_file):
+        if line[0] == '>':
+            if null_correlations_genes is not None:
+                if samples < max_samples:
+                    yield null_correlations_genes
+                    samples += 1
+            null_correlations_genes = []
+        else:
+            a = line.split()
+            null_correlations_genes.append((abs(float(a[1])),a[0]))
+    if null_correlations_genes is not None and samples < max_samples:
+        yield null_correlations_genes
+
+
 ################################################################################
 # __main__
 ################################################################################
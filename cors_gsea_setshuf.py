@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 from optparse import OptionParser
 from scipy.stats import norm
-import math, networkx, pdb, random
-import util, fdr
+import math, networkx, pdb
+import fdr, gsea_kernel, util
 
 ################################################################################
 # gsea.py
@@ -29,6 +29,9 @@ def main():
     parser.add_option('--go_min', dest='go_min', type='int', default=10, help='Minimum number of genes assigned a GO term to consider enrichment of that term')
     parser.add_option('--go_max', dest='go_max', type='int', default=300, help='Maximum number of genes assigned a GO term to consider enrichment of that term')
     parser.add_option('-n', dest='num_shuffles', type='int', default=250, help='Number of shuffles to obtain p-value [Default: %default]')
+    parser.add_option('--no_cache', dest='cache', default=True, action='store_false', help='Do not read or write cached null distributions [Default: %default]')
+    parser.add_option('-p', dest='processes', type='int', default=1, help='Number of processes to generate null distributions across [Default: %default]')
+    parser.add_option('-r', dest='seed', type='int', default=1, help='Random seed for the null distributions [Default: %default]')
     parser.add_option('-s', dest='size_skip', type='int', default=4, help='Gene set sizes to skip when computing null distributions [Default: %default]')
     (options,args) = parser.parse_args()
 
@@ -46,27 +49,32 @@ def main():
         genes.append(a[0])
     correlations_genes.sort(reverse=True)
 
+    ranked_genes = gsea_kernel.RankedGenes(correlations_genes)
+
     # GO
     go_map, go_descs = read_go(set(genes))
 
     # make null distributions
-    geneset_size_enrichments = make_null_dist(options.go_min, options.go_max, options.num_shuffles, options.size_skip, go_map, correlations_genes, genes)
+    geneset_size_enrichments = make_null_dist(options.go_min, options.go_max, options.num_shuffles, options.size_skip, go_map, ranked_genes, options.seed, options.processes, options.cache)
+
+    # compute enrichments
+    consider_go = [go_term for go_term in go_map if options.go_min <= len(go_map[go_term]) <= options.go_max]
+    go_enrichments = ranked_genes.enrichments([go_map[go_term] for go_term in consider_go])
 
     # do stats
     output_cols = []
-    for go_term in go_map:
+    for gi in range(len(consider_go)):
+        go_term = consider_go[gi]
         go_size = len(go_map[go_term])
-        if options.go_min <= go_size <= options.go_max:
-            # compute enrichment
-            enrichment = gsea_enrichment(correlations_genes, go_map[go_term])
-
-            # compute p-value using normal approximation
-            #p_val = (1+len([e for e in geneset_size_enrichments[go_size] if e >= enrichment])) / float(options.num_shuffles)
-            (mean, sd) = interpolate_null(geneset_size_enrichments, options.size_skip, go_size)
-            p_val = max(norm.rvs(1,loc=0,scale=1e-17), 1.0 - norm.cdf(enrichment, loc=mean, scale=sd))
-            
-            # output
-            output_cols.append([go_term, enrichment, p_val, 99, go_size, go_descs[go_term]])
+        enrichment = go_enrichments[gi]
+
+        # compute p-value using normal approximation
+        #p_val = (1+len([e for e in geneset_size_enrichments[go_size] if e >= enrichment])) / float(options.num_shuffles)
+        (mean, sd) = interpolate_null(geneset_size_enrichments, options.size_skip, go_size)
+        p_val = max(norm.rvs(1,loc=0,scale=1e-17), 1.0 - norm.cdf(enrichment, loc=mean, scale=sd))
+        
+        # output
+        output_cols.append([go_term, enrichment, p_val, 99, go_size, go_descs[go_term]])
 
     # FDR multiple hypothesis correction
     p_values = [oc[2] for oc in output_cols]
@@ -104,31 +112,6 @@ def genes_from_cdf():
     return genes
 
 
-################################################################################
-# gsea_enrichment
-#
-# Compute enrichment score as defined in Subramanian et al 2005.
-################################################################################
-def gsea_enrichment(correlations_genes, term_genes):
-    p_hit = [0.0]*(1+len(correlations_genes))
-    p_miss = [0.0]*(1+len(correlations_genes))
-
-    i = 1
-    for (cor,gene) in correlations_genes:
-        if gene in term_genes:
-            p_hit[i] = p_hit[i-1] + cor
-            p_miss[i] = p_miss[i-1]
-        else:
-            p_hit[i] = p_hit[i-1]
-            p_miss[i] = p_miss[i-1] + 1.0
-        i += 1
-
-    p_hit = [p/p_hit[-1] for p in p_hit]
-    p_miss = [p/p_miss[-1] for p in p_miss]
-
-    return max([p_hit[i]-p_miss[i] for i in range(len(p_hit))])
-
-
 ################################################################################
 # interpolate_null
 #
@@ -188,9 +171,11 @@ def load_go_graph():
 ################################################################################
 # make_null_dist
 #
-# Make the null distributions for various gene set sizes, spacing them out
+# Make the null distributions for various gene set sizes, spacing them out,
+# using gsea_kernel to generate them in parallel with seeded random sets and
+# cache them on disk.
 ################################################################################
-def make_null_dist(go_min, go_max, num_shuffles, size_skip, go_map, correlations_genes, genes):
+def make_null_dist(go_min, go_max, num_shuffles, size_skip, go_map, ranked_genes, seed=1, processes=1, cache=True):
     # find set sizes
     set_sizes = set()
     for go_term in go_map:
@@ -199,7 +184,7 @@ def make_null_dist(go_min, go_max, num_shuffles, size_skip, go_map, correlations
             set_sizes.add(go_size)
 
     # distribute null distributions evenly in set range
-    geneset_size_enrichments = {}
+    null_sizes = []
     ss_max = max(set_sizes)
     ss = min(set_sizes)
     while ss < ss_max:
@@ -208,12 +193,18 @@ def make_null_dist(go_min, go_max, num_shuffles, size_skip, go_map, correlations
             if x in set_sizes:
                 ss_use = True
         if ss_use:
-            geneset_size_enrichments[ss] = [gsea_enrichment(correlations_genes, random.sample(genes,ss)) for i in range(num_shuffles)]
+            null_sizes.append(ss)
         ss += size_skip
 
     # get the max
-    if not ss_max in geneset_size_enrichments:
-        geneset_size_enrichments[ss_max] = [gsea_enrichment(correlations_genes, random.sample(genes,ss_max)) for i in range(num_shuffles)]
+    if not ss_max in null_sizes:
+        null_sizes.append(ss_max)
+
+    size_enrichments = gsea_kernel.null_enrichments(ranked_genes, null_sizes, num_shuffles, seed, processes, cache)
+
+    geneset_size_enrichments = {}
+    for ss in null_sizes:
+        geneset_size_enrichments[ss] = size_enrichments[ss].tolist()
 
     return geneset_size_enrichments
 
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+from optparse import OptionParser
+import marshal, os
+import numpy as np
+import bam_filters, bam_fragments, bam_shards, disk_cache, intersect
+
+################################################################################
+# coverage_cache.py
+#
+# Compute the per-base, stranded read coverage of a BAM file once and save it
+# to disk, so profile and heatmap tools can slice windows out of it rather
+# than pass over the BAM file again for every set of windows.
+#
+# Coverage counts the aligned blocks of reads, including deletions but not
+# introns, optionally skipping reads with mapping quality 0 or those samtools
+# mpileup skips, and weighting multi-mappers by 1/NH. Each parameter set is
+# cached separately beneath <bam file>.cov and rebuilt when the BAM file is
+# newer than it.
+#
+# The coverage of each chromosome and read strand is held run-length encoded
+# as arrays of the 0-based positions where it changes and its value from each
+# position on, saved as .npy files that are memory-mapped when loaded. The BAM
+# file is read by genome shard (see bam_shards.py), optionally across
+# processes.
+################################################################################
+
+cache_version = 1
+
+# strands of the coverage tracks and their file names
+track_strands = {'+':'plus', '-':'minus'}
+
+# maximum number of positions to look up at once
+max_lookup = 2**22
+
+
+################################################################################
+# main
+################################################################################
+def main():
+    usage = 'usage: %prog [options] <bam file>'
+    parser = OptionParser(usage)
+    parser.add_option('-f', dest='pileup', default=False, action='store_true', help='Skip reads as samtools mpileup does [Default: %default]')
+    parser.add_option('-m', dest='filter_mapq', default=False, action='store_true', help='Skip reads with mapping quality 0 [Default: %default]')
+    parser.add_option('-p', dest='processes', default=1, type='int', help='Number of processes to split the genome across [Default: %default]')
+    parser.add_option('-u', dest='unweighted', default=False, action='store_true', help='Count multi-mappers fully rather than by 1/NH [Default: %default]')
+    (options,args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error('Must provide BAM file')
+    else:
+        bam_file = args[0]
+
+    cov = coverage_cache(bam_file, options.filter_mapq, options.pileup, not options.unweighted, options.processes)
+    print cov.cache_dir
+
+
+################################################################################
+# cache_dir
+#
+# Return the directory caching the BAM file's coverage for the parameters.
+################################################################################
+def cache_dir(bam_file, filter_mapq=False, pileup=False, weight_nh=True):
+    return '%s.cov/mapq%d_pileup%d_nh%d' % (bam_file, filter_mapq, pileup, weight_nh)
+
+
+################################################################################
+# compute_coverage
+#
+# Pass over the BAM file by genome shard and return its CoverageCache.
+################################################################################
+def compute_coverage(bam_file, filter_mapq=False, pileup=False, weight_nh=True, processes=1):
+    shards = bam_shards.bam_shards(bam_file)
+    units = [(bam_file, shard, filter_mapq, pileup, weight_nh) for shard in shards]
+
+    fragments = 0.0
+    tracks = {}
+    track_parts = {}
+    for ui, (unit_fragments, unit_tracks) in enumerate(bam_shards.map_shards(coverage_unit, units, processes)):
+        fragments += unit_fragments
+        for track in unit_tracks:
+            track_parts.setdefault(track, []).append(unit_tracks[track])
+
+        # a chromosome's shards are consecutive, so its tracks are complete
+        # once the next shard moves past it
+        if ui+1 < len(shards):
+            next_chrom = shards[ui+1][0]
+        else:
+            next_chrom = None
+
+        for track in track_parts.keys():
+            if track[0] != next_chrom:
+                positions, deltas = merge_deltas(track_parts.pop(track))
+                tracks[track] = run_lengths(positions, deltas)
+
+    return CoverageCache(tracks, fragments)
+
+
+################################################################################
+# coverage_cache
+#
+# Return the CoverageCache of the BAM file for the parameters, loading it if
+# it is up to date and otherwise computing it and saving it.
+################################################################################
+def coverage_cache(bam_file, filter_mapq=False, pileup=False, weight_nh=True, processes=1):
+    def compute():
+        return compute_coverage(bam_file, filter_mapq, pileup, weight_nh, processes)
+
+    cov_dir = cache_dir(bam_file, filter_mapq, pileup, weight_nh)
+    return disk_cache.load_or_build(cov_dir, bam_file, read_cache, compute, write_cache, 'coverage cache')
+
+
+################################################################################
+# coverage_unit
+#
+# Return the fragments counted in one (BAM file, genome shard, filter mapq,
+# pileup, weight NH) unit and a dict mapping its (chrom, strand) tracks to
+# arrays of the positions where coverage changes and the changes there.
+################################################################################
+def coverage_unit((bam_file, shard, filter_mapq, pileup, weight_nh)):
+    chrom, start, end = shard
+
+    if pileup:
+        read_filter = bam_filters.pileup_filter()
+    else:
+        read_filter = None
+
+    block_parts = {}
+    counter = bam_fragments.BamCounter(bam_file, filter_mapq=filter_mapq, read_filter=read_filter, chrom=chrom, start=start, end=end)
+    for blocks in counter.blocks():
+        blocks.finalize()
+        if weight_nh:
+            weights = 1.0 / blocks.nh()
+        else:
+            weights = np.ones(len(blocks))
+
+        for ci in range(len(blocks.chroms)):
+            for strand in track_strands:
+                track_blocks = (blocks.chrom_codes == ci) & (blocks.strands == intersect.strand_codes[strand])
+                block_parts.setdefault((blocks.chroms[ci],strand), []).append((blocks.starts[track_blocks], blocks.ends[track_blocks], weights[track_blocks]))
+
+    unit_tracks = {}
+    for track in block_parts:
+        starts, ends, weights = [np.concatenate([part[c] for part in block_parts[track]]) for c in range(3)]
+        unit_tracks[track] = merge_deltas([(np.concatenate([starts,ends]), np.concatenate([weights,-weights]))])
+
+    return counter.fragments, unit_tracks
+
+
+################################################################################
+# merge_deltas
+#
+# Merge a list of (positions, changes) arrays into the sorted, unique
+# positions and the sum of the changes at each.
+################################################################################
+def merge_deltas(parts):
+    positions, position_idx = np.unique(np.concatenate([part[0] for part in parts]), return_inverse=True)
+    deltas = np.bincount(position_idx, weights=np.concatenate([part[1] for part in parts]), minlength=len(positions))
+    return positions, deltas
+
+
+################################################################################
+# read_cache
+#
+# Load the CoverageCache saved in cov_dir, memory-mapping the tracks.
+################################################################################
+def read_cache(cov_dir):
+    index = marshal.load(open('%s/tracks' % cov_dir, 'rb'))
+    if index.get('version') != cache_version:
+        raise ValueError('Unsupported coverage cache version in %s' % cov_dir)
+
+    tracks = {}
+    for i in range(len(index['chroms'])):
+        for strand in index['strands'][i]:
+            track_pre = '%s/%d_%s' % (cov_dir, i, track_strands[strand])
+            tracks[(index['chroms'][i],strand)] = (np.load('%s_pos.npy' % track_pre, mmap_mode='r'), np.load('%s_cov.npy' % track_pre, mmap_mode='r'))
+
+    return CoverageCache(tracks, index['fragments'], cov_dir)
+
+
+################################################################################
+# run_lengths
+#
+# Return the run-length encoding of the coverage summed from the changes at
+# the sorted positions, as arrays of the positions where it changes and its
+# value from each on. Rounding residues of zero coverage are dropped.
+################################################################################
+def run_lengths(positions, deltas):
+    coverage = np.cumsum(deltas)
+    coverage[np.abs(coverage) < 1e-6] = 0
+    coverage = coverage.astype('float32')
+
+    changes = (coverage != np.concatenate([[0], coverage[:-1]]))
+    return positions[changes], coverage[changes]
+
+
+################################################################################
+# write_cache
+#
+# Save the CoverageCache to cov_dir.
+################################################################################
+def write_cache(cov, cov_dir):
+    def write_tracks(tmp_dir):
+        os.makedirs(tmp_dir)
+
+        chroms = sorted(set([chrom for chrom, strand in cov.tracks]))
+        chrom_strands = []
+        for i in range(len(chroms)):
+            chrom_strands.append(''.join([strand for strand in sorted(track_strands) if (chroms[i],strand) in cov.tracks]))
+            for strand in chrom_strands[-1]:
+                track_pre = '%s/%d_%s' % (tmp_dir, i, track_strands[strand])
+                positions, coverage = cov.tracks[(chroms[i],strand)]
+                np.save('%s_pos.npy' % track_pre, positions)
+                np.save('%s_cov.npy' % track_pre, coverage)
+
+        index_out = open('%s/tracks' % tmp_dir, 'wb')
+        marshal.dump({'version':cache_version, 'chroms':chroms, 'strands':chrom_strands, 'fragments':float(cov.fragments)}, index_out, 2)
+        index_out.close()
+
+    disk_cache.write_aside(cov_dir, write_tracks)
+    cov.cache_dir = cov_dir
+
+
+################################################################################
+# CoverageCache
+#
+# The coverage of a BAM file. tracks maps each (chrom, strand) to arrays of
+# the 0-based positions where the coverage of reads aligned to that strand
+# changes and its value from each position to the next, zero before the
+# first. fragments is the number of fragments counted as by
+# bam_fragments.BamCounter, and cache_dir is the directory the cache is saved
+# in, if any.
+################################################################################
+class CoverageCache:
+    def __init__(self, tracks, fragments, cache_dir=None):
+        self.tracks = tracks
+        self.fragments = fragments
+        self.cache_dir = cache_dir
+
+    ############################################################################
+    # positions_coverage
+    #
+    # Return an array of the coverage at the 0-based positions of chrom, of
+    # reads on the given strand or on both.
+    ############################################################################
+    def positions_coverage(self, chrom, positions, strand=None):
+        if strand is None:
+            strands = sorted(track_strands)
+        else:
+            strands = [strand]
+
+        coverage = np.zeros(positions.shape)
+        for strand in strands:
+            if (chrom,strand) in self.tracks:
+                run_starts, run_coverage = self.tracks[(chrom,strand)]
+                run_idx = np.searchsorted(run_starts, positions, side='right') - 1
+                coverage += np.where(run_idx >= 0, run_coverage[np.maximum(run_idx,0)], 0)
+
+        return coverage
+
+    ############################################################################
+    # window_coverage
+    #
+    # Return a matrix of the coverage of chrom by position in the 0-based,
+    # half-open windows [start, end) of the arrays starts and ends, reversed
+    # where the boolean array reverse is set, with width columns, zero past
+    # each window's end.
+    ############################################################################
+    def window_coverage(self, chrom, starts, ends, reverse=None, width=None, strand=None):
+        if width is None:
+            width = max(0, (ends-starts).max()) if len(starts) else 0
+        if reverse is None:
+            reverse = np.zeros(len(starts), dtype='bool')
+
+        coverage = np.zeros((len(starts), width))
+        offsets = np.arange(width)
+        chunk = max(1, max_lookup / max(1, width))
+        for ci in range(0, len(starts), chunk):
+            cstarts = starts[ci:ci+chunk,np.newaxis]
+            cends = ends[ci:ci+chunk,np.newaxis]
+            positions = np.where(reverse[ci:ci+chunk,np.newaxis], cends-1-offsets, cstarts+offsets)
+            coverage[ci:ci+chunk] = np.where(offsets < cends-cstarts, self.positions_coverage(chrom, positions, strand), 0)
+
+        return coverage
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+    main()
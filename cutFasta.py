@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from optparse import OptionParser
 import gzip, sys
+import dna
 
 ############################################################
 # cutFasta
@@ -33,14 +34,59 @@ def main():
 # header in the file fasta_file
 ############################################################
 def cf(start, end, header, contain, fasta_file):
+    if fasta_file[-3:] == '.gz':
+        seq, header = cf_stream(start, end, header, contain, fasta_file)
+    else:
+        seq, header = cf_indexed(header, contain, fasta_file)
+
+    # print seq
+    if start and end:
+        return '>%s_(%d-%d)\n%s' % (header,start,end,seq[start-1:end])
+    elif start:
+        return '>%s_(%d-)\n%s' % (header,start,seq[start-1:])
+    elif end:
+        return '>%s_(-%d)\n%s' % (header,start,seq[:end])
+    else:
+        return '>%s\n%s' % (header,seq)
+
+############################################################
+# cf_indexed
+#
+# Find the entry header in the uncompressed fasta_file and
+# return a view of its sequence through the fasta index,
+# so only the cut is read. A missing entry has an empty
+# sequence, as when streaming.
+############################################################
+def cf_indexed(header, contain, fasta_file):
+    fasta = dna.Fasta(fasta_file)
+
+    if not header:
+        header = fasta.names[0]
+    elif contain:
+        contain_names = [name for name in fasta.names if name.find(header) != -1]
+        if contain_names:
+            header = contain_names[0]
+    elif header not in fasta and header.split()[0] in fasta:
+        # index names are the first word of the header
+        header = header.split()[0]
+
+    if header not in fasta:
+        return '', header
+
+    return fasta[header], header
+
+############################################################
+# cf_stream
+#
+# Read the sequence of the entry header from fasta_file up
+# to end.
+############################################################
+def cf_stream(start, end, header, contain, fasta_file):
     # collect sequence up to end
     seq = ''
     get_seq = False
 
-    if fasta_file[-3:] == '.gz':
-        ff = gzip.open(fasta_file)
-    else:
-        ff = open(fasta_file)
+    ff = gzip.open(fasta_file)
     line = ff.readline()
     while line:
         if line[0] == '>':
@@ -65,15 +111,7 @@ def cf(start, end, header, contain, fasta_file):
 
         line = ff.readline()
 
-    # print seq
-    if start and end:
-        return '>%s_(%d-%d)\n%s' % (header,start,end,seq[start-1:end])
-    elif start:
-        return '>%s_(%d-)\n%s' % (header,start,seq[start-1:])
-    elif end:
-        return '>%s_(-%d)\n%s' % (header,start,seq[:end])
-    else:
-        return '>%s\n%s' % (header,seq)
+    return seq, header
 
 ############################################################
 # __main__
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+import os, shutil, sys
+
+################################################################################
+# disk_cache.py
+#
+# Load and save the on-disk caches of data derived from input files, such as
+# BAM coverage, chain indexes, annotation stores and null distributions.
+#
+# A cache is a file or directory, loaded if it is no older than the file it
+# was derived from and rebuilt otherwise. Caches are written aside under a
+# temporary name and renamed into place, so readers never see a partial one.
+# A cache that cannot be read or written only costs the time to rebuild it,
+# so failures are warnings rather than errors.
+################################################################################
+
+# exceptions raised reading or writing a damaged or inaccessible cache
+read_errors = (IOError, OSError, ValueError, EOFError, TypeError)
+write_errors = (IOError, OSError, ValueError)
+
+
+################################################################################
+# load
+#
+# Return the data read from the cache at path by read_fn(path), or None if
+# there is no cache, it is older than src_file, it cannot be read or read_fn
+# returns None for it.
+################################################################################
+def load(path, src_file, read_fn, desc='cache'):
+    if not os.path.exists(path):
+        return None
+    if src_file is not None and os.path.getmtime(path) < os.path.getmtime(src_file):
+        return None
+
+    try:
+        return read_fn(path)
+    except read_errors:
+        print >> sys.stderr, 'WARNING: unable to read %s in %s' % (desc, path)
+        return None
+
+
+################################################################################
+# load_or_build
+#
+# Return the data loaded from the cache at path as by load, or otherwise
+# built by build_fn() and saved there by write_fn(data, path).
+################################################################################
+def load_or_build(path, src_file, read_fn, build_fn, write_fn, desc='cache'):
+    data = load(path, src_file, read_fn, desc)
+    if data is None:
+        data = build_fn()
+        save(path, data, write_fn, desc)
+    return data
+
+
+################################################################################
+# save
+#
+# Save the data to the cache at path by write_fn(data, path), returning True
+# if it was saved.
+################################################################################
+def save(path, data, write_fn, desc='cache'):
+    try:
+        write_fn(data, path)
+        return True
+    except write_errors:
+        print >> sys.stderr, 'WARNING: unable to save %s in %s' % (desc, path)
+        return False
+
+
+################################################################################
+# write_aside
+#
+# Write the file or directory at path by write_fn(tmp_path), which must
+# create tmp_path, and rename it into place, replacing any existing one.
+################################################################################
+def write_aside(path, write_fn):
+    parent_dir = os.path.dirname(path)
+    if parent_dir and not os.path.isdir(parent_dir):
+        os.makedirs(parent_dir)
+
+    tmp_path = '%s.%d' % (path, os.getpid())
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+
+    write_fn(tmp_path)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
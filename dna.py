@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 # no __future__ division!
-import string, sys, math, random, pdb
+import mmap, os, string, sys, math, random, pdb
 
 ############################################################
 # dna
@@ -14,24 +14,217 @@ import string, sys, math, random, pdb
 # Read a multifasta file into a dict.  Taking the whole line
 # as the key.
 #
-# I've found this can be quite slow for some reason, even
-# for a single fasta entry.
+# Sequence lines are joined once per entry. For random
+# access into large files, use Fasta instead.
 ############################################################
 def fasta2dict(fasta_file):
-    fasta_dict = {}    
+    fasta_dict = {}
     header = ''
-    
+    seq_lines = []
+
     for line in open(fasta_file):
         if line[0] == '>':
+            if header:
+                fasta_dict[header] = ''.join(seq_lines)
             #header = line.split()[0][1:]
             header = line[1:].rstrip()
-            fasta_dict[header] = ''
+            seq_lines = []
         else:
-            fasta_dict[header] += line.rstrip()
+            seq_lines.append(line.rstrip())
+
+    if header:
+        fasta_dict[header] = ''.join(seq_lines)
 
     return fasta_dict
 
 
+############################################################
+# faidx
+#
+# Build a samtools-compatible .fai index for the fasta file,
+# returning a dict mapping sequence names to tuples of
+# (length, offset, line bases, line width) and the list of
+# names in file order.
+############################################################
+def faidx(fasta_file):
+    index = {}
+    names = []
+
+    name = None
+    offset = 0
+    fasta_in = open(fasta_file, 'rb')
+    for line in fasta_in:
+        if line[0] == '>':
+            name = line[1:].split()[0]
+            names.append(name)
+            # length, offset, line bases, line width, last line seen
+            index[name] = [0, offset+len(line), 0, 0, False]
+
+        elif name is not None:
+            entry = index[name]
+            line_bases = len(line.rstrip('\r\n'))
+
+            if entry[4] and line_bases > 0:
+                raise ValueError('Lines of different lengths in fasta entry %s' % name)
+
+            if entry[2] == 0:
+                entry[2] = line_bases
+                entry[3] = len(line)
+            elif line_bases != entry[2] or len(line) != entry[3]:
+                # only the last line may be shorter
+                if line_bases > entry[2]:
+                    raise ValueError('Lines of different lengths in fasta entry %s' % name)
+                entry[4] = True
+
+            entry[0] += line_bases
+
+        offset += len(line)
+    fasta_in.close()
+
+    for name in names:
+        index[name] = tuple(index[name][:4])
+
+    return index, names
+
+
+############################################################
+# Fasta
+#
+# Random access to the sequences of an uncompressed fasta
+# file through a memory map and a .fai index, which is
+# built next to the fasta file if missing or out of date.
+############################################################
+class Fasta:
+    def __init__(self, fasta_file):
+        if fasta_file[-3:] == '.gz':
+            raise ValueError('Indexed fasta access requires an uncompressed file: %s' % fasta_file)
+
+        self.fasta_file = fasta_file
+        self.index, self.names = self.read_index()
+
+        self.fasta_in = open(fasta_file, 'rb')
+        if os.path.getsize(fasta_file) > 0:
+            self.mm = mmap.mmap(self.fasta_in.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.mm = ''
+
+    def read_index(self):
+        fai_file = '%s.fai' % self.fasta_file
+
+        if os.path.isfile(fai_file) and os.path.getmtime(fai_file) >= os.path.getmtime(self.fasta_file):
+            index = {}
+            names = []
+            for line in open(fai_file):
+                a = line.split('\t')
+                names.append(a[0])
+                index[a[0]] = (int(a[1]), int(a[2]), int(a[3]), int(a[4]))
+
+        else:
+            index, names = faidx(self.fasta_file)
+            try:
+                fai_out = open(fai_file, 'w')
+                for name in names:
+                    print >> fai_out, '%s\t%d\t%d\t%d\t%d' % ((name,)+index[name])
+                fai_out.close()
+            except IOError:
+                print >> sys.stderr, 'WARNING: unable to write fasta index %s' % fai_file
+
+        return index, names
+
+    def close(self):
+        if self.mm:
+            self.mm.close()
+        self.fasta_in.close()
+
+    ############################################################
+    # fetch
+    #
+    # Return the sequence of chrom from start to end, using
+    # 1-based, inclusive coordinates as in gff, reverse
+    # complemented for strand '-'. Coordinates are clipped to
+    # the sequence.
+    ############################################################
+    def fetch(self, chrom, start, end, strand='+'):
+        seq = self.slice(chrom, start-1, end)
+        if strand == '-':
+            seq = rc(seq)
+        return seq
+
+    ############################################################
+    # slice
+    #
+    # Return the sequence of chrom from 0-based start up to
+    # end, as in a python slice, reading only the bytes that
+    # span it.
+    ############################################################
+    def slice(self, chrom, start, end):
+        length, offset, line_bases, line_width = self.index[chrom]
+
+        start = max(0, start)
+        end = min(length, end)
+        if start >= end:
+            return ''
+
+        byte_start = offset + (start / line_bases)*line_width + start % line_bases
+        byte_end = offset + ((end-1) / line_bases)*line_width + (end-1) % line_bases + 1
+
+        seq = self.mm[byte_start:byte_end]
+        if line_width > line_bases:
+            seq = seq.replace('\n','').replace('\r','')
+        return seq
+
+    def __contains__(self, chrom):
+        return chrom in self.index
+
+    def __getitem__(self, chrom):
+        return FastaSeq(self, chrom)
+
+    def __len__(self):
+        return len(self.names)
+
+
+############################################################
+# FastaSeq
+#
+# A single sequence of a Fasta that slices like a string
+# without ever loading the whole sequence.
+############################################################
+class FastaSeq:
+    def __init__(self, fasta, chrom):
+        self.fasta = fasta
+        self.chrom = chrom
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, end, step = i.indices(len(self))
+            if step < 0:
+                # fetch forward from just after end through start
+                seq = self.fasta.slice(self.chrom, end+1, start+1)
+            else:
+                seq = self.fasta.slice(self.chrom, start, end)
+            if step != 1:
+                seq = seq[::step]
+            return seq
+        else:
+            if i < 0:
+                i += len(self)
+            if i < 0 or i >= len(self):
+                raise IndexError('FastaSeq index out of range')
+            return self.fasta.slice(self.chrom, i, i+1)
+
+    def __getslice__(self, start, end):
+        # negative bounds already have len added
+        start = max(start, 0)
+        end = max(end, 0)
+        return self.__getitem__(slice(start, end))
+
+    def __len__(self):
+        return self.fasta.index[self.chrom][0]
+
+    def __str__(self):
+        return self.fasta.slice(self.chrom, 0, len(self))
+
+
 ############################################################
 # rc
 #
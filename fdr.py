@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from optparse import OptionParser
-import math
+import array, gzip, math, sys
+import numpy as np
 
 ################################################################################
 # fdr
@@ -13,50 +14,134 @@ import math
 # main
 ################################################################################
 def main():
-    usage = 'usage: %prog [options] <table file> <p-value column>'
+    usage = 'usage: %prog [options] <table file> <p-value column # or name>'
     parser = OptionParser(usage)
-    #parser.add_option()
+    parser.add_option('-l', dest='pi0_method', default='fixed', help='Method to choose lambda for estimating pi_0: fixed, bootstrap, or smoother [Default: %default]')
+    parser.add_option('-o', dest='out_file', default=None, help='Output file [Default: stdout]')
     (options,args) = parser.parse_args()
 
     if len(args) != 2:
-        parser.error('Must provide table file and the column # with the p-value')
+        parser.error('Must provide table file and the column # or header name with the p-value')
     else:
         table_file = args[0]
-        p_col = int(args[1])
+        p_col = args[1]
 
-    pvals = [float(line.split()[p_col]) for line in open(table_file)]
-    qvals = storey(pvals)
+    # a column name means the table has a header line
+    header = False
+    try:
+        p_col = int(p_col)
+    except ValueError:
+        header = True
+        table_in = open_table(table_file)
+        header_cols = table_in.readline().split()
+        table_in.close()
+        if p_col not in header_cols:
+            parser.error('Column %s not in the table header' % p_col)
+        p_col = header_cols.index(p_col)
 
+    # pass 1: collect p-values
+    pvals = read_pvalues(table_file, p_col, header)
+    qvals = storey_array(pvals, pi0_method=options.pi0_method)
+    del pvals
+
+    # pass 2: annotate lines
+    if options.out_file:
+        out = open(options.out_file, 'w')
+    else:
+        out = sys.stdout
+    write_qvalues(table_file, qvals, header, out)
+    if options.out_file:
+        out.close()
+
+
+################################################################################
+# open_table
+#
+# Open a table file for reading, gzipped or not.
+################################################################################
+def open_table(table_file):
+    if table_file[-3:] == '.gz':
+        return gzip.open(table_file)
+    else:
+        return open(table_file)
+
+
+################################################################################
+# read_pvalues
+#
+# Read the p-values in column p_col of a table file into a numpy float array,
+# holding nothing else from the table.
+################################################################################
+def read_pvalues(table_file, p_col, header=False):
+    pvals = array.array('d')
+
+    table_in = open_table(table_file)
+    if header:
+        table_in.readline()
+    for line in table_in:
+        pvals.append(float(line.split(None, p_col+1)[p_col]))
+    table_in.close()
+
+    return np.frombuffer(pvals, dtype='float64')
+
+
+################################################################################
+# write_qvalues
+#
+# Print the lines of a table file with their q-values appended, in buffered
+# chunks.
+################################################################################
+def write_qvalues(table_file, qvals, header=False, out=sys.stdout, chunk_lines=100000):
+    table_in = open_table(table_file)
+    if header:
+        print >> out, '%s %s' % (table_in.readline().rstrip(), 'qvalue')
+
+    out_lines = []
     i = 0
-    for line in open(table_file):
-        print '%s %7.2e' % (line.rstrip(), qvals[i])
+    for line in table_in:
+        out_lines.append('%s %7.2e\n' % (line.rstrip(), qvals[i]))
         i += 1
+
+        if len(out_lines) >= chunk_lines:
+            out.write(''.join(out_lines))
+            out_lines = []
+
+    out.write(''.join(out_lines))
+    table_in.close()
   
 
 ################################################################################
 # ben_hoch
 #
 # Convert the given p-values to q-values using Benjamini-Hochberg FDR.
+#
+# q-values are made monotone in the p-values and capped at 1.
 ################################################################################
 def ben_hoch(p_values):
-    m = len(p_values)
+    return ben_hoch_array(p_values).tolist()
 
-    # attach original indexes to p-values
-    p_k = [(p_values[k],k) for k in range(m)]
 
-    # sort by p-value
-    p_k.sort()
-
-    # compute q-value and attach original index to front
-    k_q = [(p_k[i][1],p_k[i][0]*m/(i+1)) for i in range(m)]
+################################################################################
+# ben_hoch_array
+#
+# Benjamini-Hochberg q-values for an array of p-values as a numpy array.
+################################################################################
+def ben_hoch_array(p_values):
+    p = np.asarray(p_values, dtype='float64')
+    m = len(p)
+    if m == 0:
+        return np.zeros(0)
 
-    # re-sort by original index
-    k_q.sort()
+    order = np.argsort(p, kind='mergesort')
+    p_sorted = p[order]
 
-    # drop original indexes
-    q_values = [k_q[k][1] for k in range(m)]
+    q_sorted = p_sorted * m / np.arange(1, m+1)
+    q_sorted = np.minimum.accumulate(q_sorted[::-1])[::-1]
+    q_sorted = np.minimum(q_sorted, 1.0)
 
-    return q_values
+    q = np.empty(m)
+    q[order] = q_sorted
+    return q
 
 
 ################################################################################
@@ -79,36 +164,118 @@ def FDR(p_values, omega, pi_0, cond_pos=False):
 
     return pi_0*omega/(Pr_rej*Pr_rpos)
 
-  
+
+################################################################################
+# pi0_lambdas
+#
+# Estimate pi_0 for each lambda in the array lambdas from the sorted p-values.
+################################################################################
+def pi0_lambdas(p_sorted, lambdas):
+    m = float(len(p_sorted))
+    W_lambd = m - np.searchsorted(p_sorted, lambdas, side='right')
+    return W_lambd / ((1.0-lambdas)*m)
+
+
+################################################################################
+# pi0_estimate
+#
+# Estimate the proportion of null p-values pi_0 from the sorted p-values,
+# choosing lambda by one of these methods:
+#  fixed:     lambda=0.5, which Storey used in the paper experiments.
+#  bootstrap: the lambda on a grid minimizing the bootstrap MSE of pi_0
+#             (Storey, Taylor & Siegmund 2004).
+#  smoother:  a cubic smoother of pi_0 over the lambda grid, evaluated at the
+#             largest lambda (Storey & Tibshirani 2003).
+################################################################################
+def pi0_estimate(p_sorted, pi0_method='fixed', lambdas=None, num_boot=100, seed=1):
+    if pi0_method == 'fixed':
+        return min(1.0, pi0_lambdas(p_sorted, np.array([0.5]))[0])
+
+    if lambdas is None:
+        lambdas = np.arange(0, 0.95, 0.05)
+    pi0s = pi0_lambdas(p_sorted, lambdas)
+
+    if pi0_method == 'smoother':
+        coefs = np.polyfit(lambdas, pi0s, 3)
+        pi0 = np.polyval(coefs, lambdas[-1])
+        pi0 = min(pi0, pi0s.max())
+
+    elif pi0_method == 'bootstrap':
+        m = len(p_sorted)
+
+        # bin the p-values by the lambdas they exceed so that each bootstrap
+        # sample can be counted without sorting
+        p_bins = np.searchsorted(lambdas, p_sorted, side='left')
+
+        rng = np.random.RandomState(seed)
+        pi0_min = pi0s.min()
+        mse = np.zeros(len(lambdas))
+        for b in range(num_boot):
+            bin_counts = np.bincount(p_bins[rng.randint(0, m, m)], minlength=len(lambdas)+1)
+            W_lambd = np.cumsum(bin_counts[::-1])[::-1][1:]
+            pi0s_boot = W_lambd / ((1.0-lambdas)*m)
+            mse += (pi0s_boot - pi0_min)**2
+
+        pi0 = pi0s[np.argmin(mse)]
+
+    else:
+        raise ValueError('Unrecognized pi_0 method %s' % pi0_method)
+
+    return max(min(1.0, pi0), 1.0/len(p_sorted))
+
+
 ################################################################################
 # storey
 #
 # Convert the given p-values to q-values using Storey's FDR.
 #
-# More sophisticated things can be done to choose lambda, but I'm just using
-# 0.5 which Storey did too in the paper experiments.
+# More sophisticated things can be done to choose lambda, but by default I'm
+# just using 0.5 which Storey did too in the paper experiments. See
+# pi0_estimate for the alternatives.
 #
 # Note that to use this we need to have a fair sample of tests that we expect
 # to fit the null distribution.
 ################################################################################
-def storey(p_values, use_pFDR=False):
-    lambd = 0.5
+def storey(p_values, use_pFDR=False, pi0_method='fixed'):
+    return storey_array(p_values, use_pFDR, pi0_method).tolist()
+
+
+################################################################################
+# storey_array
+#
+# Storey q-values for an array of p-values as a numpy array, computing the
+# FDR at every p-value from a single sort and taking the cumulative minimum
+# from the largest p-value down.
+################################################################################
+def storey_array(p_values, use_pFDR=False, pi0_method='fixed'):
+    p = np.asarray(p_values, dtype='float64')
+    m = len(p)
+    if m == 0:
+        return np.zeros(0)
+
+    order = np.argsort(p, kind='mergesort')
+    if m < 2**31:
+        order = order.astype('int32')
+    q_sorted = p[order]
 
-    m = float(len(p_values))
-    W_lambd = float(len([p for p in p_values if p > lambd]))
-    pi_0 = min(1.0, W_lambd/((1.0-lambd)*m))
+    pi_0 = pi0_estimate(q_sorted, pi0_method)
 
-    q_exact = [FDR(p_values, p, pi_0, cond_pos=use_pFDR) for p in p_values]
-    
-    p_i = sorted([(p_values[i],i) for i in range(len(p_values))], reverse=True)
+    # FDR at omega = each p-value, computed in place over the sorted p-values
+    R_omega = np.searchsorted(q_sorted, q_sorted, side='right')
+    if use_pFDR:
+        Pr_rpos = 1.0 - np.power(1.0-q_sorted, m)
+        Pr_rpos[Pr_rpos == 0] = 1e-20
+        q_sorted /= Pr_rpos
+        del Pr_rpos
+    q_sorted *= pi_0*m
+    q_sorted /= R_omega
+    del R_omega
 
-    q_values = [0]*len(p_values)
-    q_values[p_i[0][1]] = q_exact[p_i[0][1]]
-    for j in range(1,len(p_i)):
-        i = p_i[j][1]
-        q_values[i] = min(q_exact[i], q_values[p_i[j-1][1]])
+    q_sorted = np.minimum.accumulate(q_sorted[::-1])[::-1]
 
-    return q_values
+    q = np.empty(m)
+    q[order] = q_sorted
+    return q
 
 
 ################################################################################
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+from optparse import OptionParser
+import time
+import numpy as np
+import fdr
+
+################################################################################
+# fdr_bench.py
+#
+# Benchmark the q-value computations in fdr.py on simulated p-values drawn
+# from a mixture of uniform nulls and beta-distributed alternatives, checking
+# the sorted Storey q-values against the original loop over fdr.FDR on a
+# small sample.
+################################################################################
+
+
+################################################################################
+# main
+################################################################################
+def main():
+    usage = 'usage: %prog [options]'
+    parser = OptionParser(usage)
+    parser.add_option('-n', dest='num_p', type='int', default=1000000, help='Number of p-values [Default: %default]')
+    parser.add_option('-p', dest='pi0', type='float', default=0.8, help='Proportion of null p-values [Default: %default]')
+    parser.add_option('-s', dest='num_check', type='int', default=2000, help='Number of p-values to check against the loop implementation [Default: %default]')
+    (options,args) = parser.parse_args()
+
+    rng = np.random.RandomState(1)
+    num_null = int(options.pi0*options.num_p)
+    p_values = np.concatenate([rng.uniform(size=num_null), rng.beta(0.2, 5, size=options.num_p-num_null)])
+    rng.shuffle(p_values)
+
+    # check against the loop
+    p_check = p_values[:options.num_check].tolist()
+    t0 = time.time()
+    q_loop = storey_loop(p_check)
+    loop_time = time.time() - t0
+    if not np.allclose(q_loop, fdr.storey(p_check)):
+        print 'Mismatch between loop and sorted q-values'
+        exit(1)
+    print '%-20s %10d p-values %10.2f s' % ('storey loop', options.num_check, loop_time)
+
+    for pi0_method in ['fixed', 'bootstrap', 'smoother']:
+        t0 = time.time()
+        q_values = fdr.storey_array(p_values, pi0_method=pi0_method)
+        print '%-20s %10d p-values %10.2f s %10d q<0.05' % ('storey %s' % pi0_method, options.num_p, time.time()-t0, (q_values < 0.05).sum())
+
+    t0 = time.time()
+    q_values = fdr.ben_hoch_array(p_values)
+    print '%-20s %10d p-values %10.2f s %10d q<0.05' % ('ben_hoch', options.num_p, time.time()-t0, (q_values < 0.05).sum())
+
+
+################################################################################
+# storey_loop
+#
+# The original Storey q-values, calling fdr.FDR once per p-value.
+################################################################################
+def storey_loop(p_values):
+    lambd = 0.5
+
+    m = float(len(p_values))
+    W_lambd = float(len([p for p in p_values if p > lambd]))
+    pi_0 = min(1.0, W_lambd/((1.0-lambd)*m))
+
+    q_exact = [fdr.FDR(p_values, p, pi_0) for p in p_values]
+
+    p_i = sorted([(p_values[i],i) for i in range(len(p_values))], reverse=True)
+
+    q_values = [0]*len(p_values)
+    q_values[p_i[0][1]] = q_exact[p_i[0][1]]
+    for j in range(1,len(p_i)):
+        i = p_i[j][1]
+        q_values[i] = min(q_exact[i], q_values[p_i[j-1][1]])
+
+    return q_values
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+    main()
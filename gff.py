@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from optparse import OptionParser
-import os, sys
+import array, hashlib, marshal, os, sys
+import disk_cache
 
 ################################################################################
 # gff
@@ -8,15 +9,23 @@ import os, sys
 # Methods for working with Gene Feature Format files.
 ################################################################################
 
+# compiled annotation stores for read_genes
+store_dir = os.environ.get('GFF_STORE', '%s/.gff_store' % os.environ.get('HOME','.'))
+store_version = 1
+
+# shared lazy attribute views for gtf_kv
+kv_views = {}
+kv_views_max = 500000
+
 
 ################################################################################
 # main
 ################################################################################
 def main():
-    usage = 'usage: %prog [options] <cmd> <gff file>'
+    usage = 'usage: %prog [options] <cmd[,cmd,...]> <gff file>'
     parser = OptionParser(usage)
     parser.add_option('-d', dest='downstream', type='int', default=200, help='Downstream bp for promoters [Default: %default]')
-    parser.add_option('-o', dest='out_file')
+    parser.add_option('-o', dest='out_file', help='Output file, or output prefix for multiple commands [Default: %default]')
     parser.add_option('-u', dest='upstream', type='int', default=2000, help='Upstream bp for promoters [Default: %default]')
     (options,args) = parser.parse_args()
 
@@ -26,7 +35,16 @@ def main():
         cmd = args[0]
         gff_file = args[1]
 
-    if cmd.lower() in ['utr','utrs']:
+    # a comma-separated list of commands shares a single parse
+    cmds = cmd.split(',')
+    if len(cmds) > 1:
+        params = {'promoters':{'promoter_up':options.upstream, 'promoter_down':options.downstream}}
+        try:
+            derive(gff_file, cmds, output_pre=options.out_file, params=params)
+        except ValueError, e:
+            parser.error(str(e))
+
+    elif cmd.lower() in ['utr','utrs']:
         utrs(gff_file, options.out_file)
     elif cmd.lower() in ['ss','splice']:
         splice_sites(gff_file, output_file=options.out_file)
@@ -36,6 +54,47 @@ def main():
         promoters(gff_file, options.upstream, options.downstream, output_file=options.out_file)
     elif cmd.lower() in ['span','spans']:
         span_gene(gff_file, output_file=options.out_file)
+    elif cmd.lower() in ['3p','three_prime']:
+        three_prime(gff_file, output_file=options.out_file)
+    elif cmd.lower() in ['ext','extend']:
+        extend(gff_file, output_file=options.out_file)
+
+
+################################################################################
+# derive
+#
+# Parse a gtf file once and write each of the requested derived products
+# (see derive_products) to its own output file, named by output_pre and the
+# product's suffix. Product parameters are given in a dict of keyword
+# argument dicts keyed by product.
+################################################################################
+def derive(gtf_file, products, output_pre=None, params={}):
+    if not output_pre:
+        output_pre = os.path.splitext(gtf_file)[0]
+
+    products = [derive_product(p) for p in products]
+
+    genes = read_genes(gtf_file)
+    source = gtf_source(gtf_file)
+
+    for product in products:
+        write_product, suffix = derive_products[product]
+        out = open('%s_%s' % (output_pre, suffix), 'w')
+        write_product(genes, source, out, **params.get(product,{}))
+        out.close()
+
+
+################################################################################
+# derive_product
+#
+# Return the canonical name of a derived product, accepting aliases.
+################################################################################
+def derive_product(name):
+    name = name.lower()
+    for product in derive_products:
+        if name == product or name in derive_aliases.get(product,[]):
+            return product
+    raise ValueError('Unrecognized gtf product %s' % name)
 
 
 ################################################################################
@@ -48,10 +107,16 @@ def extend(gtf_file, extend_5p=2000, extend_3p=2000, output_file=None):
         gtf_base = os.path.splitext(gtf_file)[0]
         output_file = '%s_ext.gtf' % gtf_base
     out = open(output_file, 'w')
+    write_extend(read_genes(gtf_file), gtf_source(gtf_file), out, extend_5p, extend_3p)
+    out.close()
 
-    genes = read_genes(gtf_file)
-    source = open(gtf_file).readline().split()[1]
 
+################################################################################
+# write_extend
+#
+# Write the extended genes parsed from a gtf file to the open file out.
+################################################################################
+def write_extend(genes, source, out, extend_5p=2000, extend_3p=2000):
     for gid in genes:
         g = genes[gid]
 
@@ -87,7 +152,6 @@ def extend(gtf_file, extend_5p=2000, extend_3p=2000, output_file=None):
                 cols = [g.chrom, source, '5p', str(g.exons[-1].end+1), str(g.exons[-1].end+extend_5p), '.', g.strand, '.', kv_gtf(g.kv)]
                 print >> out, '\t'.join(cols)
 
-    out.close()
 
 ################################################################################
 # g2t
@@ -131,30 +195,65 @@ def gtf_gene_set(gtf_file, gtf_key='gene_id'):
 # gtf_kv
 #
 # Convert the last gtf section of key/value pairs into a dict.
-################################################################################
-def gtf_kv(s):
+#
+# With lazy=True, return a LazyKV view that parses only the keys requested.
+# Views are shared between identical strings, which are common in e.g. the
+# RepeatMasker gff, so each distinct string is parsed once.
+################################################################################
+def gtf_kv(s, lazy=False):
+    if lazy:
+        kv = kv_views.get(s)
+        if kv is None:
+            if len(kv_views) >= kv_views_max:
+                kv_views.clear()
+            kv = kv_views[s] = LazyKV(s)
+        return kv
+
     d = {}
 
     a = s.split(';')
     for key_val in a:
         if key_val.strip():
-            eq_i = key_val.find('=')
-            if eq_i != -1 and key_val[eq_i-1] != '"':
-                kvs = key_val.split('=')
-            else:
-                kvs = key_val.split()
-
-            key = kvs[0]
-            if kvs[1][0] == '"' and kvs[-1][-1] == '"':
-                val = (' '.join(kvs[1:]))[1:-1].strip()
-            else:
-                val = (' '.join(kvs[1:])).strip()
-
+            key, val = gtf_kv_field(key_val)
             d[key] = val
 
     return d
 
 
+################################################################################
+# gtf_kv_field
+#
+# Convert a single key/value field of the last gtf section, in either GTF
+# (key "val") or GFF3 (key=val) syntax, into a (key, val) tuple.
+################################################################################
+def gtf_kv_field(key_val):
+    eq_i = key_val.find('=')
+    if eq_i != -1 and key_val[eq_i-1] != '"':
+        kvs = key_val.split('=')
+    else:
+        kvs = key_val.split()
+
+    key = kvs[0]
+    if kvs[1][0] == '"' and kvs[-1][-1] == '"':
+        val = (' '.join(kvs[1:]))[1:-1].strip()
+    else:
+        val = (' '.join(kvs[1:])).strip()
+
+    return key, val
+
+
+################################################################################
+# gtf_source
+#
+# Return the source column of the first line of a gtf file.
+################################################################################
+def gtf_source(gtf_file):
+    gtf_in = open(gtf_file)
+    source = gtf_in.readline().split()[1]
+    gtf_in.close()
+    return source
+
+
 ################################################################################
 # introns
 #
@@ -165,10 +264,16 @@ def introns(gtf_file, output_file=None):
         gtf_base = os.path.splitext(gtf_file)[0]
         output_file = '%s_introns.gtf' % gtf_base
     out = open(output_file, 'w')
+    write_introns(read_genes(gtf_file), gtf_source(gtf_file), out)
+    out.close()
 
-    genes = read_genes(gtf_file)
-    source = open(gtf_file).readline().split()[1]
 
+################################################################################
+# write_introns
+#
+# Write the introns of the genes parsed from a gtf file to the open file out.
+################################################################################
+def write_introns(genes, source, out):
     for gid in genes:
         g = genes[gid]
 
@@ -180,8 +285,6 @@ def introns(gtf_file, output_file=None):
                 cols = [g.chrom, source, 'intron', str(istart), str(iend), '.', g.strand, '.', kv_gtf(g.kv)]
                 print >> out, '\t'.join(cols)
 
-    out.close()
-
 
 ################################################################################
 # kv_gtf
@@ -214,10 +317,17 @@ def promoters(gtf_file, promoter_up=2000, promoter_down=0, output_file=None, gue
         gtf_base = os.path.splitext(gtf_file)[0]
         output_file = '%s_prom.gtf' % gtf_base
     out = open(output_file, 'w')
+    write_promoters(read_genes(gtf_file), gtf_source(gtf_file), out, promoter_up, promoter_down, guess_strand)
+    out.close()
 
-    transcripts = read_genes(gtf_file)
-    source = open(gtf_file).readline().split()[1]
 
+################################################################################
+# write_promoters
+#
+# Write the promoters of the transcripts parsed from a gtf file to the open
+# file out.
+################################################################################
+def write_promoters(transcripts, source, out, promoter_up=2000, promoter_down=0, guess_strand=False):
     for tid in transcripts:
         tx = transcripts[tid]
 
@@ -244,8 +354,6 @@ def promoters(gtf_file, promoter_up=2000, promoter_down=0, output_file=None, gue
         if cols:
             print >> out, '\t'.join(cols)
 
-    out.close()
-
 
 ################################################################################
 # span_gene
@@ -261,6 +369,19 @@ def span_gene(gtf_file, extend=0, output_file=None):
     # get isoforms
     transcripts = read_genes(gtf_file, key_id='transcript_id', sort=True)
 
+    # print
+    out = open(output_file, 'w')
+    write_span_gene(transcripts, gtf_source(gtf_file), out, extend)
+    out.close()
+
+
+################################################################################
+# write_span_gene
+#
+# Write a single entry per gene covering the entire span of the transcripts
+# parsed from a gtf file to the open file out.
+################################################################################
+def write_span_gene(transcripts, source, out, extend=0):
     # store gene info
     gene_regions = {}
     for tid in transcripts:
@@ -273,8 +394,6 @@ def span_gene(gtf_file, extend=0, output_file=None):
             gene_regions[gid][2] = max(gene_regions[gid][2], tx.exons[-1].end)
 
     # print
-    source = open(gtf_file).readline().split()[1]
-    out = open(output_file, 'w')
     for gid in gene_regions:
         g = gene_regions[gid]
 
@@ -283,7 +402,6 @@ def span_gene(gtf_file, extend=0, output_file=None):
 
         cols = [g[0], source, 'span', str(start), str(end), '.', g[3], '.', kv_gtf({'gene_id':gid})]
         print >> out, '\t'.join(cols)
-    out.close()
 
 
 ################################################################################
@@ -320,10 +438,17 @@ def splice_sites(gtf_file, exon=0, intron=2, output_file=None):
         gtf_base = os.path.splitext(gtf_file)[0]
         output_file = '%s_splice.gff' % gtf_base
     out = open(output_file, 'w')
+    write_splice_sites(read_genes(gtf_file), gtf_source(gtf_file), out, exon, intron)
+    out.close()
 
-    genes = read_genes(gtf_file)
-    source = open(gtf_file).readline().split()[1]
 
+################################################################################
+# write_splice_sites
+#
+# Write the splice sites of the genes parsed from a gtf file to the open file
+# out.
+################################################################################
+def write_splice_sites(genes, source, out, exon=0, intron=2):
     for gid in genes:
         g = genes[gid]
 
@@ -345,18 +470,16 @@ def splice_sites(gtf_file, exon=0, intron=2, output_file=None):
                cols = [g.chrom, source, 'acceptor', str(g.exons[i].end-exon+1), str(g.exons[i].end+intron), '.', g.strand, '.', kv_gtf(g.kv)]
                print >> out, '\t'.join(cols)
 
-    out.close()
-
 
 ################################################################################
-# read_genes
+# parse_genes
 #
 # Parse a gtf file and return a set of Gene objects in a hash keyed by the
 # id given.
 #
 # Note: assumes exons only.
 ################################################################################
-def read_genes(gtf_file, key_id='transcript_id', sort=True):
+def parse_genes(gtf_file, key_id='transcript_id', sort=True):
     genes = {}
 
     gtf_in = open(gtf_file)
@@ -382,9 +505,151 @@ def read_genes(gtf_file, key_id='transcript_id', sort=True):
 
     gtf_in.close()
 
+    for gid in genes:
+        genes[gid].finalize()
+
     return genes
 
 
+################################################################################
+# read_genes
+#
+# Return the genes of a gtf file as parsed by parse_genes.
+#
+# If store=True, load them from a compiled annotation store (see read_store)
+# if one is current, and otherwise write one after parsing.
+################################################################################
+def read_genes(gtf_file, key_id='transcript_id', sort=True, store=True):
+    def read(st_file):
+        return read_store(gtf_file, st_file)
+    def parse():
+        return parse_genes(gtf_file, key_id, sort)
+    def write(genes, st_file):
+        write_store(gtf_file, genes, st_file)
+
+    if store:
+        return disk_cache.load_or_build(store_file(gtf_file, key_id, sort), gtf_file, read, parse, write, 'annotation store')
+    else:
+        return parse()
+
+
+################################################################################
+# read_store
+#
+# Load the genes of a gtf file from the compiled annotation store st_file,
+# returning None if it is out of date with respect to the gtf file's
+# modification time and size.
+################################################################################
+def read_store(gtf_file, st_file):
+    gtf_stat = os.stat(gtf_file)
+    st_in = open(st_file, 'rb')
+    st = marshal.load(st_in)
+    st_in.close()
+
+    if st.get('version') != store_version or st.get('mtime') != gtf_stat.st_mtime or st.get('size') != gtf_stat.st_size:
+        return None
+
+    strings = st['strings']
+
+    cols = {}
+    for col in ['tx_id', 'tx_chrom', 'tx_strand', 'kv_off', 'kv', 'ex_off', 'ex_start', 'ex_end', 'cds_off', 'cds_start', 'cds_end']:
+        cols[col] = array.array('i')
+        cols[col].fromstring(st[col])
+
+    kv_off = cols['kv_off']
+    kv_si = cols['kv']
+    ex_off = cols['ex_off']
+    ex_start = cols['ex_start']
+    ex_end = cols['ex_end']
+    cds_off = cols['cds_off']
+    cds_start = cols['cds_start']
+    cds_end = cols['cds_end']
+
+    genes = {}
+    for t in range(len(cols['tx_id'])):
+        kv = {}
+        for k in range(kv_off[t], kv_off[t+1], 2):
+            kv[strings[kv_si[k]]] = strings[kv_si[k+1]]
+
+        g = Gene(strings[cols['tx_chrom'][t]], strings[cols['tx_strand'][t]], kv)
+        g.exon_starts = ex_start[ex_off[t]:ex_off[t+1]]
+        g.exon_ends = ex_end[ex_off[t]:ex_off[t+1]]
+        g.cds_starts = cds_start[cds_off[t]:cds_off[t+1]]
+        g.cds_ends = cds_end[cds_off[t]:cds_off[t+1]]
+
+        genes[strings[cols['tx_id'][t]]] = g
+
+    return genes
+
+
+################################################################################
+# store_file
+#
+# Return the path of the compiled annotation store for the given gtf file and
+# read_genes options.
+################################################################################
+def store_file(gtf_file, key_id='transcript_id', sort=True):
+    store_key = '%s:%s:%d' % (os.path.abspath(gtf_file), key_id, sort)
+    return '%s/%s.gst' % (store_dir, hashlib.md5(store_key).hexdigest())
+
+
+################################################################################
+# write_store
+#
+# Compile the genes parsed from a gtf file into a store of columnar integer
+# arrays, with chromosomes, strands, ids and attributes interned in a single
+# string table, and save them to st_file.
+################################################################################
+def write_store(gtf_file, genes, st_file):
+    strings = []
+    string_i = {}
+    def si(s):
+        if s not in string_i:
+            string_i[s] = len(strings)
+            strings.append(s)
+        return string_i[s]
+
+    cols = {}
+    for col in ['tx_id', 'tx_chrom', 'tx_strand', 'kv_off', 'kv', 'ex_off', 'ex_start', 'ex_end', 'cds_off', 'cds_start', 'cds_end']:
+        cols[col] = array.array('i')
+    cols['kv_off'].append(0)
+    cols['ex_off'].append(0)
+    cols['cds_off'].append(0)
+
+    for gid in genes:
+        g = genes[gid]
+        cols['tx_id'].append(si(gid))
+        cols['tx_chrom'].append(si(g.chrom))
+        cols['tx_strand'].append(si(g.strand))
+
+        for key in g.kv:
+            cols['kv'].append(si(key))
+            cols['kv'].append(si(g.kv[key]))
+        cols['kv_off'].append(len(cols['kv']))
+
+        g.finalize()
+
+        cols['ex_start'].extend(g.exon_starts)
+        cols['ex_end'].extend(g.exon_ends)
+        cols['ex_off'].append(len(cols['ex_start']))
+
+        cols['cds_start'].extend(g.cds_starts)
+        cols['cds_end'].extend(g.cds_ends)
+        cols['cds_off'].append(len(cols['cds_start']))
+
+    gtf_stat = os.stat(gtf_file)
+    st = {'version':store_version, 'mtime':gtf_stat.st_mtime, 'size':gtf_stat.st_size, 'strings':strings}
+    for col in cols:
+        st[col] = cols[col].tostring()
+
+    def write_st(tmp_file):
+        st_out = open(tmp_file, 'wb')
+        marshal.dump(st, st_out, 2)
+        st_out.close()
+
+    disk_cache.write_aside(st_file, write_st)
+
+
 ################################################################################
 # three_prime
 #
@@ -395,10 +660,17 @@ def three_prime(gtf_file, upstream=0, downstream=2000, output_file=None):
         gtf_base = os.path.splitext(gtf_file)[0]
         output_file = '%s_3p.gtf' % gtf_base
     out = open(output_file, 'w')
+    write_three_prime(read_genes(gtf_file), gtf_source(gtf_file), out, upstream, downstream)
+    out.close()
 
-    genes = read_genes(gtf_file)
-    source = open(gtf_file).readline().split()[1]
 
+################################################################################
+# write_three_prime
+#
+# Write the sections surrounding the 3' ends of the genes parsed from a gtf
+# file to the open file out.
+################################################################################
+def write_three_prime(genes, source, out, upstream=0, downstream=2000):
     for gid in genes:
         g = genes[gid]
 
@@ -412,8 +684,6 @@ def three_prime(gtf_file, upstream=0, downstream=2000, output_file=None):
         if cols:
             print >> out, '\t'.join(cols)
 
-    out.close()
-
 
 ################################################################################
 # t2g
@@ -439,10 +709,16 @@ def utrs(gtf_file, output_file=None):
         gtf_base = os.path.splitext(gtf_file)[0]
         output_file = '%s_utrs.gtf' % gtf_base
     out = open(output_file, 'w')
+    write_utrs(read_genes(gtf_file), gtf_source(gtf_file), out)
+    out.close()
 
-    genes = read_genes(gtf_file)
-    source = open(gtf_file).readline().split()[1]
 
+################################################################################
+# write_utrs
+#
+# Write the UTRs of the genes parsed from a gtf file to the open file out.
+################################################################################
+def write_utrs(genes, source, out):
     for gid in genes:
         g = genes[gid]
         if len(g.cds) > 0:
@@ -477,56 +753,219 @@ def utrs(gtf_file, output_file=None):
 
                     c = min(c+1,len(g.cds)-1)
 
-    out.close()
+
+################################################################################
+# LazyKV
+#
+# Read-only view of the last gtf section of key/value pairs that finds and
+# converts only the fields for the keys requested, giving the same values as
+# gtf_kv. Values are interned, so repeated names share one string.
+################################################################################
+class LazyKV:
+    def __init__(self, s):
+        self.s = s
+        self.d = {}
+
+    def find(self, key):
+        s = self.s
+        klen = len(key)
+
+        # the last field with the key wins, as in gtf_kv
+        i = s.rfind(key)
+        while i != -1:
+            fs = s.rfind(';', 0, i) + 1
+            if fs == i or not s[fs:i].strip():
+                fe = s.find(';', i)
+                if fe == -1:
+                    fe = len(s)
+                j = i + klen
+                eq_i = s.find('=', fs, fe)
+
+                if eq_i == -1 and s[j:j+1] in ' \t':
+                    # GTF key "val" with a single token value
+                    val = s[j:fe].strip()
+                    if val and ' ' not in val and '\t' not in val:
+                        if val[0] == '"' and val[-1] == '"':
+                            val = val[1:-1].strip()
+                        return intern(val)
+
+                elif eq_i == j and fs == i and s.find('=', j+1, fe) == -1:
+                    # GFF3 key=val
+                    val = s[j+1:fe]
+                    if val:
+                        if val[0] == '"' and val[-1] == '"':
+                            val = val[1:-1]
+                        return intern(val.strip())
+
+                # anything else gets the general treatment
+                fkey, fval = gtf_kv_field(s[fs:fe])
+                if fkey == key:
+                    return intern(fval)
+
+            i = s.rfind(key, 0, i+klen-1)
+
+        return None
+
+    def get(self, key, default=None):
+        try:
+            val = self.d[key]
+        except KeyError:
+            val = self.d[key] = self.find(key)
+        if val is None:
+            return default
+        return val
+
+    def keys(self):
+        return gtf_kv(self.s).keys()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        try:
+            val = self.d[key]
+        except KeyError:
+            val = self.d[key] = self.find(key)
+        if val is None:
+            raise KeyError(key)
+        return val
+
+    def __str__(self):
+        return self.s.strip()
 
 
 ################################################################################
 # Gene
+#
+# Transcript model holding exon and CDS coordinates in typed arrays. Exons
+# added out of order are sorted once, by finalize or the first access to
+# exons/cds.
 ################################################################################
-class Gene:
+class Gene(object):
+    __slots__ = ('chrom', 'strand', 'kv', 'exon_starts', 'exon_ends', 'exons_unsorted', 'cds_starts', 'cds_ends', 'cds_unsorted')
+
     def __init__(self, chrom, strand, kv):
         self.chrom = chrom
         self.strand = strand
         self.kv = kv
-        self.exons = []
-        self.cds = []
+        self.exon_starts = array.array('i')
+        self.exon_ends = array.array('i')
+        self.exons_unsorted = False
+        self.cds_starts = array.array('i')
+        self.cds_ends = array.array('i')
+        self.cds_unsorted = False
 
     def add_cds(self, start, end, sort=True):
-        self.cds.append(Exon(start,end))
-        if sort and len(self.cds) > 1 and self.cds[-2].end > start:
-            #print >> sys.stderr, 'CDS are not sorted - %s %d %d' % (self.chrom,self.start,self.end)
-            self.cds.sort()
+        if sort and self.cds_ends and self.cds_ends[-1] > start:
+            self.cds_unsorted = True
+        self.cds_starts.append(start)
+        self.cds_ends.append(end)
 
     def add_exon(self, start, end, sort=True):
-        self.exons.append(Exon(start,end))
-        if sort and len(self.exons) > 1 and self.exons[-2].end > start:
-            #print >> sys.stderr, 'Warning: exons are not sorted - %s' % kv_gtf(self.kv)
-            self.exons.sort()
+        if sort and self.exon_ends and self.exon_ends[-1] > start:
+            self.exons_unsorted = True
+        self.exon_starts.append(start)
+        self.exon_ends.append(end)
+
+    def finalize(self):
+        if self.exons_unsorted:
+            self.exon_starts, self.exon_ends = sort_intervals(self.exon_starts, self.exon_ends)
+            self.exons_unsorted = False
+        if self.cds_unsorted:
+            self.cds_starts, self.cds_ends = sort_intervals(self.cds_starts, self.cds_ends)
+            self.cds_unsorted = False
+
+    @property
+    def cds(self):
+        if self.cds_unsorted:
+            self.finalize()
+        return Exons(self.cds_starts, self.cds_ends)
+
+    @property
+    def exons(self):
+        if self.exons_unsorted:
+            self.finalize()
+        return Exons(self.exon_starts, self.exon_ends)
 
     def __str__(self):
         return '%s %s %s %s' % (self.chrom, self.strand, kv_gtf(self.kv), ','.join([ex.__str__() for ex in self.exons]))
 
 
+################################################################################
+# sort_intervals
+#
+# Stable sort the parallel start/end arrays by start.
+################################################################################
+def sort_intervals(starts, ends):
+    order = sorted(range(len(starts)), key=starts.__getitem__)
+    sorted_starts = array.array(starts.typecode, [starts[i] for i in order])
+    sorted_ends = array.array(ends.typecode, [ends[i] for i in order])
+    return sorted_starts, sorted_ends
+
+
+################################################################################
+# Exons
+#
+# Read-only sequence of Exon records over parallel start/end arrays.
+################################################################################
+class Exons(object):
+    __slots__ = ('starts', 'ends')
+
+    def __init__(self, starts, ends):
+        self.starts = starts
+        self.ends = ends
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [Exon(self.starts[j],self.ends[j]) for j in range(*i.indices(len(self.starts)))]
+        else:
+            return Exon(self.starts[i], self.ends[i])
+
+    def __iter__(self):
+        for i in range(len(self.starts)):
+            yield Exon(self.starts[i], self.ends[i])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __str__(self):
+        return ','.join([ex.__str__() for ex in self])
+
+
 ################################################################################
 # Exon
 ################################################################################
-class Exon:
+class Exon(object):
+    __slots__ = ('start', 'end')
+
     def __init__(self, start, end):
         self.start = start
         self.end = end
 
-    def __cmp__(self, x):
-        if self.start < x.start:
-            return -1
-        elif self.start > x.start:
-            return 1
-        else:
-            return 0
+    def __lt__(self, x):
+        return self.start < x.start
 
     def __str__(self):
         return 'exon(%d-%d)' % (self.start,self.end)
         
 
+################################################################################
+# derive_products
+#
+# Writer and output file suffix for each product derive can make, along with
+# the aliases accepted for each.
+################################################################################
+derive_products = {'extend':(write_extend,'ext.gtf'),
+                   'introns':(write_introns,'introns.gtf'),
+                   'promoters':(write_promoters,'prom.gtf'),
+                   'span':(write_span_gene,'span.gtf'),
+                   'ss':(write_splice_sites,'splice.gff'),
+                   '3p':(write_three_prime,'3p.gtf'),
+                   'utrs':(write_utrs,'utrs.gtf')}
+
+derive_aliases = {'extend':['ext'], 'introns':['intron'], 'promoters':['promoter'], 'span':['spans'], 'ss':['splice'], '3p':['three_prime'], 'utrs':['utr']}
+
+
 ################################################################################
 # __main__
 ################################################################################
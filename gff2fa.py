@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 from optparse import OptionParser
-import gzip, os, pdb, sys
+import glob, gzip, multiprocessing, os, pdb, sys
 import dna, gff
 
 ################################################################################
@@ -8,6 +8,10 @@ import dna, gff
 #
 # Given a gff file and fasta file or chromosome fasta file directory, produce
 # a fasta file of the gff entries.
+#
+# The gff file is read once and its features hashed by chromosome. Sequence is
+# fetched through the fasta index for uncompressed fasta files, optionally
+# processing chromosomes in parallel, and streamed for gzipped ones.
 ################################################################################
 
 
@@ -22,6 +26,7 @@ def main():
     parser.add_option('-g', dest='gene_too', default=False, action='store_true', help='Print transcript id and gene id [Default: %default]')
     #parser.add_option('--gtf', dest='gtf', action='store_true', default=False, help='Input file is gtf and linked entries should be combined into a single sequence [Default: %default]')
     parser.add_option('--head', dest='header_key', default='transcript_id', help='GFF key to be used to merge GFF entries and label the fasta headers [Default: %default]')
+    parser.add_option('-p', dest='processes', type='int', default=1, help='Number of processes to split chromosomes across [Default: %default]')
     parser.add_option('-s', dest='split_lines', default=None, action='store_true', help='Split sequence across multiple lines [Default: %default]')
     parser.add_option('-x', dest='exon', action='store_true', default=False, help='Only include exon rows [Default: %default]')
     (options,args) = parser.parse_args()
@@ -31,12 +36,14 @@ def main():
     else:
         gff_file = args[0]
 
+    # hash features by chromosome
+    chrom_features = read_features(gff_file, options)
+
     if options.fasta_file:
         fasta_files = [options.fasta_file]
     elif options.chr_dir:
-        gff_chrs = set([line.split()[0] for line in open(gff_file)])
         fasta_files = []
-        for chrom in gff_chrs:
+        for chrom in chrom_features:
             fasta_files += glob.glob(options.chr_dir+'/%s*' % chrom)
     else:
         parser.error('Must provide fasta source')
@@ -44,58 +51,119 @@ def main():
     for fasta_file in fasta_files:
         if fasta_file[-3:] == '.gz':
             fasta_open = gzip.open(fasta_file)
+
+            header = ''
+            line = fasta_open.readline()
+            while line:
+                if line[0] == '>':
+                    if header in chrom_features:
+                        print_seqs(features_seqs(''.join(seq_lines), chrom_features[header]), options.split_lines)
+                    header = line[1:].split()[0]
+                    seq_lines = []
+                else:
+                    seq_lines.append(line.rstrip())
+                line = fasta_open.readline()
+            if header in chrom_features:
+                print_seqs(features_seqs(''.join(seq_lines), chrom_features[header]), options.split_lines)
+
         else:
-            fasta_open = open(fasta_file)
-
-        header = ''
-        line = fasta_open.readline()
-        while line:
-            if line[0] == '>':
-                if header:
-                    header_gff(header, seq, gff_file, options)
-                header = line[1:].split()[0]
-                seq = ''
+            fasta = dna.Fasta(fasta_file)
+            chrom_args = [(fasta_file, chrom, chrom_features[chrom]) for chrom in fasta.names if chrom in chrom_features]
+            fasta.close()
+
+            if options.processes > 1:
+                pool = multiprocessing.Pool(options.processes)
+                for header_seqs in pool.imap(fasta_features_seqs, chrom_args):
+                    print_seqs(header_seqs, options.split_lines)
+                pool.close()
+                pool.join()
             else:
-                seq += line.rstrip()
-            line = fasta_open.readline()
-        header_gff(header, seq, gff_file, options)
+                for chrom_arg in chrom_args:
+                    print_seqs(fasta_features_seqs(chrom_arg), options.split_lines)
 
 
 ################################################################################
-# header_gff
+# fasta_features_seqs
 #
-# Print sequence features for the given header and seq from the given gff file
+# Open the indexed fasta file and return the sequences of the features on the
+# given chromosome, taking a single tuple argument for Pool.imap.
+################################################################################
+def fasta_features_seqs((fasta_file, chrom, features)):
+    fasta = dna.Fasta(fasta_file)
+    header_seqs = features_seqs(fasta[chrom], features)
+    fasta.close()
+    return header_seqs
+
+
 ################################################################################
-def header_gff(header, seq, gff_file, options):
+# features_seqs
+#
+# Return a list of (header, sequence) tuples for the features on a chromosome
+# with sequence seq, combining features with the same header in the order of
+# their first appearance.
+################################################################################
+def features_seqs(seq, features):
+    # plus strand features are appended and minus strand prepended
     header_seqs = {}
+    headers = []
+    for head_id, feat_start, feat_end, feat_strand in features:
+        feat_seq = seq[feat_start-1:feat_end]
+
+        if head_id not in header_seqs:
+            headers.append(head_id)
+            header_seqs[head_id] = ([], [])
+
+        if feat_strand == '+':
+            header_seqs[head_id][1].append(feat_seq)
+        else:
+            header_seqs[head_id][0].append(dna.rc(feat_seq))
+
+    seqs = []
+    for head_id in headers:
+        prepend_seqs, append_seqs = header_seqs[head_id]
+        seqs.append((head_id, ''.join(prepend_seqs[::-1]) + ''.join(append_seqs)))
+
+    return seqs
+
+
+################################################################################
+# print_seqs
+#
+# Print a list of (header, sequence) tuples in fasta format.
+################################################################################
+def print_seqs(header_seqs, split_lines=False):
+    for header, seq in header_seqs:
+        print '>%s' % header
+        if split_lines:
+            i = 0
+            while i < len(seq):
+                print seq[i:i+60]
+                i += 60
+        else:
+            print seq
+
+
+################################################################################
+# read_features
+#
+# Hash the gff features by chromosome as lists of (header, start, end, strand)
+# tuples.
+################################################################################
+def read_features(gff_file, options):
+    chrom_features = {}
     for line in open(gff_file):
         a = line.split('\t')
         a[-1] = a[-1].rstrip()
-        if (not options.exon or a[2] == 'exon') and a[0] == header:
+        if not options.exon or a[2] == 'exon':
             kv = gff.gtf_kv(a[8])
             #head_id = kv.get(options.header_key,a[8]+'_'+a[0]+':'+a[3]+'-'+a[4])
             head_id = kv.get(options.header_key,a[8])
             if options.gene_too:
                 head_id += ' gene=%s' % kv.get('gene_id','')
 
-            feat_start = int(a[3])
-            feat_end = int(a[4])
-
-            feat_seq = seq[feat_start-1:feat_end]
-            if a[6] == '+':
-                header_seqs[head_id] = header_seqs.get(head_id,'') + feat_seq
-            else:
-                header_seqs[head_id] = dna.rc(feat_seq) + header_seqs.get(head_id,'')
+            chrom_features.setdefault(a[0],[]).append((head_id, int(a[3]), int(a[4]), a[6]))
 
-    for header in header_seqs:
-        print '>%s' % header
-        if options.split_lines:
-            i = 0
-            while i < len(header_seqs[header]):
-                print header_seqs[header][i:i+60]
-                i += 60
-        else:
-            print header_seqs[header]
+    return chrom_features
 
 
 ################################################################################
@@ -1,46 +1,44 @@
 #!/usr/bin/env python
 from optparse import OptionParser
-import os, subprocess, sys, tempfile
+import os, struct, subprocess, sys, tempfile
+import numpy as np
 
 ################################################################################
 # ggplot.py
 #
 # Make a plot given an R script, dict data frame, and arguments.
+#
+# The data frame is handed to R column by column in a binary file, read by
+# read.df in r/read_df.r, which is run ahead of the plot script. The file
+# holds the numbers of columns and rows as little-endian int32s, each
+# column's name and type as NUL-terminated strings, and then each column in
+# turn: doubles as float64s, integers and logicals as int32s, and anything
+# else as NUL-terminated strings, which R converts as read.table would.
+#
+# Columns may be lists or NumPy arrays; contiguous float64 and int32 arrays
+# are written without copying.
 ################################################################################
 
+# R code defining read.df
+df_reader = '%s/r/read_df.r' % os.path.dirname(os.path.abspath(__file__))
+
 
 ################################################################################
 # plot
 ################################################################################
 def plot(r_script, df_dict, args, df_file=None):
-    # open temp file
+    # write data frame
     if df_file == None:
-        df_fd, df_file = tempfile.mkstemp()
+        df_fd, df_file = print_df(df_dict)
     else:
         df_fd = None
-    df_out = open(df_file, 'w')
-
-    # get headers
-    headers = sorted(df_dict.keys())
-    print >> df_out, ' '.join([str(head) for head in headers])
-
-    # check list lengths
-    length = len(df_dict[headers[0]])
-    for i in range(1,len(headers)):
-        if length != len(df_dict[headers[i]]):
-            print >> sys.stderr, 'Lists in dict vary in length.'
-            exit(1)
-
-    # print data frame
-    for i in range(length):
-        print >> df_out, ' '.join([str(df_dict[head][i]) for head in headers])
-    df_out.close()
+        print_df(df_dict, df_file)
 
     # convert args to one string
     args_str = ' '.join([str(a) for a in args])
 
     # plot in R
-    subprocess.call('R --slave --args %s %s < %s' % (df_file, args_str, r_script), shell=True)
+    subprocess.call('cat %s %s | R --slave --args %s %s' % (df_reader, r_script, df_file, args_str), shell=True)
 
     # clean
     if df_fd != None:
@@ -48,10 +46,40 @@ def plot(r_script, df_dict, args, df_file=None):
         os.remove(df_file)
 
 
+################################################################################
+# df_column
+#
+# Return the R type of the data frame column and an array of it to write, or
+# for strings a single NUL-separated string.
+################################################################################
+def df_column(values):
+    col = np.asarray(values)
+
+    if col.ndim != 1 or col.dtype.kind not in 'fiub':
+        return 'character', ''.join(['%s\0' % str(v) for v in values])
+
+    elif col.dtype.kind == 'f':
+        return 'double', col.astype('<f8', copy=False)
+
+    elif col.dtype.kind == 'b':
+        return 'logical', col.astype('<i4')
+
+    elif col.dtype.itemsize < 4 or col.dtype == np.int32:
+        return 'integer', col.astype('<i4', copy=False)
+
+    elif len(col) == 0 or (col.min() > -2**31 and col.max() < 2**31):
+        # -2^31 is R's NA
+        return 'integer', col.astype('<i4')
+
+    else:
+        return 'double', col.astype('<f8')
+
+
 ################################################################################
 # print_df
 #
-# Just print the given data frame dictionary to the output file given.
+# Write the given data frame dictionary to the output file given, or to a
+# temp file whose descriptor and name are returned.
 ################################################################################
 def print_df(df_dict, out_file=None):
     # open
@@ -59,11 +87,10 @@ def print_df(df_dict, out_file=None):
         df_fd, df_file = tempfile.mkstemp()
     else:
         df_file = out_file
-    df_out = open(df_file, 'w')
+    df_out = open(df_file, 'wb')
 
     # get headers
     headers = sorted(df_dict.keys())
-    print >> df_out, ' '.join([str(head) for head in headers])
 
     # check list lengths
     length = len(df_dict[headers[0]])
@@ -74,9 +101,19 @@ def print_df(df_dict, out_file=None):
                 print >> sys.stderr, headers[j], len(df_dict[headers[j]])
             exit(1)
 
+    columns = [df_column(df_dict[head]) for head in headers]
+
+    # print dimensions, names and types
+    df_out.write(struct.pack('<ii', len(headers), length))
+    for i in range(len(headers)):
+        df_out.write('%s\0%s\0' % (headers[i], columns[i][0]))
+
     # print data frame
-    for i in range(length):
-        print >> df_out, ' '.join([str(df_dict[head][i]) for head in headers])
+    for col_type, col in columns:
+        if col_type == 'character':
+            df_out.write(col)
+        else:
+            np.ascontiguousarray(col).tofile(df_out)
     df_out.close()
 
     if out_file == None:
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+import hashlib, multiprocessing, os
+import numpy as np
+import disk_cache
+
+################################################################################
+# gsea_kernel.py
+#
+# Enrichment scores as defined in Subramanian et al 2005, computed for many
+# gene sets at once over a ranked gene list, shared by gsea.py, cors_gsea.py
+# and cors_gsea_setshuf.py.
+#
+# The running sum only rises at hits, so its maximum is found among the
+# positions just after each hit. Gene sets become rows of a matrix of sorted
+# hit positions in the ranked list, and the running hit and miss sums at
+# those positions are NumPy cumulative sums along the rows, giving the same
+# scores as walking the whole list.
+#
+# Null distributions of random gene sets are drawn from a RandomState seeded
+# by (seed, set size), so they are reproducible regardless of how the set
+# sizes are spread across processes, and cached on disk by the hash of the
+# ranked correlations, set size, number of shuffles and seed.
+################################################################################
+
+null_dir = os.environ.get('GSEA_NULLS', '%s/.gsea_nulls' % os.environ.get('HOME','.'))
+
+
+################################################################################
+# enrichment
+#
+# Compute the enrichment score of a single gene set for a list of
+# (correlation, gene) tuples sorted in decreasing order.
+################################################################################
+def enrichment(correlations_genes, term_genes):
+    return RankedGenes(correlations_genes).enrichments([term_genes])[0]
+
+
+################################################################################
+# hit_enrichments
+#
+# Compute the enrichment score of each row of the matrix of sorted hit
+# positions hit_pos for the ranked correlations cors, where positions equal
+# to len(cors) pad rows for smaller gene sets.
+################################################################################
+def hit_enrichments(cors, hit_pos):
+    n = len(cors)
+    padding = (hit_pos == n)
+    set_sizes = (~padding).sum(axis=1)
+
+    # running hit sum at each hit
+    p_hit = np.cumsum(np.append(cors,0)[hit_pos], axis=1)
+    p_hit /= p_hit[:,-1:]
+
+    # running miss sum at each hit
+    p_miss = (hit_pos - np.arange(hit_pos.shape[1])).astype('float64')
+    p_miss /= (n - set_sizes)[:,np.newaxis]
+
+    scores = p_hit - p_miss
+    scores[padding] = -np.inf
+
+    # the running sum starts at zero before the first gene
+    return np.maximum(scores.max(axis=1), 0)
+
+
+################################################################################
+# null_enrichments
+#
+# Return a dict mapping each of the given set sizes to a numpy array of the
+# enrichment scores of num_shuffles random gene sets of that size, reading
+# cached null distributions where available and generating the rest across
+# the given number of processes.
+################################################################################
+def null_enrichments(ranked_genes, set_sizes, num_shuffles, seed=1, processes=1, cache=True):
+    size_enrichments = {}
+
+    # read cached
+    compute_sizes = []
+    for set_size in set_sizes:
+        enrichments = None
+        if cache:
+            enrichments = read_null(ranked_genes, set_size, num_shuffles, seed)
+        if enrichments is None:
+            compute_sizes.append(set_size)
+        else:
+            size_enrichments[set_size] = enrichments
+
+    # compute the rest
+    null_args = [(ranked_genes.cors, set_size, num_shuffles, seed) for set_size in compute_sizes]
+    if processes > 1 and len(null_args) > 1:
+        pool = multiprocessing.Pool(processes)
+        compute_enrichments = pool.map(random_enrichments, null_args)
+        pool.close()
+        pool.join()
+    else:
+        compute_enrichments = [random_enrichments(null_arg) for null_arg in null_args]
+
+    for i in range(len(compute_sizes)):
+        size_enrichments[compute_sizes[i]] = compute_enrichments[i]
+        if cache:
+            write_null(ranked_genes, compute_sizes[i], num_shuffles, seed, compute_enrichments[i])
+
+    return size_enrichments
+
+
+################################################################################
+# null_file
+#
+# Return the path of the cached null distribution for the given ranked genes
+# and shuffle parameters. Random sets are drawn from positions in the ranked
+# list, so only the correlations determine the null.
+################################################################################
+def null_file(ranked_genes, set_size, num_shuffles, seed):
+    null_key = '%s:%d:%d:%d' % (ranked_genes.cors_hash(), set_size, num_shuffles, seed)
+    return '%s/%s.npy' % (null_dir, hashlib.md5(null_key).hexdigest())
+
+
+################################################################################
+# random_enrichments
+#
+# Compute enrichment scores for num_shuffles random gene sets of the given
+# size from the ranked correlations cors, taking a single tuple argument for
+# Pool.map.
+################################################################################
+def random_enrichments((cors, set_size, num_shuffles, seed)):
+    rng = np.random.RandomState([seed, set_size])
+
+    # sample positions without replacement by Floyd's algorithm, drawing
+    # the i'th position of every shuffle at once
+    n = len(cors)
+    hit_pos = np.empty((num_shuffles, set_size), dtype='int64')
+    for i in range(set_size):
+        j = n - set_size + i
+        pos = rng.randint(0, j+1, size=num_shuffles)
+        pos[(hit_pos[:,:i] == pos[:,np.newaxis]).any(axis=1)] = j
+        hit_pos[:,i] = pos
+    hit_pos.sort(axis=1)
+
+    return hit_enrichments(cors, hit_pos)
+
+
+################################################################################
+# read_null
+#
+# Return the cached null distribution for the given ranked genes and shuffle
+# parameters, or None if it has not been cached.
+################################################################################
+def read_null(ranked_genes, set_size, num_shuffles, seed):
+    def read(nl_file):
+        enrichments = np.load(nl_file)
+        if len(enrichments) != num_shuffles:
+            return None
+        return enrichments
+
+    return disk_cache.load(null_file(ranked_genes, set_size, num_shuffles, seed), None, read, 'null distribution')
+
+
+################################################################################
+# write_null
+#
+# Cache the null distribution for the given ranked genes and shuffle
+# parameters.
+################################################################################
+def write_null(ranked_genes, set_size, num_shuffles, seed, enrichments):
+    def write_npy(tmp_file):
+        # np.save would append .npy to the temporary name
+        nl_out = open(tmp_file, 'wb')
+        np.save(nl_out, enrichments)
+        nl_out.close()
+    def write(enrichments, nl_file):
+        disk_cache.write_aside(nl_file, write_npy)
+
+    disk_cache.save(null_file(ranked_genes, set_size, num_shuffles, seed), enrichments, write, 'null distribution')
+
+
+################################################################################
+# RankedGenes
+#
+# A ranked list of (correlation, gene) tuples sorted in decreasing order, with
+# the gene positions hashed to build hit position matrices.
+################################################################################
+class RankedGenes:
+    def __init__(self, correlations_genes):
+        self.cors = np.array([cor for (cor,gene) in correlations_genes], dtype='float64')
+        self.genes = [gene for (cor,gene) in correlations_genes]
+
+        self.gene_positions = {}
+        for i in range(len(self.genes)):
+            self.gene_positions.setdefault(self.genes[i],[]).append(i)
+
+        self.cors_digest = None
+
+    def __len__(self):
+        return len(self.genes)
+
+    ############################################################################
+    # cors_hash
+    #
+    # Return a hex digest of the ranked correlations.
+    ############################################################################
+    def cors_hash(self):
+        if self.cors_digest is None:
+            self.cors_digest = hashlib.md5(self.cors.tostring()).hexdigest()
+        return self.cors_digest
+
+    ############################################################################
+    # enrichments
+    #
+    # Return a numpy array of the enrichment scores of the given gene sets.
+    # Genes missing from the ranked list are ignored.
+    ############################################################################
+    def enrichments(self, gene_sets):
+        positions = []
+        for gene_set in gene_sets:
+            set_positions = []
+            for gene in gene_set:
+                set_positions += self.gene_positions.get(gene,[])
+            positions.append(set_positions)
+
+        return self.position_enrichments(positions)
+
+    ############################################################################
+    # position_enrichments
+    #
+    # Return a numpy array of the enrichment scores of gene sets given as
+    # sequences of positions in the ranked list, e.g. the rows of a 2D array
+    # of random positions.
+    ############################################################################
+    def position_enrichments(self, positions):
+        n = len(self.cors)
+        num_sets = len(positions)
+        max_size = max([len(set_positions) for set_positions in positions] + [1])
+
+        hit_pos = np.empty((num_sets, max_size), dtype='int64')
+        hit_pos.fill(n)
+        for i in range(num_sets):
+            hit_pos[i,:len(positions[i])] = positions[i]
+        hit_pos.sort(axis=1)
+
+        return hit_enrichments(self.cors, hit_pos)
@@ -107,28 +107,33 @@ def output_promoters(promoters, promoter_length, acgt_t, output_pre):
         out_fa = open('promoters.fa','w')
         out_gff = open('promoters.gff','w')
 
-    if os.path.isfile(hg19_fa):        
-        genome_in = open(hg19_fa)
+    if os.path.isfile(hg19_fa):
+        # fetch promoters through the fasta index
+        genome = dna.Fasta(hg19_fa)
+        for chrom in genome.names:
+            process_chr(chrom, genome[chrom], chr_hash.get(chrom,[]), out_fa, out_gff, promoter_length, acgt_t)
+
     elif os.path.isfile(hg19_fa+'.gz'):
         genome_in = gzip.open(hg19_fa+'.gz')
+
+        chrom = ''
+        line = genome_in.readline()
+        while line:
+            if line[0] == '>':
+                if chrom:
+                    process_chr(chrom, ''.join(chr_lines), chr_hash.get(chrom,[]), out_fa, out_gff, promoter_length, acgt_t)
+
+                chrom = line[1:].rstrip()
+                chr_lines = []
+            else:
+                chr_lines.append(line.rstrip())
+            line = genome_in.readline()
+        process_chr(chrom, ''.join(chr_lines), chr_hash.get(chrom,[]), out_fa, out_gff, promoter_length, acgt_t)
+
     else:
         print >> sys.stderr, 'No genome %s' % hg19_fa
         exit(1)
 
-    chrom = ''
-    line = genome_in.readline()
-    while line:
-        if line[0] == '>':
-            if chrom:
-                process_chr(chrom, chr_seq, chr_hash.get(chrom,[]), out_fa, out_gff, promoter_length, acgt_t)
-
-            chrom = line[1:].rstrip()
-            chr_seq = ''
-        else:
-            chr_seq += line.rstrip()
-        line = genome_in.readline()
-    process_chr(chrom, chr_seq, chr_hash.get(chrom,[]), out_fa, out_gff, promoter_length, acgt_t)
-
     out_fa.close()
     out_gff.close()
 
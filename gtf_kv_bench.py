@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+from optparse import OptionParser
+import sys, time
+import gff
+
+################################################################################
+# gtf_kv_bench.py
+#
+# Benchmark gff.gtf_kv against the lazy attribute view on a gff file, e.g. the
+# RepeatMasker gff, extracting only the given keys and checking that the two
+# agree on every line.
+################################################################################
+
+
+################################################################################
+# main
+################################################################################
+def main():
+    usage = 'usage: %prog [options] <gff file>'
+    parser = OptionParser(usage)
+    parser.add_option('-k', dest='keys', default='repeat,family', help='Comma-separated attribute keys to extract [Default: %default]')
+    parser.add_option('-n', dest='max_lines', type='int', default=None, help='Maximum number of lines to read [Default: %default]')
+    (options,args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error('Must provide gff file')
+    else:
+        gff_file = args[0]
+
+    keys = options.keys.split(',')
+
+    # read attribute strings
+    attrs = []
+    for line in open(gff_file):
+        a = line.split('\t')
+        if len(a) > 8:
+            attrs.append(a[8])
+        if options.max_lines and len(attrs) >= options.max_lines:
+            break
+
+    # full dicts
+    t0 = time.time()
+    full_vals = [[gff.gtf_kv(s).get(key) for key in keys] for s in attrs]
+    full_time = time.time() - t0
+
+    # lazy views
+    t0 = time.time()
+    lazy_vals = [[gff.gtf_kv(s, lazy=True).get(key) for key in keys] for s in attrs]
+    lazy_time = time.time() - t0
+
+    for i in range(len(attrs)):
+        if full_vals[i] != lazy_vals[i]:
+            print >> sys.stderr, 'Mismatch on line %d: %s vs %s' % (i+1, full_vals[i], lazy_vals[i])
+            exit(1)
+
+    print '%-6s %10d lines' % ('lines', len(attrs))
+    print '%-6s %10.2f s' % ('full', full_time)
+    print '%-6s %10.2f s' % ('lazy', lazy_time)
+    print '%-6s %10.2f x' % ('gain', full_time/max(lazy_time,1e-9))
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+    main()
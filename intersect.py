@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+from optparse import OptionParser
+import array, gzip, sys
+import numpy as np
+
+################################################################################
+# intersect.py
+#
+# Intersect interval files in process, as a replacement for piping
+# intersectBed -wo output through a text parser.
+#
+# Intervals are held as 0-based, half-open integer arrays in file order and,
+# per chromosome, sorted by start within tiers of similar length. A query
+# interval can only overlap intervals of a tier whose start lies within the
+# tier's maximum length before the query start, so every query is two binary
+# searches per tier, vectorized over all queries with NumPy. Results are
+# arrays of (a index, b index, overlap bp) in the order of the a file.
+#
+# As a script, the output mirrors intersectBed for gff, gtf and bed files so
+# the two can be diffed.
+################################################################################
+
+# maximum number of queries to expand at once
+chunk_queries = 2**20
+
+strand_codes = {'+':1, '-':-1}
+
+################################################################################
+# main
+################################################################################
+def main():
+    usage = 'usage: %prog [options] <a file> <b file>'
+    parser = OptionParser(usage)
+    parser.add_option('-f', dest='min_frac', type='float', default=None, help='Minimum overlap required as a fraction of A [Default: %default]')
+    parser.add_option('-r', dest='reciprocal', default=False, action='store_true', help='Require the minimum fraction be satisfied for A and B [Default: %default]')
+    parser.add_option('-s', dest='same_strand', default=False, action='store_true', help='Require same strandedness [Default: %default]')
+    parser.add_option('-u', dest='unique', default=False, action='store_true', help='Write the original A entry once if any overlaps are found in B [Default: %default]')
+    parser.add_option('-v', dest='no_overlap', default=False, action='store_true', help='Only report those entries in A that have no overlaps with B [Default: %default]')
+    parser.add_option('--wa', dest='write_a', default=False, action='store_true', help='Write the original entry in A for each overlap [Default: %default]')
+    parser.add_option('--wb', dest='write_b', default=False, action='store_true', help='Write the original entry in B for each overlap [Default: %default]')
+    parser.add_option('--wo', dest='write_overlap', default=False, action='store_true', help='Write the original A and B entries plus the number of base pairs of overlap [Default: %default]')
+    (options,args) = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error('Must provide A and B files')
+    else:
+        a_file = args[0]
+        b_file = args[1]
+
+    a_ivs, a_lines = read_intervals(a_file)
+    b_ivs, b_lines = read_intervals(b_file)
+    a_gff = is_gff(a_file)
+
+    a_idx, b_idx, bp = intersect(a_ivs, b_ivs, options.same_strand)
+
+    # filter by overlap fraction
+    if options.min_frac:
+        keep = bp >= options.min_frac*a_ivs.lengths()[a_idx]
+        if options.reciprocal:
+            keep &= bp >= options.min_frac*b_ivs.lengths()[b_idx]
+        a_idx = a_idx[keep]
+        b_idx = b_idx[keep]
+        bp = bp[keep]
+
+    if options.no_overlap:
+        hit = np.zeros(len(a_ivs), dtype='bool')
+        hit[a_idx] = True
+        for ai in np.nonzero(~hit)[0]:
+            print a_lines[ai]
+
+    elif options.unique:
+        for ai in np.unique(a_idx):
+            print a_lines[ai]
+
+    else:
+        for i in range(len(a_idx)):
+            ai = a_idx[i]
+            bi = b_idx[i]
+
+            if options.write_overlap:
+                print '%s\t%s\t%d' % (a_lines[ai], b_lines[bi], bp[i])
+            elif options.write_a and options.write_b:
+                print '%s\t%s' % (a_lines[ai], b_lines[bi])
+            elif options.write_a:
+                print a_lines[ai]
+            else:
+                # the overlapping portion of A
+                ovl_start = max(a_ivs.starts[ai], b_ivs.starts[bi])
+                ovl_end = min(a_ivs.ends[ai], b_ivs.ends[bi])
+                a = a_lines[ai].split('\t')
+                if a_gff:
+                    a[3] = str(ovl_start+1)
+                    a[4] = str(ovl_end)
+                else:
+                    a[1] = str(ovl_start)
+                    a[2] = str(ovl_end)
+                if options.write_b:
+                    a.append(b_lines[bi])
+                print '\t'.join(a)
+
+
+################################################################################
+# expand_ranges
+#
+# Return the concatenation of the ranges [lo[i], lo[i]+counts[i]) and the
+# query index i of each element.
+################################################################################
+def expand_ranges(lo, counts):
+    total = counts.sum()
+    query_i = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    return lo[query_i] + offsets, query_i
+
+
+################################################################################
+# intersect
+#
+# Return arrays of the indexes of overlapping intervals in a_ivs and b_ivs and
+# their overlap in bp, ordered by a index and then b index.
+################################################################################
+def intersect(a_ivs, b_ivs, same_strand=False):
+    a_ivs.finalize()
+    b_ivs.finalize()
+
+    a_parts = []
+    b_parts = []
+    for chrom in a_ivs.chrom_records:
+        if chrom not in b_ivs.chrom_tiers:
+            continue
+
+        chrom_a = a_ivs.chrom_records[chrom]
+        for ci in range(0, len(chrom_a), chunk_queries):
+            query_a = chrom_a[ci:ci+chunk_queries]
+            query_starts = a_ivs.starts[query_a]
+            query_ends = a_ivs.ends[query_a]
+
+            for max_len, tier_b, tier_starts in b_ivs.chrom_tiers[chrom]:
+                # b starts within max_len before the query start and before
+                # the query end
+                lo = np.searchsorted(tier_starts, query_starts - max_len, 'right')
+                hi = np.searchsorted(tier_starts, query_ends, 'left')
+                counts = np.maximum(hi - lo, 0)
+
+                tier_i, query_i = expand_ranges(lo, counts)
+                hit_a = query_a[query_i]
+                hit_b = tier_b[tier_i]
+
+                keep = b_ivs.ends[hit_b] > a_ivs.starts[hit_a]
+                if same_strand:
+                    keep &= a_ivs.strands[hit_a] == b_ivs.strands[hit_b]
+
+                a_parts.append(hit_a[keep])
+                b_parts.append(hit_b[keep])
+
+    if a_parts:
+        a_idx = np.concatenate(a_parts)
+        b_idx = np.concatenate(b_parts)
+    else:
+        a_idx = np.zeros(0, dtype='int64')
+        b_idx = np.zeros(0, dtype='int64')
+
+    order = np.argsort(a_idx*len(b_ivs) + b_idx)
+    a_idx = a_idx[order]
+    b_idx = b_idx[order]
+
+    bp = np.minimum(a_ivs.ends[a_idx], b_ivs.ends[b_idx]) - np.maximum(a_ivs.starts[a_idx], b_ivs.starts[b_idx])
+
+    return a_idx, b_idx, bp
+
+
+################################################################################
+# is_gff
+#
+# Return True if the file name looks like a gff or gtf file.
+################################################################################
+def is_gff(interval_file):
+    if interval_file[-3:] == '.gz':
+        interval_file = interval_file[:-3]
+    return interval_file.split('.')[-1] in ['gff', 'gff3', 'gtf']
+
+
+################################################################################
+# parse_intervals
+#
+# Return Intervals for the given gff or bed lines, skipping comments and track
+# lines, and the list of lines kept, stripped of their newlines.
+################################################################################
+def parse_intervals(lines, gff=True):
+    ivs = Intervals()
+    kept_lines = []
+
+    if gff:
+        scol, ecol, strand_col, soff = 3, 4, 6, 1
+    else:
+        scol, ecol, strand_col, soff = 1, 2, 5, 0
+
+    for line in lines:
+        if line[0] == '#' or line.startswith('track') or line.startswith('browser'):
+            continue
+        line = line.rstrip('\r\n')
+        a = line.split('\t')
+        if len(a) <= ecol:
+            continue
+
+        if len(a) > strand_col:
+            strand = a[strand_col]
+        else:
+            strand = '.'
+
+        ivs.add(a[0], int(a[scol])-soff, int(a[ecol]), strand)
+        kept_lines.append(line)
+
+    ivs.finalize()
+
+    return ivs, kept_lines
+
+
+################################################################################
+# read_intervals
+#
+# Return Intervals for the gff, gtf or bed file, judged by its extension
+# unless specified, and the list of its interval lines.
+################################################################################
+def read_intervals(interval_file, gff=None):
+    if interval_file[-3:] == '.gz':
+        interval_open = gzip.open(interval_file)
+    elif interval_file == '-':
+        interval_open = sys.stdin
+    else:
+        interval_open = open(interval_file)
+
+    if gff is None:
+        gff = is_gff(interval_file)
+
+    ivs, lines = parse_intervals(interval_open, gff)
+
+    if interval_open is not sys.stdin:
+        interval_open.close()
+
+    return ivs, lines
+
+
+################################################################################
+# Intervals
+#
+# A set of intervals in 0-based, half-open coordinates, indexed by the order
+# in which they were added.
+################################################################################
+class Intervals:
+    def __init__(self):
+        self.chroms = []
+        self.chrom_i = {}
+
+        self.chrom_col = array.array('i')
+        self.start_col = array.array('i')
+        self.end_col = array.array('i')
+        self.strand_col = array.array('b')
+
+        self.chrom_records = None
+        self.chrom_tiers = None
+
+    def __len__(self):
+        return len(self.start_col)
+
+    ############################################################################
+    # add
+    #
+    # Add an interval and return its index.
+    ############################################################################
+    def add(self, chrom, start, end, strand='.'):
+        if chrom not in self.chrom_i:
+            self.chrom_i[chrom] = len(self.chroms)
+            self.chroms.append(chrom)
+
+        self.chrom_col.append(self.chrom_i[chrom])
+        self.start_col.append(start)
+        self.end_col.append(end)
+        self.strand_col.append(strand_codes.get(strand,0))
+
+        self.chrom_records = None
+
+        return len(self.start_col) - 1
+
+    ############################################################################
+    # extend
+    #
+    # Add intervals on chrom from arrays of starts, ends and optional strand
+    # codes, and return the index of the first.
+    ############################################################################
+    def extend(self, chrom, starts, ends, strands=None):
+        if chrom not in self.chrom_i:
+            self.chrom_i[chrom] = len(self.chroms)
+            self.chroms.append(chrom)
+
+        first_i = len(self.start_col)
+
+        self.chrom_col.fromstring(np.repeat(self.chrom_i[chrom], len(starts)).astype('int32').tostring())
+        self.start_col.fromstring(np.asarray(starts).astype('int32').tostring())
+        self.end_col.fromstring(np.asarray(ends).astype('int32').tostring())
+        if strands is None:
+            strands = np.zeros(len(starts), dtype='int8')
+        self.strand_col.fromstring(np.asarray(strands).astype('int8').tostring())
+
+        self.chrom_records = None
+
+        return first_i
+
+    ############################################################################
+    # finalize
+    #
+    # Build the per-chromosome sorted arrays used by queries. Called implicitly
+    # by queries after intervals have been added.
+    ############################################################################
+    def finalize(self):
+        if self.chrom_records is not None:
+            return
+
+        self.chrom_codes = np.frombuffer(self.chrom_col, dtype='int32').astype('int64')
+        self.starts = np.frombuffer(self.start_col, dtype='int32').astype('int64')
+        self.ends = np.frombuffer(self.end_col, dtype='int32').astype('int64')
+        self.strands = np.frombuffer(self.strand_col, dtype='int8').copy()
+
+        # tier intervals by the power of two bounding their length
+        tiers = np.ceil(np.log2(np.maximum(self.ends - self.starts, 1))).astype('int64')
+
+        self.chrom_records = {}
+        self.chrom_tiers = {}
+
+        chrom_order = np.argsort(self.chrom_codes, kind='mergesort')
+        chrom_bounds = np.searchsorted(self.chrom_codes[chrom_order], np.arange(len(self.chroms)+1))
+        for c in range(len(self.chroms)):
+            chrom_idx = chrom_order[chrom_bounds[c]:chrom_bounds[c+1]]
+            chrom_idx = chrom_idx[np.argsort(self.starts[chrom_idx], kind='mergesort')]
+            self.chrom_records[self.chroms[c]] = chrom_idx
+
+            self.chrom_tiers[self.chroms[c]] = []
+            chrom_tiers = tiers[chrom_idx]
+            for tier in np.unique(chrom_tiers):
+                tier_idx = chrom_idx[chrom_tiers == tier]
+                tier_idx = tier_idx[np.argsort(self.starts[tier_idx], kind='mergesort')]
+                max_len = (self.ends[tier_idx] - self.starts[tier_idx]).max()
+                self.chrom_tiers[self.chroms[c]].append((max_len, tier_idx, self.starts[tier_idx]))
+
+    ############################################################################
+    # lengths
+    #
+    # Return an array of the interval lengths by index.
+    ############################################################################
+    def lengths(self):
+        self.finalize()
+        return self.ends - self.starts
+
+    ############################################################################
+    # overlaps
+    #
+    # Return an array of the indexes of intervals overlapping the given
+    # 0-based, half-open interval, optionally requiring the given strand.
+    ############################################################################
+    def overlaps(self, chrom, start, end, strand=None):
+        self.finalize()
+
+        hits = []
+        for max_len, tier_idx, tier_starts in self.chrom_tiers.get(chrom,[]):
+            lo = np.searchsorted(tier_starts, start - max_len, 'right')
+            hi = np.searchsorted(tier_starts, end, 'left')
+            tier_hits = tier_idx[lo:hi]
+            hits.append(tier_hits[self.ends[tier_hits] > start])
+
+        if hits:
+            hits = np.sort(np.concatenate(hits))
+        else:
+            hits = np.zeros(0, dtype='int64')
+
+        if strand is not None:
+            hits = hits[self.strands[hits] == strand_codes.get(strand,0)]
+
+        return hits
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+    main()
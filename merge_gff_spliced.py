@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 from optparse import OptionParser
-import gff
-import os, pdb, subprocess
+import gff, intersect
+import os, pdb
 
 ################################################################################
 # merge_gff_spliced.py
@@ -28,38 +28,33 @@ def main():
         gff_pre = os.path.splitext(gff_file)[0]
 
     # get features
+    feature_ivs, feature_lines = intersect.read_intervals(gff_file, gff=True)
+
+    feature_keys = []
     feature_lengths = {}
-    for line in open(gff_file):
+    for line in feature_lines:
         a = line.split('\t')
-        a[-1] = a[-1].rstrip()
 
         key = a[8]
         if options.key:
             key = gff.gtf_kv(a[8])[options.key]
+        feature_keys.append(key)
 
         feature_lengths[key] = feature_lengths.get(key,0) + int(a[4])-int(a[3])+1
         
     # intersect features
-    p = subprocess.Popen('intersectBed -s -wo -a %s -b %s > %s_self.gff' % (gff_file,gff_file,gff_pre), shell=True)
-    os.waitpid(p.pid,0)
+    feature_idx1, feature_idx2, feature_bp = intersect.intersect(feature_ivs, feature_ivs, same_strand=True)
 
     # hash overlap bp
     overlap_bp = {}
-    for line in open('%s_self.gff' % gff_pre):
-        a = line.split('\t')
-        a[-1] = a[-1].rstrip()
-
-        key1 = a[8]
-        if options.key:
-            key1 = gff.gtf_kv(a[8])[options.key]
-        key2 = a[17]
-        if options.key:
-            key2 = gff.gtf_kv(a[17])[options.key]
+    for i in range(len(feature_idx1)):
+        key1 = feature_keys[feature_idx1[i]]
+        key2 = feature_keys[feature_idx2[i]]
 
         if key1 < key2: # just in one direction
             if key1 not in overlap_bp:
                 overlap_bp[key1] = {}
-            overlap_bp[key1][key2] = overlap_bp[key1].get(key2,0) + int(a[-1])
+            overlap_bp[key1][key2] = overlap_bp[key1].get(key2,0) + int(feature_bp[i])
 
     # create list of % overlaps
     overlap_pcts = []
@@ -96,16 +91,9 @@ def main():
                     overlap_pcts[j] = (overlap_pcts[j][0],overlap_pcts[j][1],replace_key)
 
     # print un-deleted
-    for line in open(gff_file):
-        a = line.split('\t')
-        a[-1] = a[-1].rstrip()
-
-        key = a[8]
-        if options.key:
-            key = gff.gtf_kv(a[8])[options.key]
-
-        if key in feature_lengths:
-            print line,
+    for i in range(len(feature_lines)):
+        if feature_keys[i] in feature_lengths:
+            print feature_lines[i]
 
 
 ################################################################################
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+import numpy as np
+import pysam
+import bam_filters, bam_fragments, bam_shards, coverage_cache
+
+################################################################################
+# meta_profile.py
+#
+# Read coverage meta-profiles over sets of equal-length windows, e.g. around
+# TSSs or splice sites, computed from a BAM file through its index, or in
+# one pass over an unindexed BAM file.
+#
+# Windows are 1-based and inclusive, hashed by chromosome as lists of tuples
+# beginning (start, end, strand). Nearby windows are merged into regions of at
+# most max_region bp, and each region's reads are fetched once and their
+# aligned blocks, including deletions but not introns, turned into per-base
+# depth by a cumulative sum of block start and end counts. Windows on the -
+# strand are reversed so that profiles run 5' to 3'.
+#
+# Reads are filtered as samtools mpileup does by default, skipping unmapped,
+# secondary, QC failed and duplicate reads and pairs that are not properly
+# paired, but bases are not filtered by quality.
+#
+# Meta-profiles are summed over the genome shards of bam_shards.py, which may
+# be spread across processes, or sliced out of the BAM file's coverage cache
+# (see coverage_cache.py).
+################################################################################
+
+# maximum length of merged window regions to fetch at once
+max_region = 2**20
+
+# unmapped, secondary, QC failed, duplicate
+skip_flags = bam_filters.pileup_flags
+
+
+################################################################################
+# bam_alignments
+#
+# Return the number of alignments in the BAM file, as counted by samtools
+# view -c, from its index if it has one.
+################################################################################
+def bam_alignments(bam_file):
+    bam = pysam.Samfile(bam_file, 'rb')
+    if bam_shards.bam_indexed(bam_file):
+        alignments = bam.mapped + bam.unmapped
+    else:
+        alignments = 0
+        for aligned_read in bam:
+            alignments += 1
+    bam.close()
+    return alignments
+
+
+################################################################################
+# cache_profile
+#
+# Return the meta-profile of the windows from the CoverageCache cov.
+################################################################################
+def cache_profile(cov, chrom_windows, length, log_sum=False):
+    profile = np.zeros(length)
+    for chrom in sorted(chrom_windows):
+        windows = chrom_windows[chrom]
+        wstarts = np.array([window[0] for window in windows], dtype='int64') - 1
+        wminus = np.array([window[2] == '-' for window in windows], dtype='bool')
+
+        depth = cov.window_coverage(chrom, wstarts, wstarts+length, wminus, length)
+        if log_sum:
+            covered = (depth > 0)
+            depth[covered] = np.log(depth[covered])
+        profile += depth.sum(axis=0)
+
+    return profile
+
+
+################################################################################
+# meta_profile
+#
+# Return a numpy array of the sum over windows of each position's read depth,
+# or of its log where the depth is positive for geometric means, splitting
+# the windows by genome shard across the given number of processes, or from
+# the BAM file's coverage cache if cache is set.
+################################################################################
+def meta_profile(bam_file, chrom_windows, length, log_sum=False, processes=1, cache=False):
+    if cache:
+        cov = coverage_cache.coverage_cache(bam_file, pileup=True, weight_nh=False, processes=processes)
+        return cache_profile(cov, chrom_windows, length, log_sum)
+
+    shards = bam_shards.bam_shards(bam_file)
+    units = [(bam_file, windows, length, log_sum) for windows in bam_shards.shard_windows(chrom_windows, shards) if windows]
+
+    profile = np.zeros(length)
+    for unit_profile in bam_shards.map_shards(profile_unit, units, processes):
+        profile += unit_profile
+    return profile
+
+
+################################################################################
+# profile_logs
+#
+# Return the logs of the positive depths in a window profile, and zero for
+# positions without reads.
+################################################################################
+def profile_logs(depth):
+    logs = np.zeros(len(depth))
+    covered = (depth > 0)
+    logs[covered] = np.log(depth[covered])
+    return logs
+
+
+################################################################################
+# profile_matrix
+#
+# Return a list of the (chrom, window index) of each window, by sorted
+# chromosome and then window order, and a matrix of their read depth
+# profiles.
+################################################################################
+def profile_matrix(bam_file, chrom_windows, length):
+    windows = []
+    for chrom in sorted(chrom_windows):
+        windows += [(chrom,wi) for wi in range(len(chrom_windows[chrom]))]
+    window_rows = dict([(windows[i],i) for i in range(len(windows))])
+
+    matrix = np.zeros((len(windows), length), dtype='int32')
+    for chrom, wi, depth in window_profiles(bam_file, chrom_windows):
+        matrix[window_rows[(chrom,wi)],:len(depth)] = depth
+
+    return windows, matrix
+
+
+################################################################################
+# profile_unit
+#
+# Return the meta-profile of one shard's windows, given as a single tuple
+# argument for Pool.imap.
+################################################################################
+def profile_unit((bam_file, chrom_windows, length, log_sum)):
+    profile = np.zeros(length)
+    for chrom, wi, depth in window_profiles(bam_file, chrom_windows):
+        if log_sum:
+            profile += profile_logs(depth)
+        else:
+            profile += depth
+    return profile
+
+
+################################################################################
+# region_depth
+#
+# Return an array of the per-base read depth over the 1-based, inclusive
+# region [start, end] of chrom in the open BAM file.
+################################################################################
+def region_depth(bam, chrom, start, end):
+    region_len = end - start + 1
+
+    block_starts = []
+    block_ends = []
+    for aligned_read in bam.fetch(chrom, max(0,start-1), end):
+        if aligned_read.flag & skip_flags or (aligned_read.is_paired and not aligned_read.is_proper_pair):
+            continue
+        for block_start, block_end in bam_fragments.read_blocks(aligned_read):
+            block_starts.append(block_start)
+            block_ends.append(block_end)
+
+    # 0-based block starts and ends relative to the region
+    block_starts = np.clip(np.array(block_starts, dtype='int64') - (start-1), 0, region_len)
+    block_ends = np.clip(np.array(block_ends, dtype='int64') - (start-1), 0, region_len)
+
+    diffs = np.bincount(block_starts, minlength=region_len+1) - np.bincount(block_ends, minlength=region_len+1)
+    return np.cumsum(diffs[:region_len])
+
+
+################################################################################
+# whole_window_profiles
+#
+# Yield window_profiles' tuples from the coverage of the whole BAM file,
+# computed in memory.
+################################################################################
+def whole_window_profiles(bam_file, chrom_windows):
+    bam = pysam.Samfile(bam_file, 'rb')
+    bam_chroms = set(bam.references)
+    bam.close()
+
+    cov = coverage_cache.compute_coverage(bam_file, pileup=True, weight_nh=False)
+
+    for chrom in sorted(chrom_windows):
+        if chrom not in bam_chroms:
+            continue
+
+        for wi in range(len(chrom_windows[chrom])):
+            wstart, wend, wstrand = chrom_windows[chrom][wi][:3]
+            depth = np.rint(cov.positions_coverage(chrom, np.arange(wstart-1, wend))).astype('int64')
+            if wstrand == '-':
+                depth = depth[::-1]
+            yield chrom, wi, depth
+
+
+################################################################################
+# window_profiles
+#
+# Yield (chrom, window index, depth) tuples for each window, with depth an
+# array of the window's per-base read depth oriented by its strand. Without
+# an index to fetch regions through, the depth of an unindexed BAM file is
+# computed in one pass over it.
+################################################################################
+def window_profiles(bam_file, chrom_windows):
+    if not bam_shards.bam_indexed(bam_file):
+        for window_profile in whole_window_profiles(bam_file, chrom_windows):
+            yield window_profile
+        return
+
+    bam = pysam.Samfile(bam_file, 'rb')
+    bam_chroms = set(bam.references)
+
+    for chrom in sorted(chrom_windows):
+        if chrom not in bam_chroms:
+            continue
+
+        for rstart, rend, region_windows in window_regions(chrom_windows[chrom]):
+            depth = region_depth(bam, chrom, rstart, rend)
+
+            for wi in region_windows:
+                wstart, wend, wstrand = chrom_windows[chrom][wi][:3]
+                window_depth = depth[max(wstart,rstart)-rstart:wend-rstart+1]
+                if wstart < rstart:
+                    # clipped before the chromosome start
+                    window_depth = np.concatenate([np.zeros(rstart-wstart, dtype=depth.dtype), window_depth])
+                if wstrand == '-':
+                    window_depth = window_depth[::-1]
+                yield chrom, wi, window_depth
+
+    bam.close()
+
+
+################################################################################
+# window_regions
+#
+# Return a list of (start, end, window indexes) regions merging overlapping
+# or adjacent windows up to max_region bp. Windows starting before the
+# chromosome are clipped.
+################################################################################
+def window_regions(windows):
+    order = sorted(range(len(windows)), key=lambda wi: windows[wi][:2])
+
+    regions = []
+    for wi in order:
+        wstart = max(1, windows[wi][0])
+        wend = windows[wi][1]
+        if regions and wstart <= regions[-1][1]+1 and max(wend,regions[-1][1]) - regions[-1][0] < max_region:
+            regions[-1][1] = max(wend, regions[-1][1])
+            regions[-1][2].append(wi)
+        else:
+            regions.append([wstart, wend, [wi]])
+
+    return [tuple(region) for region in regions]
@@ -1,13 +1,16 @@
 #!/usr/bin/env python
 from optparse import OptionParser
-import os, pdb, shutil, stats, subprocess, sys, tempfile
-import pysam
-import gff, ggplot
+import os, pdb, shutil, sys
+import numpy as np
+import bam_fragments, bam_shards, gff, ggplot, intersect
 
 ################################################################################
 # peak_bam_cov.py
 #
 # Plot read coverage in a BAM file surrounding the median points of GFF entries
+#
+# The BAM file is read by genome shard (see bam_shards.py), optionally across
+# processes, and the shards' coverage differences summed in order.
 ################################################################################
 
 ################################################################################
@@ -19,6 +22,7 @@ def main():
     #parser.add_option('-c', dest='control_bam_file', default=None, help='Control BAM file')
     parser.add_option('-g', dest='geo_mean', default=False, action='store_true', help='Compute geometric mean of individual peak coverages [Default: %default]')
     parser.add_option('-i', dest='individual_plots', default=False, action='store_true', help='Print a coverage plot for every individual peak [Default: %default]')
+    parser.add_option('-n', dest='processes', default=1, type='int', help='Number of processes to split the genome across [Default: %default]')
     parser.add_option('-o', dest='out_prefix', default='peak_cov', help='Output prefix [Default: %default]')
     parser.add_option('-p', dest='properly_paired', default=False, action='store_true', help='Count entire fragments for only properly paired reads [Default: %default]')
     parser.add_option('-u', dest='range', default=500, type='int', help='Range around peak middle [Default: %default]')
@@ -30,34 +34,9 @@ def main():
         peaks_gff = args[0]
         bam_file = args[1]
 
-    # filter BAM for mapping quality
-    bam_mapq_fd, bam_mapq_file = tempfile.mkstemp(dir='%s/research/scratch' % os.environ['HOME'])
-    bam_in = pysam.Samfile(bam_file, 'rb')
-    bam_mapq_out = pysam.Samfile(bam_mapq_file, 'wb', template=bam_in)
-    for aligned_read in bam_in:
-        if aligned_read.mapq > 0:
-            bam_mapq_out.write(aligned_read)
-    bam_mapq_out.close()
-
-    # count fragments and hash multi-mappers
-    num_fragments = 0
-    multi_maps = {}
-    for aligned_read in pysam.Samfile(bam_mapq_file, 'rb'):
-        if options.properly_paired:
-            if aligned_read.is_properly_paired:
-                num_fragments += 0.5/aligned_read.opt('NH')
-        else:
-            if aligned_read.is_paired:
-                num_fragments += 0.5/aligned_read.opt('NH')
-            else:
-                num_fragments += 1.0/aligned_read.opt('NH')
-
-        if aligned_read.opt('NH') > 1:
-            multi_maps[aligned_read.qname] = aligned_read.opt('NH')
-
     # extend GFF entries to range
-    peaks_gff_range_fd, peaks_gff_range_file = tempfile.mkstemp()
-    peaks_gff_range_out = open(peaks_gff_range_file, 'w')
+    peak_ivs = intersect.Intervals()
+    peak_ids = []
     for line in open(peaks_gff):
         a = line.split('\t')
         
@@ -65,53 +44,36 @@ def main():
         pend = int(a[4])
         peak_mid = pstart + (pend-pstart)/2
 
-        a[3] = str(peak_mid - options.range/2 - 1)
-        a[4] = str(peak_mid + options.range/2 + 1)
+        peak_ivs.add(a[0], peak_mid - options.range/2 - 2, peak_mid + options.range/2 + 1, a[6])
+        peak_ids.append(gff.gtf_kv(a[8])['id'])
 
-        print >> peaks_gff_range_out, '\t'.join(a),
-    peaks_gff_range_out.close()
+    # count fragments and reads by genome shard, filtering for mapping quality
+    peak_rows = {}
+    for peak_id in peak_ids:
+        peak_rows.setdefault(peak_id, len(peak_rows))
+    peaks = (peak_ivs, np.array([peak_rows[peak_id] for peak_id in peak_ids], dtype='int64'), options.range, options.properly_paired)
 
-    # initialize coverage counters
-    peak_cov_individual = {}
-    peak_reads = {}
+    peak_cov_diffs = np.zeros((len(peak_rows), options.range+2))
+    peak_read_counts = np.zeros(len(peak_rows), dtype='int64')
 
-    # count reads
-    p = subprocess.Popen('intersectBed -split -wo -bed -abam %s -b %s' % (bam_mapq_file,peaks_gff_range_file), shell=True, stdout=subprocess.PIPE)
-    for line in p.stdout:
-        a = line.split('\t')
-        
-        rstart = int(a[1])
-        rend = int(a[2])
-        rheader = a[3]
+    units = [(bam_file, shard) for shard in bam_shards.bam_shards(bam_file)]
+    num_fragments = bam_shards.merge_row_diffs(bam_shards.map_shards(coverage_unit, units, options.processes, bam_shards.init_worker, (peaks,)), peak_cov_diffs, peak_read_counts)
 
-        # because intersectBed screws up indels near endpoints
-        if rstart < rend:
-            pstart = int(a[15])
-            pend = int(a[16])
-            peak_id = gff.gtf_kv(a[20])['id']
-            peak_reads[peak_id] = peak_reads.get(peak_id,0) + 1
-
-            peak_mid = pstart + (pend-pstart)/2
-            peak_range_start = peak_mid - options.range/2
-            peak_range_end = peak_mid + options.range/2
-
-            range_start = max(rstart, peak_range_start)
-            range_end = min(rend, peak_range_end)
-
-            if not peak_id in peak_cov_individual:
-                peak_cov_individual[peak_id] = [0.0]*(1+options.range)
-            for i in range(range_start - peak_range_start, range_end - peak_range_start + 1):
-                peak_cov_individual[peak_id][i] += 1.0/multi_maps.get(rheader,1)
-
-    p.communicate()
+    # individual coverage of the peaks with reads
+    peak_cov_matrix = np.cumsum(peak_cov_diffs, axis=1)[:,:options.range+1]
+    peak_cov_individual = {}
+    peak_reads = {}
+    for peak_id in peak_rows:
+        if peak_read_counts[peak_rows[peak_id]] > 0:
+            peak_cov_individual[peak_id] = peak_cov_matrix[peak_rows[peak_id]].tolist()
+            peak_reads[peak_id] = peak_read_counts[peak_rows[peak_id]]
 
     # combine individual
-    peak_cov = [0.0]*(1+options.range)
-    for i in range(len(peak_cov)):
-        if options.geo_mean:
-            peak_cov[i] = stats.geo_mean([1+peak_cov_individual[peak_id][i] for peak_id in peak_cov_individual])
-        else:
-            peak_cov[i] = stats.mean([peak_cov_individual[peak_id][i] for peak_id in peak_cov_individual])
+    read_rows = (peak_read_counts > 0)
+    if options.geo_mean:
+        peak_cov = np.exp(np.log(1+peak_cov_matrix[read_rows]).mean(axis=0)).tolist()
+    else:
+        peak_cov = peak_cov_matrix[read_rows].mean(axis=0).tolist()
 
     #for peak_id in peak_reads:
     #    print peak_id, peak_reads[peak_id]
@@ -129,11 +91,38 @@ def main():
             if peak_reads[peak_id] > 150:
                 make_output(peak_cov_individual[peak_id], '%s/%s' % (individual_dir,peak_id), options.range)
 
-    # clean
-    os.close(bam_mapq_fd)
-    os.remove(bam_mapq_file)
-    os.close(peaks_gff_range_fd)
-    os.remove(peaks_gff_range_file)
+
+################################################################################
+# coverage_unit
+#
+# Compute the coverage differences of one (BAM file, genome shard) unit's
+# reads over the (Intervals, peak rows, range, properly paired) peaks set by
+# bam_shards.init_worker, weighting multi-mappers by their NH tags, and
+# return the fragments counted and bam_shards.shard_row_diffs of the peak
+# rows covered, counting their overlapping blocks.
+################################################################################
+def coverage_unit((bam_file, shard)):
+    peak_ivs, peak_rows, prange, properly_paired = bam_shards.worker_state
+    chrom, start, end = shard
+
+    unit_incs = []
+    counter = bam_fragments.BamCounter(bam_file, filter_mapq=True, properly_paired=properly_paired, chrom=chrom, start=start, end=end)
+    for blocks in counter.overlaps(peak_ivs):
+        rstarts = blocks.starts[blocks.block_idx]
+        rends = blocks.ends[blocks.block_idx]
+
+        pstarts = peak_ivs.starts[blocks.feature_idx] + 1
+        pends = peak_ivs.ends[blocks.feature_idx]
+        peak_mids = pstarts + (pends-pstarts)/2
+        peak_range_starts = peak_mids - prange/2
+        peak_range_ends = peak_mids + prange/2
+
+        range_starts = np.maximum(rstarts, peak_range_starts)
+        range_ends = np.minimum(rends, peak_range_ends)
+
+        unit_incs.append((peak_rows[blocks.feature_idx], range_starts - peak_range_starts, np.maximum(range_starts, range_ends+1) - peak_range_starts, 1.0/blocks.nh()[blocks.block_idx]))
+
+    return (counter.fragments,) + bam_shards.shard_row_diffs(unit_incs, prange+1)
 
 
 ################################################################################
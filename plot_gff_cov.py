@@ -1,11 +1,11 @@
 #!/usr/bin/env python
 from optparse import OptionParser
-import math, os, pdb, random, shutil, stats, subprocess, sys, tempfile
+import os, pdb, random, shutil, sys, tempfile
 
 #from guppy import hpy
-import pysam
+import numpy as np
 
-import count_reads, gff, ggplot
+import bam_fragments, bam_shards, count_reads, coverage_cache, gff, ggplot, intersect
 
 ################################################################################
 # plot_gff_cov.py
@@ -13,6 +13,14 @@ import count_reads, gff, ggplot
 # Plot coverage of entries in a BAM or GFF file over the median points or span
 # of GFF entries as a heatmap.
 #
+# Coverage is held in a float32 matrix of anchors by positions. Each overlap
+# adds its weight at the start of its range and subtracts it at the end,
+# and a cumulative sum along each anchor turns these differences into
+# coverage. BAM files are read by genome shard (see bam_shards.py), optionally
+# across processes, and the shards' differences summed in order. In mid mode
+# around GFF anchors, their coverage may instead be sliced from their coverage
+# caches (see coverage_cache.py).
+#
 # To plot coverage around TSS:
 #  ./plot_gff_cov.py -u mid -r 1000 mid tss.gff reads.bam
 #
@@ -32,12 +40,14 @@ def main():
     parser.add_option('-e', dest='plot_heat', default=False, help='Plot as a heatmap [Default: %default]')
     parser.add_option('-l', dest='log', default=False, action='store_true', help='log2 coverage [Default: %default]')
     parser.add_option('-o', dest='output_pre', default='gff_cov', help='Output prefix [Default: %default]')
+    parser.add_option('-p', dest='processes', default=1, type='int', help='Number of processes to split the genome across [Default: %default]')
     parser.add_option('-s', dest='sorted_gene_files', help='Files of sorted gene lists. Plot heatmaps in their order')
 
     parser.add_option('-b', dest='bins', default=100, type='int', help='Number of bins across the gene span [Default: %default]')
     parser.add_option('-m', dest='min_length', default=None, type='int', help='Minimum anchor length [Default: %default]')
 
     parser.add_option('-w', dest='window', default=2000, type='int', help='Window around peak middle [Default: %default]')
+    parser.add_option('-x', dest='cache', default=False, action='store_true', help='Slice coverage from the BAM files\' coverage caches in mid mode [Default: %default]')
 
     (options,args) = parser.parse_args()
 
@@ -59,9 +69,9 @@ def main():
     ############################################
     # compute coverage
     ############################################
-    coverage, events = compute_coverage(prep_anchor_gff, event_files, mode, anchor_is_gtf, options.bins)
+    anchor_ids, coverage, events = compute_coverage(prep_anchor_gff, event_files, mode, anchor_is_gtf, options.bins, options.processes, options.cache)
     if options.control_files:
-        coverage_control, events_control = compute_coverage(prep_anchor_gff, control_files, mode, anchor_is_gtf, options.bins)
+        anchor_ids, coverage_control, events_control = compute_coverage(prep_anchor_gff, control_files, mode, anchor_is_gtf, options.bins, options.processes, options.cache)
 
     # clean
     os.close(prep_anchor_fd)
@@ -71,43 +81,51 @@ def main():
     # normalize
     ############################################
     # normalize coverages (and add pseudocounts)
-    for anchor_id in coverage:
-        for i in range(len(coverage[anchor_id])):
-            coverage[anchor_id][i] = (1+coverage[anchor_id][i])/float(events)
-            if options.control_files:
-                coverage_control[anchor_id][i] = (1+coverage_control[anchor_id][i])/float(events_control)
+    coverage += 1
+    coverage /= float(events)
+    if options.control_files:
+        coverage_control += 1
+        coverage_control /= float(events_control)
 
     ############################################
     # sort anchors
     ############################################
     anchors_sorted = []
     if options.sorted_gene_files:
+        anchor_rows = dict([(anchor_ids[ai],ai) for ai in range(len(anchor_ids))])
+
         # for each sorted list
         for sorted_gene_file in options.sorted_gene_files.split(','):
-            # collect anchor_id's
+            # collect anchor rows
             anchors_sorted.append([])
             for line in open(sorted_gene_file):
                 anchor_id = line.split()[0]
                 # verify randomly selected
-                if anchor_id in coverage:
-                    anchors_sorted[-1].append(anchor_id)
+                if anchor_id in anchor_rows:
+                    anchors_sorted[-1].append(anchor_rows[anchor_id])
 
     else:
         # tuple anchor_id's with mean coverage
-        stat_aid = []
-        for anchor_id in coverage:
-            if options.control_files:
-                astat = stats.mean([math.log(coverage[anchor_id][i],2) - math.log(coverage_control[anchor_id][i],2) for i in range(len(coverage[anchor_id]))])
-            else:
-                astat = stats.geo_mean([coverage[anchor_id][i] for i in range(len(coverage[anchor_id]))])
-
-            stat_aid.append((astat, anchor_id))
+        if options.control_files:
+            astats = (np.log2(coverage, dtype='float64') - np.log2(coverage_control, dtype='float64')).mean(axis=1)
+        else:
+            astats = np.exp(np.log(coverage, dtype='float64').mean(axis=1))
 
         # sort
-        stat_aid.sort(reverse=True)
+        stat_aid = sorted(zip(astats.tolist(), anchor_ids, range(len(anchor_ids))), reverse=True)
 
         # store as the only sorted list
-        anchors_sorted.append([anchor_id for (astat, anchor_id) in stat_aid])
+        anchors_sorted.append([ai for (astat, anchor_id, ai) in stat_aid])
+
+    if mode == 'mid':
+        index_offset = options.window/2
+    elif mode == 'span':
+        index_offset = 0
+    else:
+        print >> sys.stderr, 'Unknown mode %s' % mode
+        exit(1)
+    index = np.arange(coverage.shape[1]) - index_offset
+    anchor_names = np.array([str(anchor_id) for anchor_id in anchor_ids])
 
     ############################################
     # plot heatmap(s)
@@ -119,29 +137,23 @@ def main():
                 os.mkdir('%s_heat' % options.output_pre)
 
         for s in range(len(anchors_sorted)):
-            df = {'Index':[], 'Anchor':[], 'Coverage':[]}
-            for si in range(len(anchors_sorted[s])):
-                anchor_id = anchors_sorted[s][si]
-
-                for i in range(len(coverage[anchor_id])):
-                    if mode == 'mid':
-                        df['Index'].append(i - options.window/2)
-                    else:
-                        df['Index'].append(i)
-                    df['Anchor'].append(anchor_id)
-
-                    if options.log:
-                        cov = math.log(coverage[anchor_id][i], 2)
-                    else:
-                        cov = coverage[anchor_id][i]
-
-                    if options.control_files:
-                        if options.log:
-                            cov -= math.log(coverage_control[anchor_id][i], 2)
-                        else:
-                            cov = cov / coverage_control[anchor_id][i]
-
-                    df['Coverage'].append('%.4e' % cov)
+            rows = np.array(anchors_sorted[s], dtype='int64')
+
+            if options.log:
+                cov = np.log2(coverage[rows], dtype='float64')
+            else:
+                cov = coverage[rows].astype('float64')
+
+            if options.control_files:
+                if options.log:
+                    cov -= np.log2(coverage_control[rows], dtype='float64')
+                else:
+                    cov /= coverage_control[rows]
+
+            df = {}
+            df['Index'] = np.tile(index, len(rows))
+            df['Anchor'] = np.repeat(anchor_names[rows], len(index))
+            df['Coverage'] = cov.ravel()
 
             r_script = '%s/plot_gff_cov_heat.r' % os.environ['RDIR']
             if len(anchors_sorted) == 1:
@@ -156,47 +168,41 @@ def main():
     ############################################
     # plot meta-coverage
     ############################################
-    df = {'Index':[], 'Coverage':[]}
-    if options.control_files:
-        df['Type'] = []
-
-    if mode == 'mid':
-        index_length = 2*(options.window/2) + 1
-    elif mode == 'span':
-        index_length = options.bins
+    if options.log:
+        meta_cov = np.exp(np.log(coverage, dtype='float64').mean(axis=0))
     else:
-        print >> sys.stderr, 'Unknown mode %s' % mode
-        exit(1)
-
-    for i in range(index_length):
-        if mode == 'mid':
-            df['Index'].append(i - options.window/2)
-        else:
-            df['Index'].append(i)
+        meta_cov = coverage.mean(axis=0, dtype='float64')
 
+    if options.control_files:
         if options.log:
-            df['Coverage'].append(stats.geo_mean([coverage[anchor_id][i] for anchor_id in coverage]))
+            meta_control = np.exp(np.log(coverage_control, dtype='float64').mean(axis=0))
         else:
-            df['Coverage'].append(stats.mean([coverage[anchor_id][i] for anchor_id in coverage]))
-
-        if options.control_files:
-            df['Type'].append('Primary')
+            meta_control = coverage_control.mean(axis=0, dtype='float64')
 
-            if mode == 'mid':
-                df['Index'].append(i - options.window/2)
-            else:
-                df['Index'].append(i)
-
-            df['Type'].append('Control')
-            if options.log:
-                df['Coverage'].append(stats.geo_mean([coverage_control[anchor_id][i] for anchor_id in coverage_control]))
-            else:
-                df['Coverage'].append(stats.mean([coverage_control[anchor_id][i] for anchor_id in coverage_control]))
+        # interleave primary and control
+        df = {}
+        df['Index'] = np.repeat(index, 2)
+        df['Coverage'] = np.column_stack([meta_cov, meta_control]).ravel()
+        df['Type'] = ['Primary','Control']*len(index)
+    else:
+        df = {'Index':index, 'Coverage':meta_cov}
 
     r_script = '%s/plot_gff_cov_meta.r' % os.environ['RDIR']
     ggplot.plot(r_script, df, [options.output_pre])
 
 
+################################################################################
+# add_increments
+#
+# Add the weights to the coverage difference matrix over the ranges
+# [inc_start, inc_end) of the given rows.
+################################################################################
+def add_increments(coverage, rows, inc_starts, inc_ends, weights):
+    weights = weights.astype('float32')
+    np.add.at(coverage, (rows, inc_starts), weights)
+    np.add.at(coverage, (rows, inc_ends), -weights)
+
+
 ################################################################################
 # compute_coverage
 #
@@ -206,124 +212,87 @@ def main():
 #  mode:          mid or span.
 #  anchor_is_gtf: True iff anchor_gff is GTF.
 #  bins:          Number of bins to consider in span mode.
+#  processes:     Number of processes to split BAM genome shards across.
+#  cache:         Slice BAM coverage from the BAM files' coverage caches.
 #
 # Output
-#  coverage:      Dict mapping anchor_id's to coverage arrays.
+#  anchor_ids:    List of anchor_id's.
+#  coverage:      Float32 matrix of coverage by anchor and position.
 #  events:        Total number of events.
 ################################################################################
-def compute_coverage(anchor_gff, event_files, mode, anchor_is_gtf, bins):
-    ############################################
-    # initialize
-    ############################################
-    coverage = initialize_coverage(anchor_gff, mode, anchor_is_gtf, bins)    
+def compute_coverage(anchor_gff, event_files, mode, anchor_is_gtf, bins, processes=1, cache=False):
+    anchors = Anchors(anchor_gff, mode, anchor_is_gtf, bins)
 
-    if anchor_is_gtf:
-        # get transcript structures
-        transcripts = gff.read_genes(anchor_gff, key_id='transcript_id')
-
-        # compute lengths
-        transcript_lengths = {}
-        for tid in transcripts:
-            tx = transcripts[tid]
-            for exon in tx.exons:
-                transcript_lengths[tid] = transcript_lengths.get(tid,0) + exon.end-exon.start+1
-
-    else:
-        transcripts = None
-        transcript_lengths = None
+    # cached coverage is per base, so can't be binned
+    if cache and (mode != 'mid' or anchor_is_gtf):
+        print >> sys.stderr, 'WARNING: coverage caches apply only to mid mode around GFF anchors'
+        cache = False
+    cache_files = []
 
+    # coverage differences, summed to coverage at the end so that
+    # incrementing a range costs two additions
+    coverage = np.zeros((len(anchors.ids), anchors.width+1), dtype='float32')
 
     events = 0
+    bam_units = []
     for event_file in event_files:
         print >> sys.stderr, 'Computing coverage for %s' % event_file
 
-        ############################################
-        # preprocess BAM/GFF
-        ############################################
-        if event_file[-4:] == '.bam':
-            # count fragments and hash multi-mappers
-            multi_maps = {}
-            for aligned_read in pysam.Samfile(event_file, 'rb'):
-                try:
-                    nh_tag = aligned_read.opt('NH')
-                except:
-                    nh_tag = 1.0
-
-                if aligned_read.is_paired:
-                    events += 0.5/nh_tag
-                else:
-                    events += 1.0/nh_tag
+        if event_file[-4:] == '.bam' and cache:
+            # slice after summing the differences below
+            cache_files.append(event_file)
 
-                if nh_tag > 1:
-                    multi_maps[aligned_read.qname] = nh_tag
+        elif event_file[-4:] == '.bam':
+            # intersect by genome shard below
+            for shard in bam_shards.bam_shards(event_file):
+                bam_units.append((event_file, shard))
 
         elif event_file[-4:] == '.gff':
-            for line in open(event_file):
-                events += 1
+            event_ivs = intersect.read_intervals(event_file, gff=True)[0]
+            events += len(event_ivs)
+            event_idx, anchor_idx = intersect.intersect(event_ivs, anchors.ivs, same_strand=True)[:2]
+            add_increments(coverage, *anchors.increments(event_ivs, event_idx, anchor_idx, np.ones(len(event_idx))))
 
         else:
             print >> sys.stderr, 'Unknown event file format %s' % event_file
 
-        ############################################
-        # intersect BAM w/ anchors
-        ############################################
-        if event_file[-4:] == '.bam':
-            p = subprocess.Popen('intersectBed -split -wo -bed -abam %s -b %s' % (event_file, anchor_gff), shell=True, stdout=subprocess.PIPE)
-        else:
-            p = subprocess.Popen('intersectBed -s -wo -a %s -b %s' % (event_file, anchor_gff), shell=True, stdout=subprocess.PIPE)
+    events += bam_shards.merge_row_diffs(bam_shards.map_shards(coverage_unit, bam_units, processes, bam_shards.init_worker, (anchors,)), coverage)
 
-        for line in p.stdout:
-            a = line.split('\t')
+    np.cumsum(coverage, axis=1, out=coverage)
 
-            if event_file[-4:] == '.bam':
-                rstart = int(a[1])+1  # convert back to 1-based gff from bed
-                rend = int(a[2])
-                rheader = a[3]
-            else:
-                rstart = int(a[3])
-                rend = int(a[4])
-
-            # because intersectBed screws up indels near endpoints
-            if rstart < rend:
-                if event_file[-4:] == '.bam':
-                    acol = 12
-                else:
-                    acol = 9
+    anchors.ivs.finalize()
+    for cache_file in cache_files:
+        cov = coverage_cache.coverage_cache(cache_file, processes=processes)
+        events += cov.fragments
+        for chrom in anchors.ivs.chroms:
+            chrom_idx = anchors.ivs.chrom_records[chrom]
+            chrom_coverage = cov.window_coverage(chrom, anchors.ivs.starts[chrom_idx], anchors.ivs.ends[chrom_idx], anchors.iv_minus[chrom_idx], anchors.width)
+            np.add.at(coverage, (anchors.iv_rows[chrom_idx], slice(0,anchors.width)), chrom_coverage.astype('float32'))
 
-                achrom = a[acol]
-                astart = int(a[acol+3])
-                aend = int(a[acol+4])
-                astrand = a[acol+6]
+    return anchors.ids, coverage[:,:anchors.width], events
 
-                if anchor_is_gtf:
-                    anchor_id = gff.gtf_kv(a[acol+8])['transcript_id']
-                else:
-                    anchor_id = (achrom, astart, aend)
 
-                # find where to increment
-                inc_start, inc_end = find_inc_coords(anchor_id, astart, aend, astrand, rstart, rend, mode, bins, transcripts, transcript_lengths)
-
-                if inc_start != None:
-                    if event_file[-4:] == '.bam':
-                        # find multi-map number, which may require removing a suffix
-                        if rheader in multi_maps:
-                            mm = multi_maps[rheader]
-                        else:
-                            rheader_base = rheader[:rheader.rfind('/')]
-                            if rheader_base in multi_maps:
-                                mm = multi_maps[rheader_base]
-                            else:
-                                mm = 1.0
-                    else:
-                        mm = 1.0
+################################################################################
+# coverage_unit
+#
+# Compute the coverage differences of one (BAM file, genome shard) unit's
+# reads over the Anchors set by bam_shards.init_worker, and return the
+# fragments counted and bam_shards.shard_row_diffs of the anchor rows
+# covered.
+################################################################################
+def coverage_unit((bam_file, shard)):
+    anchors = bam_shards.worker_state
+    chrom, start, end = shard
 
-                    # increment!
-                    for i in range(inc_start, inc_end):
-                        coverage[anchor_id][i] += 1.0/mm
+    # count fragments, weighting multi-mappers by their NH tags
+    counter = bam_fragments.BamCounter(bam_file, chrom=chrom, start=start, end=end)
 
-        p.communicate()
+    unit_incs = []
+    for overlaps in counter.overlaps(anchors.ivs):
+        event_weights = 1.0 / overlaps.nh()[overlaps.block_idx]
+        unit_incs.append(anchors.increments(overlaps, overlaps.block_idx, overlaps.feature_idx, event_weights))
 
-    return coverage, events
+    return (counter.fragments,) + bam_shards.shard_row_diffs(unit_incs, anchors.width, 'float32')
 
 
 ################################################################################
@@ -401,11 +370,59 @@ def find_inc_coords(anchor_id, astart, aend, astrand, rstart, rend, mode, bins,
     return inc_start, inc_end
 
 
+################################################################################
+# find_inc_ranges
+#
+# Vectorized find_inc_coords for arrays of anchor and read alignment
+# coordinates, except for span mode over transcripts.
+#
+# Input
+#  astarts:     Anchor starts.
+#  aends:       Anchor ends.
+#  aminus:      Anchors not on the + strand.
+#  rstarts:     Read alignment starts.
+#  rends:       Read alignment ends.
+#  mode:        mid or span.
+#  bins:        Number of bins in span mode.
+#
+# Output
+#  inc_starts:  Coordinates at which to start incrementing.
+#  inc_ends:    Coordinates at which to stop incrementing.
+################################################################################
+def find_inc_ranges(astarts, aends, aminus, rstarts, rends, mode, bins):
+    cov_starts = np.maximum(rstarts, astarts)
+    cov_ends = np.minimum(rends, aends)
+
+    if mode == 'mid':
+        inc_starts = np.where(aminus, aends - cov_ends, cov_starts - astarts)
+        inc_ends = np.where(aminus, aends - cov_starts + 1, cov_ends - astarts + 1)
+
+    elif mode == 'span':
+        alengths = (aends - astarts + 1).astype('float64')
+        cov_start_pcts = np.where(aminus, aends - cov_ends, cov_starts - astarts) / alengths
+        cov_end_pcts = np.where(aminus, aends - cov_starts + 1, cov_ends - astarts + 1) / alengths
+
+        inc_starts = (bins*cov_start_pcts).astype('int64')
+        inc_ends = (0.5 + bins*cov_end_pcts).astype('int64')
+
+    else:
+        print >> sys.stderr, 'Unknown mode %s' % mode
+        exit(1)
+
+    return inc_starts, inc_ends
+
+
 ################################################################################
 # initialize_coverage
+#
+# Output
+#  anchor_ids:  List of anchor_id's in order of appearance.
+#  width:       Coverage positions per anchor.
 ################################################################################
 def initialize_coverage(anchor_gff, mode, anchor_is_gtf, bins):
-    coverage = {}
+    anchor_ids = []
+    anchor_set = set()
+    width = 0
     for line in open(anchor_gff):
         a = line.split('\t')
 
@@ -418,16 +435,19 @@ def initialize_coverage(anchor_gff, mode, anchor_is_gtf, bins):
         else:
             anchor_id = (chrom, start, end)
             
-        if not anchor_id in coverage:
+        if not anchor_id in anchor_set:
+            anchor_set.add(anchor_id)
+            anchor_ids.append(anchor_id)
+
             if mode == 'span':
-                coverage[anchor_id] = [0]*bins
+                width = bins
             elif mode == 'mid':
-                coverage[anchor_id] = [0]*(end-start+1)
+                width = max(width, end-start+1)
             else:
                 print >> sys.stderr, 'Unknown mode %s' % mode
                 exit(1)
 
-    return coverage
+    return anchor_ids, width
 
 
 ################################################################################
@@ -546,6 +566,84 @@ def preprocess_anchors(anchor_gff, mode, max_anchors, anchor_is_gtf, min_length,
     return prep_anchor_fd, prep_anchor_gff
 
 
+################################################################################
+# Anchors
+#
+# The anchors' coverage rows and the Intervals of their gff lines, with the
+# id, strand and row of each interval and the transcript structures of GTF
+# anchors, to place event overlaps within the rows.
+################################################################################
+class Anchors:
+    def __init__(self, anchor_gff, mode, anchor_is_gtf, bins):
+        self.mode = mode
+        self.bins = bins
+
+        self.ids, self.width = initialize_coverage(anchor_gff, mode, anchor_is_gtf, bins)
+        anchor_rows = dict([(self.ids[ai],ai) for ai in range(len(self.ids))])
+
+        if anchor_is_gtf:
+            # get transcript structures
+            self.transcripts = gff.read_genes(anchor_gff, key_id='transcript_id')
+
+            # compute lengths
+            self.transcript_lengths = {}
+            for tid in self.transcripts:
+                tx = self.transcripts[tid]
+                for exon in tx.exons:
+                    self.transcript_lengths[tid] = self.transcript_lengths.get(tid,0) + exon.end-exon.start+1
+
+        else:
+            self.transcripts = None
+            self.transcript_lengths = None
+
+        # hash anchors
+        self.ivs, anchor_lines = intersect.read_intervals(anchor_gff, gff=True)
+        self.iv_ids = []
+        self.iv_strands = []
+        for line in anchor_lines:
+            a = line.split('\t')
+            self.iv_strands.append(a[6])
+            if anchor_is_gtf:
+                self.iv_ids.append(gff.gtf_kv(a[8])['transcript_id'])
+            else:
+                self.iv_ids.append((a[0], int(a[3]), int(a[4])))
+        self.iv_rows = np.array([anchor_rows[anchor_id] for anchor_id in self.iv_ids], dtype='int64')
+        self.iv_minus = np.array([astrand != '+' for astrand in self.iv_strands], dtype='bool')
+
+    ############################################################################
+    # increments
+    #
+    # Return arrays of the coverage row, increment start and end, and weight
+    # of the overlaps of the events in event_ivs with the anchor intervals,
+    # given by the arrays event_idx and anchor_idx, that cover any position.
+    ############################################################################
+    def increments(self, event_ivs, event_idx, anchor_idx, event_weights):
+        # 1-based gff coordinates
+        rstarts = event_ivs.starts[event_idx] + 1
+        rends = event_ivs.ends[event_idx]
+        astarts = self.ivs.starts[anchor_idx] + 1
+        aends = self.ivs.ends[anchor_idx]
+
+        # find where to increment
+        if self.transcripts != None:
+            inc_starts = np.zeros(len(event_idx), dtype='int64')
+            inc_ends = np.zeros(len(event_idx), dtype='int64')
+            for i in range(len(event_idx)):
+                ai = anchor_idx[i]
+                inc_start, inc_end = find_inc_coords(self.iv_ids[ai], astarts[i], aends[i], self.iv_strands[ai], rstarts[i], rends[i], self.mode, self.bins, self.transcripts, self.transcript_lengths)
+                if inc_start != None:
+                    inc_starts[i] = inc_start
+                    inc_ends[i] = inc_end
+        else:
+            inc_starts, inc_ends = find_inc_ranges(astarts, aends, self.iv_minus[anchor_idx], rstarts, rends, self.mode, self.bins)
+
+        inc_starts = np.clip(inc_starts, 0, self.width)
+        inc_ends = np.clip(inc_ends, 0, self.width)
+        inc = (inc_starts < inc_ends)
+
+        return self.iv_rows[anchor_idx[inc]], inc_starts[inc], inc_ends[inc], event_weights[inc]
+
+
 ################################################################################
 # __main__
 ################################################################################
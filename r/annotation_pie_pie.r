@@ -5,7 +5,7 @@ df.file = ca[1]
 plot.title = ca[2]
 output.pdf = ca[3]
 
-df = read.table(df.file, header=T, quote="\"")
+df = read.df(df.file)
 
 annotation.order.all = c('Intergenic','Introns','3\'UTR','5\'UTR','CDS','lncRNA','Pseudogene','rRNA','smallRNA')
 annotation.order = annotation.order.all[annotation.order.all %in% df$annotation]
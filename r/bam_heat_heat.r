@@ -5,7 +5,7 @@ df.file = ca[1]
 output.pdf = ca[2]
 control = ca[3]
 
-df = read.table(df.file, header=T, quote="\"")
+df = read.df(df.file)
 
 gp = ggplot(df, aes(x=Index, y=Feature, fill=Coverage)) +
     geom_tile()
@@ -5,7 +5,7 @@ ca = commandArgs(trailing=T)
 df.file = ca[1]
 output.pdf = ca[2]
 
-df = read.table(df.file, header=T, quote="\"")
+df = read.df(df.file)
 
 # this is broken
 
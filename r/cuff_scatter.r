@@ -7,7 +7,7 @@ cond1 = ca[3]
 cond2 = ca[4]
 pseudocount = as.numeric(ca[5])
 
-df = read.table(df.file, header=T, quote="\"")
+df = read.df(df.file)
 
 fpkm.min = log2(pseudocount)
 
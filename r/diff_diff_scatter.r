@@ -4,7 +4,7 @@ ca = commandArgs(trailing=T)
 df.file = ca[1]
 output.pdf = ca[2]
 
-df = read.table(df.file, header=T, quote="\"")
+df = read.df(df.file)
 
 x.min = quantile(df$diff1, .002)
 x.max = quantile(df$diff1, .998)
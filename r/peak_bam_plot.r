@@ -4,7 +4,7 @@ ca = commandArgs(trailing=T)
 df.file = ca[1]
 output.pdf = ca[2]
 
-df = read.table(df.file, header=T, quote="\"")
+df = read.df(df.file)
 
 ggplot(df, aes(x=peak_i, y=cov)) +
  geom_point() +
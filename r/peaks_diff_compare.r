@@ -4,7 +4,7 @@ ca = commandArgs(trailing=T)
 df.file = ca[1]
 out.pre = ca[2]
 
-df = read.table(df.file, header=T, quote="\"")
+df = read.df(df.file)
 
 x.min = quantile(df$Test_stat, .003, na.rm=T)
 x.max = quantile(df$Test_stat, .997, na.rm=T)
@@ -5,7 +5,7 @@ ca = commandArgs(trailing=T)
 df.file = ca[1]
 out.pre = ca[2]
 
-df = read.table(df.file, header=T, quote="\"")
+df = read.df(df.file)
 
 # unnormalized
 if (ncol(df) == 2) {
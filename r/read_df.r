@@ -0,0 +1,30 @@
+# Read a data frame written by ggplot.py's print_df.
+read.df = function(df.file) {
+    con = file(df.file, "rb")
+
+    dims = readBin(con, "integer", n=2, size=4, endian="little")
+    num.cols = dims[1]
+    num.rows = dims[2]
+
+    names.types = readBin(con, "character", n=2*num.cols)
+    col.names = names.types[seq(1, by=2, length.out=num.cols)]
+    col.types = names.types[seq(2, by=2, length.out=num.cols)]
+
+    df = list()
+    for (ci in seq_len(num.cols)) {
+        if (col.types[ci] == "double") {
+            col = readBin(con, "double", n=num.rows, size=8, endian="little")
+        } else if (col.types[ci] == "integer") {
+            col = readBin(con, "integer", n=num.rows, size=4, endian="little")
+        } else if (col.types[ci] == "logical") {
+            col = readBin(con, "logical", n=num.rows, size=4, endian="little")
+        } else {
+            col = type.convert(readBin(con, "character", n=num.rows), as.is=TRUE)
+        }
+        df[[col.names[ci]]] = col
+    }
+
+    close(con)
+
+    data.frame(df)
+}
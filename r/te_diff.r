@@ -4,7 +4,7 @@ ca = commandArgs(trailing=T)
 df.file = ca[1]
 output.pdf = ca[2]
 
-df = read.table(df.file, header=T, quote="\"")
+df = read.df(df.file)
 
 xmin = quantile(df$fold, .007, na.rm=T)
 xmax = quantile(df$fold, .993, na.rm=T)
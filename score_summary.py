@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+import numpy as np
+
+################################################################################
+# score_summary.py
+#
+# Running summaries of streams of scores, e.g. the per-base conservation
+# scores of a transcript, that keep the count, sum and threshold counts
+# exactly and the quantiles in a sketch of bounded size.
+#
+# The quantile sketch follows the compactor scheme of Karnin, Lang and Liberty
+# 2016. Scores enter level 0 and whenever a level holds sketch_size scores it is
+# sorted and every other score is promoted to the level above, where each
+# stands for twice as many scores. Until the first compaction the sketch holds
+# every score and its quantiles are exact.
+################################################################################
+
+# scores held per sketch level
+sketch_size = 256
+
+
+################################################################################
+# QuantileSketch
+#
+# Approximate quantiles of a stream of scores in O(sketch_size log n) memory.
+################################################################################
+class QuantileSketch:
+    def __init__(self, size=sketch_size):
+        self.size = size
+        self.levels = [[]]
+        self.level_counts = [0]
+        self.level_offsets = [0]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    ############################################################################
+    # add
+    #
+    # Add a sequence of scores.
+    ############################################################################
+    def add(self, scores):
+        scores = np.asarray(scores, dtype='float64')
+        if len(scores) == 0:
+            return
+
+        self.levels[0].append(scores)
+        self.level_counts[0] += len(scores)
+        self.count += len(scores)
+
+        l = 0
+        while l < len(self.levels) and self.level_counts[l] >= self.size:
+            self.compact(l)
+            l += 1
+
+    ############################################################################
+    # compact
+    #
+    # Sort level l and promote every other score to the level above, keeping
+    # the largest score behind if the level holds an odd number.
+    ############################################################################
+    def compact(self, l):
+        level_scores = np.sort(np.concatenate(self.levels[l]))
+
+        keep = level_scores[len(level_scores) - len(level_scores)%2:]
+        level_scores = level_scores[:len(level_scores) - len(level_scores)%2]
+
+        # alternate which half is promoted to avoid a consistent bias
+        promote = level_scores[self.level_offsets[l]::2]
+        self.level_offsets[l] = 1 - self.level_offsets[l]
+
+        self.levels[l] = [keep]
+        self.level_counts[l] = len(keep)
+
+        if l+1 == len(self.levels):
+            self.levels.append([])
+            self.level_counts.append(0)
+            self.level_offsets.append(0)
+        self.levels[l+1].append(promote)
+        self.level_counts[l+1] += len(promote)
+
+    ############################################################################
+    # quantile
+    #
+    # Return the approximate q'th quantile, exact if no level has yet been
+    # compacted.
+    ############################################################################
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+
+        if len(self.levels) == 1:
+            return np.percentile(np.concatenate(self.levels[0]), 100*q)
+
+        scores = []
+        weights = []
+        for l in range(len(self.levels)):
+            for level_scores in self.levels[l]:
+                scores.append(level_scores)
+                weights.append(np.repeat(2**l, len(level_scores)))
+        scores = np.concatenate(scores)
+        weights = np.concatenate(weights)
+
+        order = np.argsort(scores, kind='mergesort')
+        cum_weights = np.cumsum(weights[order])
+        qi = np.searchsorted(cum_weights, q*cum_weights[-1], 'left')
+
+        return scores[order[min(qi, len(order)-1)]]
+
+
+################################################################################
+# ScoreSummary
+#
+# Running count, mean, fractions above and below thresholds and median of a
+# stream of scores, holding every score only if exact medians are requested.
+################################################################################
+class ScoreSummary:
+    def __init__(self, exact=False, pos_threshold=1, neg_threshold=1):
+        self.exact = exact
+        self.pos_threshold = pos_threshold
+        self.neg_threshold = neg_threshold
+
+        self.count = 0
+        self.sum = 0.0
+        self.pos = 0
+        self.neg = 0
+
+        if self.exact:
+            self.scores = []
+        else:
+            self.sketch = QuantileSketch()
+
+    def __len__(self):
+        return self.count
+
+    ############################################################################
+    # add
+    #
+    # Add a sequence of scores.
+    ############################################################################
+    def add(self, scores):
+        scores = np.asarray(scores, dtype='float64')
+
+        self.count += len(scores)
+        self.sum += scores.sum()
+        self.pos += (scores > self.pos_threshold).sum()
+        self.neg += (scores < self.neg_threshold).sum()
+
+        if self.exact:
+            self.scores.append(scores)
+        else:
+            self.sketch.add(scores)
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.sum / self.count
+
+    def median(self):
+        if self.count == 0:
+            return None
+        if self.exact:
+            return np.median(np.concatenate(self.scores))
+        else:
+            return self.sketch.quantile(0.5)
+
+    def frac_pos(self):
+        if self.count == 0:
+            return None
+        return self.pos / float(self.count)
+
+    def frac_neg(self):
+        if self.count == 0:
+            return None
+        return self.neg / float(self.count)
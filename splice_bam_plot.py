@@ -3,8 +3,8 @@ from optparse import OptionParser
 from rpy2.robjects.packages import importr
 import rpy2.robjects as ro
 import rpy2.robjects.lib.ggplot2 as ggplot2
-import math, pdb, subprocess
-import gff
+import math, pdb
+import gff, meta_profile
 
 grdevices = importr('grDevices')
 
@@ -23,7 +23,9 @@ def main():
     parser = OptionParser(usage)
     parser.add_option('-c', dest='control_bam_file', default=None, help='Control BAM file')
     parser.add_option('-o', dest='out_prefix', default='splice', help='Output prefix [Default: %default]')
+    parser.add_option('-p', dest='processes', default=1, type='int', help='Number of processes to split the genome across [Default: %default]')
     parser.add_option('-w', dest='window', default=200, type='int', help='Size of the surrounding window to consider [Default: %default]')
+    parser.add_option('-x', dest='cache', default=False, action='store_true', help='Slice coverage from the BAM files\' coverage caches [Default: %default]')
     (options,args) = parser.parse_args()
 
     if len(args) != 2:
@@ -36,12 +38,12 @@ def main():
     intervals_5p, intervals_3p = get_splice_intervals(gtf_file, options.window)
 
     # process bam
-    cov_5p = process_bam(bam_file, intervals_5p, options.out_prefix, options.window)
-    cov_3p = process_bam(bam_file, intervals_3p, options.out_prefix, options.window)
+    cov_5p = process_bam(bam_file, intervals_5p, options.window, options.processes, options.cache)
+    cov_3p = process_bam(bam_file, intervals_3p, options.window, options.processes, options.cache)
 
     if options.control_bam_file:
-        control_cov_5p = process_bam(options.control_bam_file, intervals_5p, options.out_prefix, options.window)
-        control_cov_3p = process_bam(options.control_bam_file, intervals_3p, options.out_prefix, options.window)
+        control_cov_5p = process_bam(options.control_bam_file, intervals_5p, options.window, options.processes, options.cache)
+        control_cov_3p = process_bam(options.control_bam_file, intervals_3p, options.window, options.processes, options.cache)
     
     ############################################
     # output
@@ -51,8 +53,8 @@ def main():
 
     if options.control_bam_file:
         # normalize
-        main_aligns = float(subprocess.check_output('samtools view -c %s' % bam_file, shell=True))
-        control_aligns = float(subprocess.check_output('samtools view -c %s' % options.control_bam_file, shell=True))
+        main_aligns = float(meta_profile.bam_alignments(bam_file))
+        control_aligns = float(meta_profile.bam_alignments(options.control_bam_file))
 
         count_5p = sum([len(intervals_5p[chrom]) for chrom in intervals_5p])
         count_3p = sum([len(intervals_3p[chrom]) for chrom in intervals_3p])
@@ -148,19 +150,6 @@ def get_splice_intervals(gtf_file, window):
     return intervals_5p, intervals_3p
 
 
-################################################################################
-# make_bed
-#
-# Make a bed file of the TSS intervals to give to samtools
-################################################################################
-def make_bed(tss_intervals, bed_file):
-    bed_out = open(bed_file,'w')
-    for chrom in tss_intervals:
-        for (start,end,strand) in tss_intervals[chrom]:
-            print >> bed_out, '%s\t%d\t%d' % (chrom,start-1,end)
-    bed_out.close()
-
-
 ################################################################################
 # make_output
 ################################################################################
@@ -224,75 +213,8 @@ def make_output_and(cov, control_cov, out_prefix, window):
 #
 # Count read coverage in a BAM file around the intervals given.
 ################################################################################
-def process_bam(bam_file, intervals, out_prefix, window):
-    # initialize data structures
-    ti_chrom = None
-    ti_i = -1
-    active_intervals = []
-    interval_cov = [0]*(window+1)
-
-    make_bed(intervals,'%s_tss.bed' % out_prefix)
-
-    proc = subprocess.Popen('samtools mpileup -l %s_tss.bed %s' % (out_prefix,bam_file), shell=True, stdout=subprocess.PIPE)
-    line = proc.stdout.readline()
-    while line:
-        a = line.split()
-
-        chrom = a[0]
-        pos = int(a[1])
-        cov = int(a[3])
-
-        if chrom in intervals:
-            # update active TSS
-            active_intervals, ti_chrom, ti_i = update_active_intervals(intervals, ti_chrom, ti_i, active_intervals, chrom, pos)
-
-            # append to interval_cov
-            for tss in active_intervals:
-                (tchrom,tstart,tend,tstrand) = tss
-                if tstrand == '+':
-                    interval_cov[pos-tstart] += cov
-                else:
-                    interval_cov[tend-pos] += cov
-
-        # next line
-        line = proc.stdout.readline()
-
-    # finish
-    line = proc.communicate()[0]
-
-    return interval_cov
-
-
-################################################################################
-# update_active_intervals
-#
-# Maintain a set of TSS intervals which chrom and pos fall inside.
-################################################################################
-def update_active_intervals(intervals, ti_chrom, ti_i, active_intervals, chrom, pos):
-    # drop finished tss
-    while active_intervals and (active_intervals[0][0] != chrom or active_intervals[0][2] < pos):
-        active_intervals = active_intervals[1:]
-
-    # initialize intervals indexes
-    if ti_chrom != chrom:
-        ti_chrom = chrom
-        ti_i = 0
-
-    # add opened tss
-    while ti_i < len(intervals[ti_chrom]):
-        (tstart,tend,tstrand) = intervals[ti_chrom][ti_i]
-        if pos < tstart:
-            # before TSS: no new active
-            break
-        elif tstart <= pos <= tend:
-            # inside TSS: add and move to next
-            active_intervals.append((ti_chrom,tstart,tend,tstrand))
-            ti_i += 1
-        else:
-            # past TSS: move to next
-            ti_i += 1
-
-    return active_intervals, ti_chrom, ti_i
+def process_bam(bam_file, intervals, window, processes=1, cache=False):
+    return meta_profile.meta_profile(bam_file, intervals, window+1, processes=processes, cache=cache).tolist()
 
 
 ################################################################################
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 from optparse import OptionParser
-import glob, os, subprocess, sys
+import glob, os, sys
 from gff import gtf_kv
+import intersect
 
 ################################################################################
 # te.py
@@ -26,29 +27,27 @@ def main():
 # Hash genes in gtf_file to sets of repeats in repeats_gff.
 ################################################################################
 def hash_genes_repeats(gtf_file, repeats_gff, gene_key='gene_id', add_star=True, stranded=False):
+    gene_ivs, gene_lines = intersect.read_intervals(gtf_file, gff=True)
+    rep_ivs, rep_lines = intersect.read_intervals(repeats_gff, gff=True)
+
+    gene_ids = [gtf_kv(line.split('\t')[8], lazy=True)[gene_key] for line in gene_lines]
+
     gene_repeats = {}
-    for line in open(gtf_file):
-        a = line.split('\t')
-        gene_id = gtf_kv(a[8])[gene_key]
+    for gene_id in gene_ids:
         gene_repeats[gene_id] = set()
-    
-    p = subprocess.Popen('intersectBed -wo -a %s -b %s' % (gtf_file, repeats_gff), shell=True, stdout=subprocess.PIPE)
-    line = p.stdout.readline()
-    while line:
-        a = line.split('\t')
 
-        # get names
-        gene_id = gtf_kv(a[8])[gene_key]
-        rep_kv = gtf_kv(a[17])
-        rep = rep_kv['repeat']
-        fam = rep_kv['family']
+    gene_idx, rep_idx, overlap_bp = [x.tolist() for x in intersect.intersect(gene_ivs, rep_ivs)]
 
-        # get strands
-        gene_strand = a[6]
-        te_strand = a[15]
+    # get names
+    rep_names = repeat_names(rep_lines, rep_idx)
+
+    for i in range(len(gene_idx)):
+        gene_id = gene_ids[gene_idx[i]]
+        rep, fam = rep_names[rep_idx[i]]
 
         if stranded:
-            if gene_strand == te_strand:
+            # get strands
+            if gene_ivs.strands[gene_idx[i]] == rep_ivs.strands[rep_idx[i]]:
                 orient = '+'
             else:
                 orient = '-'
@@ -64,9 +63,6 @@ def hash_genes_repeats(gtf_file, repeats_gff, gene_key='gene_id', add_star=True,
                 gene_repeats[gene_id].add(('*',fam))
                 gene_repeats[gene_id].add(('*','*'))
 
-        line = p.stdout.readline()
-    p.communicate()
-
     return gene_repeats
 
 
@@ -79,21 +75,24 @@ def hash_genes_repeats(gtf_file, repeats_gff, gene_key='gene_id', add_star=True,
 #  -If we hash by gene_id, we want to have chosen a single isoform per gene.
 ################################################################################
 def hash_genes_repeats_nt(gtf_file, repeats_gff, gene_key='gene_id', add_star=True):
-    gene_repeat_nt = {}
+    gene_ivs, gene_lines = intersect.read_intervals(gtf_file, gff=True)
+    rep_ivs, rep_lines = intersect.read_intervals(repeats_gff, gff=True)
 
-    p = subprocess.Popen('intersectBed -wo -a %s -b %s' % (gtf_file, repeats_gff), shell=True, stdout=subprocess.PIPE)
-    line = p.stdout.readline()
-    while line:
-        a = line.split('\t')
+    gene_idx, rep_idx, overlap_bp = [x.tolist() for x in intersect.intersect(gene_ivs, rep_ivs)]
 
-        # get names
-        gene_id = gtf_kv(a[8])['gene_id']
-        rep_kv = gtf_kv(a[17])
-        rep = rep_kv['repeat']
-        fam = rep_kv['family']
+    # get names
+    gene_ids = {}
+    for gi in set(gene_idx):
+        gene_ids[gi] = gtf_kv(gene_lines[gi].split('\t')[8], lazy=True)['gene_id']
+    rep_names = repeat_names(rep_lines, rep_idx)
+
+    gene_repeat_nt = {}
+    for i in range(len(gene_idx)):
+        gene_id = gene_ids[gene_idx[i]]
+        rep, fam = rep_names[rep_idx[i]]
 
         # get overlap
-        nt_overlap = int(a[18])
+        nt_overlap = overlap_bp[i]
 
         if not gene_id in gene_repeat_nt:
             gene_repeat_nt[gene_id] = {}
@@ -103,9 +102,6 @@ def hash_genes_repeats_nt(gtf_file, repeats_gff, gene_key='gene_id', add_star=Tr
             gene_repeat_nt[gene_id][('*',fam)] = gene_repeat_nt[gene_id].get(('*',fam),0) + nt_overlap
             gene_repeat_nt[gene_id][('*','*')] = gene_repeat_nt[gene_id].get(('*','*'),0) + nt_overlap
 
-        line = p.stdout.readline()
-    p.communicate()
-
     return gene_repeat_nt
 
 
@@ -118,7 +114,7 @@ def hash_repeat_family():
     repeat_family = {}
     for line in open('%s/hg19.fa.out.tp.gff' % os.environ['MASK']):
         a = line.split('\t')
-        kv = gtf_kv(a[8])
+        kv = gtf_kv(a[8], lazy=True)
         repeat_family[kv['repeat']] = kv['family']
     return repeat_family
 
@@ -132,7 +128,7 @@ def map_dfam_family():
     repeat_family = {}
     for line in open('%s/hg19.fa.out.tp.gff' % os.environ['MASK']):
         a = line.split('\t')
-        kv = gtf_kv(a[8])
+        kv = gtf_kv(a[8], lazy=True)
         repeat_family[kv['repeat']] = kv['family']
 
     dfam_family = {}
@@ -153,7 +149,7 @@ def map_dfam_repeat():
     repeats = set()
     for line in open('%s/hg19.fa.out.tp.gff' % os.environ['MASK']):
         a = line.split('\t')
-        kv = gtf_kv(a[8])
+        kv = gtf_kv(a[8], lazy=True)
         repeats.add(kv['repeat'])
 
     dfam_repeat = {}
@@ -201,6 +197,20 @@ def map_rm_dfam(repeat, quiet=False):
     return dfam_reps
 
 
+################################################################################
+# repeat_names
+#
+# Return a dict mapping each index in the list rep_idx to (repeat, family)
+# tuples, parsing the attributes of each RepeatMasker gff line once.
+################################################################################
+def repeat_names(rep_lines, rep_idx):
+    rep_names = {}
+    for ri in set(rep_idx):
+        rep_kv = gtf_kv(rep_lines[ri].split('\t')[8], lazy=True)
+        rep_names[ri] = (rep_kv['repeat'], rep_kv['family'])
+    return rep_names
+
+
 ################################################################################
 # __main__
 ################################################################################
@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 from optparse import OptionParser
 from scipy.stats import binom
-import gzip, os, pdb, random, subprocess, sys, tempfile
+import gzip, os, pdb, random, subprocess, tempfile
+import numpy as np
 import pysam
-import bedtools, gff, stats
+import bam_filters, bam_fragments, bam_shards, fdr, gff, intersect, stats
 
 ################################################################################
 # te_bam_enrich.py
@@ -35,6 +36,7 @@ def main():
     parser.add_option('-c', dest='control_bam_files', help='Control BAM file to paramterize null distribution [Default: %default]')
     parser.add_option('-g', dest='filter_gff', help='Filter the TEs by overlap with genes in the given gff file [Default: %default]')
     parser.add_option('-m', dest='mapq', default=False, action='store_true', help='Consider only reads with mapq>0 [Default: %default]')
+    parser.add_option('-p', dest='processes', type='int', default=1, help='Number of processes to count BAM files and their genome shards across [Default: %default]')
     parser.add_option('-r', dest='repeats_gff', default='%s/hg19.fa.out.tp.gff' % os.environ['MASK'])
     parser.add_option('-s', dest='strand_split', default=False, action='store_true', help='Split statistics by strand [Default: %default]')
     (options,args) = parser.parse_args()
@@ -61,22 +63,16 @@ def main():
         subprocess.call('intersectBed -a %s -b %s > %s' % (options.repeats_gff, filter_merged_bed_file, te_gff_file), shell=True)
         options.repeats_gff = te_gff_file
 
-        # filter BAM
-        bam_gff_fds = [None]*len(bam_files)
-        bam_gff_files = [None]*len(bam_files)
-        for i in range(len(bam_files)):
-            bam_gff_fds[i], bam_gff_files[i] = tempfile.mkstemp(dir='%s/research/scratch/temp' % os.environ['HOME'])
-            bedtools.abam_f1(bam_files[i], filter_merged_bed_file, bam_gff_files[i])
-            bam_files[i] = bam_gff_files[i]
-
-        # filter control BAM
-        if control_bam_files:
-            cbam_gff_fds = [None]*len(control_bam_files)
-            cbam_gff_files = [None]*len(control_bam_files)
-            for i in range(len(control_bam_files)):
-                cbam_gff_fds[i], cbam_gff_files[i] = tempfile.mkstemp(dir='%s/research/scratch/temp' % os.environ['HOME'])
-                bedtools.abam_f1(control_bam_files[i], filter_merged_bed_file, cbam_gff_files[i])
-                control_bam_files[i] = cbam_gff_files[i]
+        # filter reads by their overlap with the merged gff as they're counted
+        filter_ivs = intersect.read_intervals(filter_merged_bed_file, gff=False)[0]
+        gff_filter = bam_filters.region_filter(filter_ivs)
+    else:
+        gff_filter = None
+
+    if options.mapq:
+        read_filter = bam_filters.combine(bam_filters.mapq_filter(), gff_filter)
+    else:
+        read_filter = gff_filter
 
     ############################################
     # lengths
@@ -84,7 +80,7 @@ def main():
     # estimate read length (just averaging across replicates for now)
     read_lens = []
     for bam_file in bam_files:
-        read_lens.append(estimate_read_length(bam_file))
+        read_lens.append(estimate_read_length(bam_file, read_filter))
     read_len = stats.mean(read_lens)
 
     # compute size of search space
@@ -102,82 +98,91 @@ def main():
     ############################################
     # count TE fragments
     ############################################
-    fragments = []
-    te_fragments = []
-    for bam_file in bam_files:
-        rep_fragments, rep_te_fragments = count_te_fragments(bam_file, options.repeats_gff, options.strand_split)
-        fragments.append(rep_fragments)
-        te_fragments.append(rep_te_fragments)
-
-    if control_bam_files:        
-        control_fragments = []
-        control_te_fragments = []
-        for control_bam_file in control_bam_files:
-            rep_fragments, rep_te_fragments = count_te_fragments(control_bam_file, options.repeats_gff, options.strand_split)
-            control_fragments.append(rep_fragments)
-            control_te_fragments.append(rep_te_fragments)
+    if options.processes > 1:
+        all_fragments, all_te_fragments = count_te_fragments_parallel(bam_files+control_bam_files, options.repeats_gff, options.strand_split, options.processes, read_filter)
+        fragments = all_fragments[:len(bam_files)]
+        te_fragments = all_te_fragments[:len(bam_files)]
+        control_fragments = all_fragments[len(bam_files):]
+        control_te_fragments = all_te_fragments[len(bam_files):]
+
+    else:
+        fragments = []
+        te_fragments = []
+        for bam_file in bam_files:
+            rep_fragments, rep_te_fragments = count_te_fragments(bam_file, options.repeats_gff, options.strand_split, read_filter)
+            fragments.append(rep_fragments)
+            te_fragments.append(rep_te_fragments)
+
+        if control_bam_files:        
+            control_fragments = []
+            control_te_fragments = []
+            for control_bam_file in control_bam_files:
+                rep_fragments, rep_te_fragments = count_te_fragments(control_bam_file, options.repeats_gff, options.strand_split, read_filter)
+                control_fragments.append(rep_fragments)
+                control_te_fragments.append(rep_te_fragments)
 
     ############################################
     # combine replicates into fragment rates
     ############################################
-    te_fragment_rates = {}
+    te_keys = []
     for (rep,fam) in te_lengths:
         if options.strand_split:
-            # positive
-            rate_list = [te_fragments[i].get((rep+'+',fam),1)/float(fragments[i]) for i in range(len(bam_files))]
-            te_fragment_rates[(rep+'+',fam)] = stats.geo_mean(rate_list)
-            # negative
-            rate_list = [te_fragments[i].get((rep+'-',fam),1)/float(fragments[i]) for i in range(len(bam_files))]
-            te_fragment_rates[(rep+'-',fam)] = stats.geo_mean(rate_list)
+            te_keys += [(rep+'+',fam), (rep+'-',fam)]
         else:
-            rate_list = [te_fragments[i].get((rep,fam),1)/float(fragments[i]) for i in range(len(bam_files))]
-            te_fragment_rates[(rep,fam)] = stats.geo_mean(rate_list)
+            te_keys.append((rep,fam))
+
+    # order as a dict of the TEs, as the table has always been
+    te_order = {}
+    for te in te_keys:
+        te_order[te] = True
+    te_keys = list(te_order)
+
+    te_fragment_counts = fragment_count_matrix(te_keys, te_fragments)
+    te_fragment_rates = geo_mean_rates(te_fragment_counts, fragments)
 
     if control_bam_files:
-        control_te_fragment_rates = {}
-        for te in te_fragment_rates:
-            rate_list = [control_te_fragments[i].get(te,1)/float(control_fragments[i]) for i in range(len(control_bam_files))]
-            control_te_fragment_rates[te] = stats.geo_mean(rate_list)
+        control_te_fragment_rates = geo_mean_rates(fragment_count_matrix(te_keys, control_te_fragments), control_fragments)
 
     ############################################
     # compute stats, print table
     ############################################
-    for (rep,fam) in te_fragment_rates:
-        # compute TE length
+    # compute TE length
+    if options.strand_split:
+        te_lens = np.array([te_lengths[(rep[:-1],fam)] for (rep,fam) in te_keys], dtype='float64')
+    else:
+        te_lens = np.array([te_lengths[(rep,fam)] for (rep,fam) in te_keys], dtype='float64')
+
+    # parameterize null model
+    if options.control_bam_files:
+        null_rates = control_te_fragment_rates
+    else:
         if options.strand_split:
-            te_len = te_lengths[(rep[:-1],fam)]
+            null_rates = te_lens / (2*genome_length)
         else:
-            te_len = te_lengths[(rep,fam)]
+            null_rates = te_lens / genome_length
 
-        # parameterize null model
-        if options.control_bam_files:
-            null_rate = control_te_fragment_rates[(rep,fam)]
-        else:
-            if options.strand_split:
-                null_rate = float(te_lengths[(rep[:-1],fam)]) / (2*genome_length)
-            else:
-                null_rate = float(te_lengths[(rep,fam)]) / genome_length
+    # compute fragment counts
+    counts = te_fragment_rates*sum(fragments)
+    null_counts = null_rates*sum(fragments)
 
-        # compute fragment counts
-        count = te_fragment_rates[(rep,fam)]*sum(fragments)
-        null_count = null_rate*sum(fragments)
+    # compute fold change
+    folds = np.zeros(len(te_keys))
+    folds[null_rates > 0] = te_fragment_rates[null_rates > 0] / null_rates[null_rates > 0]
 
-        # compute fold change
-        if null_rate > 0:
-            fold = te_fragment_rates[(rep,fam)]/null_rate
-        else:
-            fold = 0
+    # compute p-value of enrichment/depletion
+    enriched = te_fragment_rates > null_rates
+    p_vals = np.ones(len(te_keys))
+    for i in range(len(bam_files)):
+        rep_counts = te_fragment_counts[i].astype('int64')
+        rep_fragments = int(fragments[i])
+        p_vals *= np.where(enriched, binom.sf(rep_counts-1, rep_fragments, null_rates), binom.cdf(rep_counts, rep_fragments, null_rates))
 
-        # compute p-value of enrichment/depletion
-        p_val = 1.0
-        for i in range(len(bam_files)):
-            if te_fragment_rates[(rep,fam)] > null_rate:            
-                p_val *= binom.sf(int(te_fragments[i].get((rep,fam),1))-1, int(fragments[i]), null_rate)
-            else:
-                p_val *= binom.cdf(int(te_fragments[i].get((rep,fam),1)), int(fragments[i]), null_rate)
+    q_vals = fdr.storey(p_vals.tolist())
 
-        cols = (rep, fam, te_len, count, null_count, fold, p_val)
-        print '%-18s %-18s %10d %10.1f %10.1f %10.3f %10.2e' % cols
+    for ti in range(len(te_keys)):
+        rep, fam = te_keys[ti]
+        cols = (rep, fam, te_lens[ti], counts[ti], null_counts[ti], folds[ti], p_vals[ti], q_vals[ti])
+        print '%-18s %-18s %10d %10.1f %10.1f %10.3f %10.2e %10.2e' % cols
 
     ############################################
     # clean
@@ -188,15 +193,6 @@ def main():
         os.close(te_gff_fd)
         os.remove(te_gff_file)
 
-        for i in range(len(bam_files)):
-            os.close(bam_gff_fds[i])
-            os.remove(bam_gff_files[i])
-
-        if options.control_bam_files:
-            for i in range(len(control_bam_files)):
-                os.close(cbam_gff_fds[i])
-                os.remove(cbam_gff_files[i])
-
 
 ################################################################################
 # count_bed
@@ -238,77 +234,71 @@ def count_hg19():
 ################################################################################
 # count_te_fragments
 #
-# Count the number of fragments aligned to each TE family.
-################################################################################
-def count_te_fragments(bam_file, te_gff, strand_split=False):
-    # count fragments and hash multi-mappers
-    num_fragments = 0
-    multi_maps = {}
-    paired_poll = {False:0, True:0}
-    for aligned_read in pysam.Samfile(bam_file, 'rb'):
-        if aligned_read.is_paired:
-            num_fragments += 0.5/aligned_read.opt('NH')
-        else:
-            num_fragments += 1.0/aligned_read.opt('NH')
-
-        if aligned_read.opt('NH') > 1:
-            multi_maps[aligned_read.qname] = aligned_read.opt('NH')
+# Count the number of fragments aligned to each TE family, optionally
+# filtering the reads.
+################################################################################
+def count_te_fragments(bam_file, te_gff, strand_split=False, read_filter=None):
+    te_ivs, te_lines = intersect.read_intervals(te_gff, gff=True)
 
-        paired_poll[aligned_read.is_paired] += 1
+    num_fragments, te_idx, te_same, te_opp = te_fragment_weights(bam_file, te_ivs, read_filter=read_filter)
 
-    # guess paired-ness
-    if paired_poll[True] > 0 and paired_poll[False] > 0:
-        print >> sys.stderr, 'Paired-ness of the reads is ambiguous'
-    if paired_poll[True] > paired_poll[False]:
-        is_paired = True
-    else:
-        is_paired = False
+    return num_fragments, te_fragment_table(te_lines, te_idx, te_same, te_opp, strand_split)
 
-    # hash read counts by TE family
-    te_fragments = {}
-    proc = subprocess.Popen('intersectBed -split -wo -bed -abam %s -b %s' % (bam_file, te_gff), shell=True, stdout=subprocess.PIPE)
-    for line in proc.stdout:
-        a = line.split('\t')
-        te_kv = gff.gtf_kv(a[20])
 
-        rep = te_kv['repeat']
-        fam = te_kv['family']
+################################################################################
+# count_te_fragments_parallel
+#
+# Count the number of fragments aligned to each TE family for each of the BAM
+# files concurrently, splitting the BAM files by genome shard (see
+# bam_shards.py) across the processes and merging the tables of each BAM file
+# at the end.
+################################################################################
+def count_te_fragments_parallel(bam_files, te_gff, strand_split=False, processes=2, read_filter=None):
+    te_ivs, te_lines = intersect.read_intervals(te_gff, gff=True)
 
-        if is_paired:
-            read_inc = 0.5/multi_maps.get(a[3],1.0)
-        else:
-            read_inc = 1.0/multi_maps.get(a[3],1.0)
+    # one unit per BAM genome shard
+    units = []
+    for bi in range(len(bam_files)):
+        for shard in bam_shards.bam_shards(bam_files[bi]):
+            units.append((bi, bam_files[bi], shard))
 
-        rep_star = '*'
-        if strand_split:
-            rstrand = a[5]
-            tstrand = a[18]
-            if rstrand == tstrand:
-                rep += '+'
-                rep_star += '+'
-            else:
-                rep += '-'
-                rep_star += '-'
+    fragments = [0.0]*len(bam_files)
+    te_same = [np.zeros(len(te_ivs)) for bam_file in bam_files]
+    te_opp = [np.zeros(len(te_ivs)) for bam_file in bam_files]
 
-        te_fragments[(rep,fam)] = te_fragments.get((rep,fam),0.0) + read_inc
-        te_fragments[(rep_star,fam)] = te_fragments.get((rep_star,fam),0.0) + read_inc
-        te_fragments[(rep_star,'*')] = te_fragments.get((rep_star,'*'),0.0) + read_inc
+    for bi, unit_fragments, te_idx, unit_same, unit_opp in bam_shards.map_shards(te_fragment_unit, units, processes, init_te_worker, (te_ivs, read_filter)):
+        fragments[bi] += unit_fragments
+        te_same[bi][te_idx] += unit_same
+        te_opp[bi][te_idx] += unit_opp
 
-    proc.communicate()
+    te_fragments = []
+    for bi in range(len(bam_files)):
+        te_idx = np.nonzero(te_same[bi] + te_opp[bi])[0]
+        te_fragments.append(te_fragment_table(te_lines, te_idx, te_same[bi][te_idx], te_opp[bi][te_idx], strand_split))
 
-    return num_fragments, te_fragments
+    return fragments, te_fragments
 
 
 ################################################################################
 # estimate_read_length
 #
-# Compute mean read length by sampling the first N reads.
+# Compute mean read length by sampling the first N reads, optionally only
+# those kept by the read filter.
 ################################################################################
-def estimate_read_length(bam_file):
+def estimate_read_length(bam_file, read_filter=None):
     samples = 10000
     s = 0
     read_lengths = []
-    for aligned_read in pysam.Samfile(bam_file, 'rb'):
+    bam_in = pysam.Samfile(bam_file, 'rb')
+    for aligned_read in bam_in:
+        if read_filter is not None:
+            if aligned_read.is_unmapped:
+                chrom = None
+            else:
+                chrom = bam_in.references[aligned_read.tid]
+            if not read_filter(aligned_read, chrom):
+                continue
+
         read_lengths.append(aligned_read.rlen)
         s += 1
         if s >= samples:
@@ -316,6 +306,45 @@ def estimate_read_length(bam_file):
     return int(0.5+stats.mean(read_lengths))
         
 
+################################################################################
+# fragment_count_matrix
+#
+# Return a replicates by TEs array of the fragments counted for the given TE
+# keys in each replicate's table, counting a pseudocount of one for TEs
+# without fragments.
+################################################################################
+def fragment_count_matrix(te_keys, te_fragments):
+    counts = np.ones((len(te_fragments), len(te_keys)))
+    for i in range(len(te_fragments)):
+        for ti in range(len(te_keys)):
+            if te_keys[ti] in te_fragments[i]:
+                counts[i,ti] = te_fragments[i][te_keys[ti]]
+    return counts
+
+
+################################################################################
+# geo_mean_rates
+#
+# Return the geometric mean across replicates of the TE fragment rates, given
+# a replicates by TEs array of counts and the replicates' total fragments.
+################################################################################
+def geo_mean_rates(counts, fragments):
+    rates = counts / np.array(fragments, dtype='float64')[:,np.newaxis]
+    return np.exp(np.log(rates).mean(axis=0))
+
+
+################################################################################
+# init_te_worker
+#
+# Set the TE Intervals and read filter counted by te_fragment_unit, as the
+# initializer of each process in a Pool.
+################################################################################
+def init_te_worker(te_ivs, read_filter=None):
+    global worker_te_ivs, worker_read_filter
+    worker_te_ivs = te_ivs
+    worker_read_filter = read_filter
+
+
 ################################################################################
 # measure_te
 #
@@ -333,7 +362,7 @@ def measure_te(rm_file):
     for line in open(rm_file):
         a = line.split('\t')
 
-        kv = gff.gtf_kv(a[8])
+        kv = gff.gtf_kv(a[8], lazy=True)
         rep = kv['repeat']
         family = kv['family']
 
@@ -346,6 +375,75 @@ def measure_te(rm_file):
     return repeat_bp
 
 
+################################################################################
+# te_fragment_table
+#
+# Hash read counts by TE family from the summed weights of the TEs te_idx
+# with reads on the same and opposite strands.
+################################################################################
+def te_fragment_table(te_lines, te_idx, te_same, te_opp, strand_split=False):
+    te_fragments = {}
+    for i in range(len(te_idx)):
+        te_kv = gff.gtf_kv(te_lines[te_idx[i]].split('\t')[8], lazy=True)
+        rep = te_kv['repeat']
+        fam = te_kv['family']
+
+        if strand_split:
+            te_incs = [('+', te_same[i]), ('-', te_opp[i])]
+        else:
+            te_incs = [('', te_same[i] + te_opp[i])]
+
+        for orient, read_inc in te_incs:
+            if read_inc > 0:
+                rep_orient = rep + orient
+                rep_star = '*' + orient
+                te_fragments[(rep_orient,fam)] = te_fragments.get((rep_orient,fam),0.0) + read_inc
+                te_fragments[(rep_star,fam)] = te_fragments.get((rep_star,fam),0.0) + read_inc
+                te_fragments[(rep_star,'*')] = te_fragments.get((rep_star,'*'),0.0) + read_inc
+
+    return te_fragments
+
+
+################################################################################
+# te_fragment_unit
+#
+# Sum read weights by TE for one (BAM index, BAM file, genome shard) unit of
+# count_te_fragments_parallel, against the TE Intervals set by
+# init_te_worker.
+################################################################################
+worker_te_ivs = None
+worker_read_filter = None
+def te_fragment_unit((bi, bam_file, shard)):
+    unit_fragments, te_idx, te_same, te_opp = te_fragment_weights(bam_file, worker_te_ivs, shard, worker_read_filter)
+    return bi, unit_fragments, te_idx, te_same, te_opp
+
+
+################################################################################
+# te_fragment_weights
+#
+# Sum the weights of the reads in the BAM file, optionally in a single genome
+# shard and kept by a read filter, overlapping each TE on the same and
+# opposite strands. Return the total fragments, the indexes of TEs with reads
+# and their sums.
+################################################################################
+def te_fragment_weights(bam_file, te_ivs, shard=(None,None,None), read_filter=None):
+    chrom, start, end = shard
+
+    te_same = np.zeros(len(te_ivs))
+    te_opp = np.zeros(len(te_ivs))
+
+    counter = bam_fragments.BamCounter(bam_file, read_filter=read_filter, chrom=chrom, start=start, end=end)
+    for blocks in counter.overlaps(te_ivs):
+        read_inc = blocks.weights()[blocks.block_idx]
+        same = blocks.strands[blocks.block_idx] == te_ivs.strands[blocks.feature_idx]
+        te_same += np.bincount(blocks.feature_idx[same], weights=read_inc[same], minlength=len(te_ivs))
+        te_opp += np.bincount(blocks.feature_idx[~same], weights=read_inc[~same], minlength=len(te_ivs))
+
+    te_idx = np.nonzero(te_same + te_opp)[0]
+
+    return counter.fragments, te_idx, te_same[te_idx], te_opp[te_idx]
+
+
 ################################################################################
 # te_target_size
 #
@@ -358,7 +456,7 @@ def te_target_size(te_gff, read_len):
     for line in open(te_gff):
         a = line.split('\t')
 
-        kv = gff.gtf_kv(a[8])
+        kv = gff.gtf_kv(a[8], lazy=True)
         rep = kv['repeat']
         fam = kv['family']
 
@@ -414,21 +512,30 @@ def te_target_size(te_gff, read_len):
 def te_target_size_bed(te_gff, ref_bed, read_len):
     # hash TE intervals by BED region
     bed_te_intervals = {}
-    p = subprocess.Popen('intersectBed -wo -a %s -b %s' % (ref_bed, te_gff), shell=True, stdout=subprocess.PIPE)
-    for line in p.stdout:
-        a = line.split('\t')
-
-        bchrom = a[0]
-        bstart = int(a[1])
-        bend = int(a[2])
+    bed_ivs, bed_lines = intersect.read_intervals(ref_bed, gff=False)
+    te_ivs, te_lines = intersect.read_intervals(te_gff, gff=True)
+    bed_idx, te_idx, overlap_bp = [x.tolist() for x in intersect.intersect(bed_ivs, te_ivs)]
+
+    # parse the attributes of each overlapped TE once
+    te_names = {}
+    for ti in set(te_idx):
+        rep_kv = gff.gtf_kv(te_lines[ti].split('\t')[8], lazy=True)
+        te_names[ti] = (rep_kv['repeat'], rep_kv['family'])
+
+    for i in range(len(bed_idx)):
+        bi = bed_idx[i]
+        ti = te_idx[i]
+
+        bchrom = bed_ivs.chroms[bed_ivs.chrom_col[bi]]
+        bstart = bed_ivs.start_col[bi]
+        bend = bed_ivs.end_col[bi]
         bid = (bchrom,bstart)
 
-        rep_kv = gff.gtf_kv(a[11])
-        rep = rep_kv['repeat']
-        fam = rep_kv['family']
+        rep, fam = te_names[ti]
 
-        tstart = int(a[6])
-        tend = int(a[7])
+        # gff coordinates
+        tstart = te_ivs.start_col[ti] + 1
+        tend = te_ivs.end_col[ti]
 
         ostart = max(bstart, tstart)
         oend = min(bend, tend)
@@ -439,8 +546,6 @@ def te_target_size_bed(te_gff, ref_bed, read_len):
         bed_te_intervals[bid].setdefault(('*',fam),[]).append((ostart,oend))
         bed_te_intervals[bid].setdefault(('*','*'),[]).append((ostart,oend))        
 
-    p.communicate()
-
     target_size = {}
     for bid in bed_te_intervals:
         bchrom, bstart = bid        
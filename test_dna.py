@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+############################################################
+# test_dna
+#
+# Check that indexed FastaSeq views slice like the plain
+# sequence strings they stand for.
+############################################################
+import os, random, shutil, tempfile, unittest
+import dna
+
+class TestFastaSeq(unittest.TestCase):
+    def setUp(self):
+        random.seed(1)
+        self.seq = ''.join([random.choice('ACGT') for i in range(1000)])
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fasta_file = '%s/seq.fa' % self.tmp_dir
+        fasta_out = open(self.fasta_file, 'w')
+        print >> fasta_out, '>seq'
+        for i in range(0, len(self.seq), 60):
+            print >> fasta_out, self.seq[i:i+60]
+        fasta_out.close()
+
+        self.fasta = dna.Fasta(self.fasta_file)
+        self.fasta_seq = self.fasta['seq']
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_simple_slices(self):
+        bounds = range(-1010, -990) + range(-15, 15) + range(990, 1010)
+        for start in bounds:
+            for end in bounds:
+                self.assertEqual(self.fasta_seq[start:end], self.seq[start:end], (start,end))
+
+    def test_extended_slices(self):
+        bounds = [None] + range(-1005, -995, 3) + range(-8, 8, 3) + range(995, 1005, 3)
+        for start in bounds:
+            for end in bounds:
+                for step in [None, 1, 2, 7, -1, -3]:
+                    self.assertEqual(self.fasta_seq[start:end:step], self.seq[start:end:step], (start,end,step))
+
+    def test_index(self):
+        for i in [0, 1, 59, 60, 999, -1, -1000]:
+            self.assertEqual(self.fasta_seq[i], self.seq[i])
+        self.assertRaises(IndexError, lambda: self.fasta_seq[1000])
+        self.assertRaises(IndexError, lambda: self.fasta_seq[-1001])
+
+############################################################
+# __main__
+############################################################
+if __name__ == '__main__':
+    unittest.main()
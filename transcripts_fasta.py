@@ -29,24 +29,30 @@ def main():
     transcript_genes = {}
 
     if genome_fasta[-2:] == 'gz':
+        # process chromosomes
         genome_open = gzip.open(genome_fasta)
-    else:
-        genome_open = open(genome_fasta)
-
-    # process chromosomes
-    chrom = ''
-    line = genome_open.readline()
-    while line:
-        if line[0] == '>':
-            if chrom:
-                process_chrom(transcripts_gtf, chrom, seq, transcript_seqs, transcript_genes)
-
-            chrom = line[1:].rstrip()
-            seq = ''
-        else:
-            seq += line.rstrip()
+
+        chrom = ''
         line = genome_open.readline()
-    process_chrom(transcripts_gtf, chrom, seq, transcript_seqs, transcript_genes)
+        while line:
+            if line[0] == '>':
+                if chrom:
+                    process_chrom(transcripts_gtf, chrom, ''.join(seq_lines), transcript_seqs, transcript_genes)
+
+                chrom = line[1:].rstrip()
+                seq_lines = []
+            else:
+                seq_lines.append(line.rstrip())
+            line = genome_open.readline()
+        process_chrom(transcripts_gtf, chrom, ''.join(seq_lines), transcript_seqs, transcript_genes)
+
+    else:
+        # fetch exons through the fasta index
+        genome = dna.Fasta(genome_fasta)
+        for line in open(transcripts_gtf):
+            a = line.split('\t')
+            if a[0] in genome:
+                process_exon(a, genome[a[0]], transcript_seqs, transcript_genes)
 
     # print fasta
     for tid in transcript_seqs:
@@ -64,20 +70,30 @@ def process_chrom(transcripts_gtf, chrom, seq, transcript_seqs, transcript_genes
     for line in open(transcripts_gtf):
         a = line.split('\t')
         if a[0] == chrom:
-            kv = gff.gtf_kv(a[8])
-            tid = kv['transcript_id']
-            gid = kv['gene_id']
+            process_exon(a, seq, transcript_seqs, transcript_genes)
 
-            exon_start = int(a[3])
-            exon_end = int(a[4])
 
-            exon_seq = seq[exon_start-1:exon_end]
-            if a[6] == '+':
-                transcript_seqs[tid] = transcript_seqs.get(tid,'') + exon_seq
-            else:
-                transcript_seqs[tid] = dna.rc(exon_seq) + transcript_seqs.get(tid,'')
+################################################################################
+# process_exon
+#
+# Add the exon in the split gtf line a, on the chromosome sequence seq, to the
+# transcript_seqs and transcript_genes hashes.
+################################################################################
+def process_exon(a, seq, transcript_seqs, transcript_genes):
+    kv = gff.gtf_kv(a[8])
+    tid = kv['transcript_id']
+    gid = kv['gene_id']
+
+    exon_start = int(a[3])
+    exon_end = int(a[4])
+
+    exon_seq = seq[exon_start-1:exon_end]
+    if a[6] == '+':
+        transcript_seqs[tid] = transcript_seqs.get(tid,'') + exon_seq
+    else:
+        transcript_seqs[tid] = dna.rc(exon_seq) + transcript_seqs.get(tid,'')
 
-            transcript_genes[tid] = gid
+    transcript_genes[tid] = gid
 
 
 ################################################################################
@@ -3,8 +3,8 @@ from optparse import OptionParser
 from rpy2.robjects.packages import importr
 import rpy2.robjects as ro
 import rpy2.robjects.lib.ggplot2 as ggplot2
-import math, pdb, subprocess
-import gff
+import math, pdb
+import gff, meta_profile
 
 grdevices = importr('grDevices')
 
@@ -28,7 +28,9 @@ def main():
     parser.add_option('-d', dest='downstream', default=2000, type='int', help='TSS downstream [Default: %default]')
     parser.add_option('-g', dest='geo_mean', default=False, action='store_true', help='Plot coverage geometric means [Default: %default]')
     parser.add_option('-o', dest='out_prefix', default='tss', help='Output prefix [Default: %default]')
+    parser.add_option('-p', dest='processes', default=1, type='int', help='Number of processes to split the genome across [Default: %default]')
     parser.add_option('-u', dest='upstream', default=5000, type='int', help='TSS upstream [Default: %default]')
+    parser.add_option('-x', dest='cache', default=False, action='store_true', help='Slice coverage from the BAM files\' coverage caches [Default: %default]')
     (options,args) = parser.parse_args()
 
     if len(args) != 2:
@@ -41,10 +43,10 @@ def main():
     tss_intervals, tss_count = get_tss(gtf_file, options.upstream, options.downstream)
 
     # process bam
-    tss_cov = process_bam(bam_file, tss_intervals, options.out_prefix, options.upstream, options.downstream, options.geo_mean)
+    tss_cov = process_bam(bam_file, tss_intervals, options.upstream, options.downstream, options.geo_mean, options.processes, options.cache)
 
     if options.control_bam_file:
-        control_tss_cov = process_bam(options.control_bam_file, tss_intervals, options.out_prefix, options.upstream, options.downstream, options.geo_mean)
+        control_tss_cov = process_bam(options.control_bam_file, tss_intervals, options.upstream, options.downstream, options.geo_mean, options.processes, options.cache)
     
     ############################################
     # output
@@ -53,8 +55,8 @@ def main():
 
     if options.control_bam_file:
         # normalize
-        main_aligns = float(subprocess.check_output('samtools view -c %s' % bam_file, shell=True))
-        control_aligns = float(subprocess.check_output('samtools view -c %s' % options.control_bam_file, shell=True))
+        main_aligns = float(meta_profile.bam_alignments(bam_file))
+        control_aligns = float(meta_profile.bam_alignments(options.control_bam_file))
 
         if options.geo_mean:
             tss_cov = [1000000.0*math.exp(float(tc)/tss_count)/main_aligns for tc in tss_cov]
@@ -100,19 +102,6 @@ def get_tss(gtf_file, upstream, downstream):
     return tss_intervals, tss_count
 
 
-################################################################################
-# make_bed
-#
-# Make a bed file of the TSS intervals to give to samtools
-################################################################################
-def make_bed(tss_intervals, bed_file):
-    bed_out = open(bed_file,'w')
-    for chrom in tss_intervals:
-        for (start,end,strand) in tss_intervals[chrom]:
-            print >> bed_out, '%s\t%d\t%d' % (chrom,start-1,end)
-    bed_out.close()
-
-
 ################################################################################
 # make_output
 ################################################################################
@@ -201,81 +190,8 @@ def make_output_and(tss_cov, control_tss_cov, out_prefix, upstream, downstream):
 #
 # Count read coverage in a BAM file around the tss_intervals given.
 ################################################################################
-def process_bam(bam_file, tss_intervals, out_prefix, upstream, downstream, geo_mean):
-    # initialize data structures
-    ti_chrom = None
-    ti_i = -1
-    active_tss = []
-    tss_cov = [0]*(upstream+downstream+1)
-
-    make_bed(tss_intervals,'%s_tss.bed' % out_prefix)
-
-    proc = subprocess.Popen('samtools mpileup -l %s_tss.bed %s' % (out_prefix,bam_file), shell=True, stdout=subprocess.PIPE)
-    line = proc.stdout.readline()
-    while line:
-        a = line.split()
-
-        chrom = a[0]
-        pos = int(a[1])
-        cov = int(a[3])
-
-        if chrom in tss_intervals:
-            # update active TSS
-            active_tss, ti_chrom, ti_i = update_active_tss(tss_intervals, ti_chrom, ti_i, active_tss, chrom, pos)
-
-            # append to tss_cov
-            for tss in active_tss:
-                (tchrom,tstart,tend,tstrand) = tss
-                if tstrand == '+':
-                    if geo_mean:
-                        tss_cov[pos-tstart] += math.log(cov)
-                    else:
-                        tss_cov[pos-tstart] += cov
-                else:
-                    if geo_mean:
-                        tss_cov[tend-pos] += math.log(cov)
-                    else:
-                        tss_cov[tend-pos] += cov
-
-        # next line
-        line = proc.stdout.readline()
-
-    # finish
-    line = proc.communicate()[0]
-
-    return tss_cov
-
-
-################################################################################
-# update_active_tss
-#
-# Maintain a set of TSS intervals which chrom and pos fall inside.
-################################################################################
-def update_active_tss(tss_intervals, ti_chrom, ti_i, active_tss, chrom, pos):
-    # drop finished tss
-    while active_tss and (active_tss[0][0] != chrom or active_tss[0][2] < pos):
-        active_tss = active_tss[1:]
-
-    # initialize tss_intervals indexes
-    if ti_chrom != chrom:
-        ti_chrom = chrom
-        ti_i = 0
-
-    # add opened tss
-    while ti_i < len(tss_intervals[ti_chrom]):
-        (tstart,tend,tstrand) = tss_intervals[ti_chrom][ti_i]
-        if pos < tstart:
-            # before TSS: no new active
-            break
-        elif tstart <= pos <= tend:
-            # inside TSS: add and move to next
-            active_tss.append((ti_chrom,tstart,tend,tstrand))
-            ti_i += 1
-        else:
-            # past TSS: move to next
-            ti_i += 1
-
-    return active_tss, ti_chrom, ti_i
+def process_bam(bam_file, tss_intervals, upstream, downstream, geo_mean, processes=1, cache=False):
+    return meta_profile.meta_profile(bam_file, tss_intervals, upstream+downstream+1, geo_mean, processes, cache).tolist()
 
 
 ################################################################################
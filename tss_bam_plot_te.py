@@ -4,7 +4,8 @@ from rpy2.robjects.packages import importr
 import rpy2.robjects as ro
 import rpy2.robjects.lib.ggplot2 as ggplot2
 import math, os, pdb, shutil, subprocess, tempfile
-import gff
+import numpy as np
+import gff, meta_profile
 
 grdevices = importr('grDevices')
 
@@ -55,9 +56,9 @@ def main():
     tss_intervals = get_tss(gtf_file, options.upstream, options.downstream)    
 
     # process bam
-    te_tss_cov = process_bams(bam_files, tss_intervals, gene_te, options.out_prefix, options.upstream, options.downstream, options.geo_mean)
+    te_tss_cov = process_bams(bam_files, tss_intervals, gene_te, options.upstream, options.downstream, options.geo_mean)
     if options.control_bam_file:
-        control_te_tss_cov = process_bams([options.control_bam_file], tss_intervals, gene_te, options.out_prefix, options.upstream, options.downstream, options.geo_mean)
+        control_te_tss_cov = process_bams([options.control_bam_file], tss_intervals, gene_te, options.upstream, options.downstream, options.geo_mean)
 
     ############################################
     # output
@@ -68,8 +69,8 @@ def main():
         # normalize
         main_aligns = 0
         for bam_file in bam_files:
-            main_aligns += float(subprocess.check_output('samtools view -c %s' % bam_file, shell=True))
-        control_aligns = float(subprocess.check_output('samtools view -c %s' % options.control_bam_file, shell=True))
+            main_aligns += float(meta_profile.bam_alignments(bam_file))
+        control_aligns = float(meta_profile.bam_alignments(options.control_bam_file))
 
         if options.geo_mean:
             for te in te_tss_cov:
@@ -164,19 +165,6 @@ def intersect_gene_te(gtf_file, upstream, downstream):
     return gene_trans
 
 
-################################################################################
-# make_bed
-#
-# Make a bed file of the TSS intervals to give to samtools
-################################################################################
-def make_bed(tss_intervals, bed_file):
-    bed_out = open(bed_file,'w')
-    for chrom in tss_intervals:
-        for (start,end,strand,gid) in tss_intervals[chrom]:
-            print >> bed_out, '%s\t%d\t%d' % (chrom,start-1,end)
-    bed_out.close()
-
-
 ################################################################################
 # make_output
 ################################################################################
@@ -269,89 +257,28 @@ def make_output_and(te_tss_cov, control_te_tss_cov, out_prefix, upstream, downst
 # Count read coverage in a BAM file around the tss_intervals given. Hash
 # counts by TE family.
 ################################################################################
-def process_bams(bam_files, tss_intervals, gene_te, out_prefix, upstream, downstream, geo_mean):
+def process_bams(bam_files, tss_intervals, gene_te, upstream, downstream, geo_mean):
     # initialize data structures
-    ti_chrom = None
-    ti_i = -1
-    active_tss = []
     te_tss_cov = {}
     for gene in gene_te:
         for te in gene_te[gene]:
             if not te in te_tss_cov:
-                te_tss_cov[te] = [0]*(upstream+downstream+1)
-
-    make_bed(tss_intervals,'%s_tss.bed' % out_prefix)
+                te_tss_cov[te] = np.zeros(upstream+downstream+1)
 
     for bam_file in bam_files:
-        # pileup
-        proc = subprocess.Popen('samtools mpileup -l %s_tss.bed %s' % (out_prefix,bam_file), shell=True, stdout=subprocess.PIPE)
-        line = proc.stdout.readline()
-        while line:
-            a = line.split()
-
-            chrom = a[0]
-            pos = int(a[1])
-            cov = int(a[3])
-
-            if chrom in tss_intervals:
-                # update active TSS
-                active_tss, ti_chrom, ti_i = update_active_tss(tss_intervals, ti_chrom, ti_i, active_tss, chrom, pos)
-
-                # append to tss_cov
-                for tss in active_tss:
-                    (tchrom,tstart,tend,tstrand,tid) = tss
-                    if tstrand == '+':
-                        for te in gene_te[tid]:
-                            if geo_mean:
-                                te_tss_cov[te][pos-tstart] += math.log(cov)
-                            else:
-                                te_tss_cov[te][pos-tstart] += cov
-                    else:
-                        for te in gene_te[tid]:
-                            if geo_mean:
-                                te_tss_cov[te][tend-pos] += math.log(cov)
-                            else:
-                                te_tss_cov[te][tend-pos] += cov
-
-            # next line
-            line = proc.stdout.readline()
-
-        # finish
-        line = proc.communicate()[0]
+        for chrom, ti, tss_depth in meta_profile.window_profiles(bam_file, tss_intervals):
+            tid = tss_intervals[chrom][ti][3]
 
-    return te_tss_cov
+            if geo_mean:
+                tss_depth = meta_profile.profile_logs(tss_depth)
 
+            for te in gene_te[tid]:
+                te_tss_cov[te] += tss_depth
 
-################################################################################
-# update_active_tss
-#
-# Maintain a set of TSS intervals which chrom and pos fall inside.
-################################################################################
-def update_active_tss(tss_intervals, ti_chrom, ti_i, active_tss, chrom, pos):
-    # drop finished tss
-    while active_tss and (active_tss[0][0] != chrom or active_tss[0][2] < pos):
-        active_tss = active_tss[1:]
-
-    # initialize tss_intervals indexes
-    if ti_chrom != chrom:
-        ti_chrom = chrom
-        ti_i = 0
-
-    # add opened tss
-    while ti_i < len(tss_intervals[ti_chrom]):
-        (tstart,tend,tstrand,tid) = tss_intervals[ti_chrom][ti_i]
-        if pos < tstart:
-            # before TSS: no new active
-            break
-        elif tstart <= pos <= tend:
-            # inside TSS: add and move to next
-            active_tss.append((ti_chrom,tstart,tend,tstrand,tid))
-            ti_i += 1
-        else:
-            # past TSS: move to next
-            ti_i += 1
+    for te in te_tss_cov:
+        te_tss_cov[te] = te_tss_cov[te].tolist()
 
-    return active_tss, ti_chrom, ti_i
+    return te_tss_cov
 
 
 ################################################################################
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+from optparse import OptionParser
+import glob, gzip, os, time
+import numpy as np
+import wig_store
+
+################################################################################
+# wig_bench.py
+#
+# Benchmark fetching the conservation scores of a gff file's intervals, e.g.
+# the lncRNA catalog against whole genome phyloP, by streaming the wigFix files
+# and from a score store, checking that both give the same scores. The time
+# to merely read the wigFix files line by line, as the scripts once did, is
+# given for reference.
+################################################################################
+
+
+################################################################################
+# main
+################################################################################
+def main():
+    usage = 'usage: %prog [options] <gff file>'
+    parser = OptionParser(usage)
+    parser.add_option('-c', dest='cons_dir', default='%s/research/common/data/phylop' % os.environ['HOME'], help='Conservation directory [Default: %default]')
+    parser.add_option('-l', dest='lines', default=False, action='store_true', help='Time reading the wigFix files line by line [Default: %default]')
+    parser.add_option('-s', dest='store_dir', help='Score store directory written by wig_store.py [Default: <conservation dir>/store]')
+    (options,args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error('Must provide gff file')
+    else:
+        gff_file = args[0]
+
+    if options.store_dir is None:
+        options.store_dir = '%s/store' % options.cons_dir
+
+    wig_files = sorted(glob.glob('%s/chr*' % options.cons_dir))
+
+    # read intervals
+    chr_intervals = {}
+    num_intervals = 0
+    for line in open(gff_file):
+        a = line.split('\t')
+        chr_intervals.setdefault(a[0], ([],[]))
+        chr_intervals[a[0]][0].append(int(a[3]))
+        chr_intervals[a[0]][1].append(int(a[4]))
+        num_intervals += 1
+
+    if options.lines:
+        t0 = time.time()
+        num_lines = read_lines(wig_files)
+        print '%-20s %10d lines %10.2f s' % ('wig lines', num_lines, time.time()-t0)
+
+    t0 = time.time()
+    sweep_sums = interval_sums(wig_store.interval_scores(wig_files, chr_intervals))
+    print '%-20s %10d intervals %10.2f s' % ('wig sweep', num_intervals, time.time()-t0)
+
+    if os.path.isdir(options.store_dir):
+        t0 = time.time()
+        store_sums = interval_sums(wig_store.interval_scores(wig_store.WigStore(options.store_dir), chr_intervals))
+        print '%-20s %10d intervals %10.2f s' % ('store', num_intervals, time.time()-t0)
+
+        if sorted(sweep_sums) != sorted(store_sums):
+            print 'Mismatch between covered intervals of wig sweep and store'
+            exit(1)
+        for key in sweep_sums:
+            if not np.allclose(sweep_sums[key], store_sums[key], rtol=1e-3, atol=1e-2):
+                print 'Mismatch between scores of wig sweep and store'
+                exit(1)
+
+
+################################################################################
+# interval_sums
+#
+# Return a dict mapping (chrom, interval index) to the number and sum of the
+# scores yielded.
+################################################################################
+def interval_sums(interval_scores):
+    sums = {}
+    for chrom, i, start, scores in interval_scores:
+        count, score_sum = sums.get((chrom,i), (0,0.0))
+        sums[(chrom,i)] = (count+len(scores), score_sum+scores.sum(dtype='float64'))
+    return sums
+
+
+################################################################################
+# read_lines
+#
+# Read the wig files line by line, converting the scores to floats, and return
+# the number of lines.
+################################################################################
+def read_lines(wig_files):
+    num_lines = 0
+    for wig_file in wig_files:
+        if wig_file[-3:] == '.gz':
+            wig_f = gzip.open(wig_file)
+        else:
+            wig_f = open(wig_file)
+
+        for line in wig_f:
+            if not line.startswith('fixedStep'):
+                float(line.rstrip())
+            num_lines += 1
+
+        wig_f.close()
+
+    return num_lines
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+    main()
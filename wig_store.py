@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+from optparse import OptionParser
+import glob, gzip, marshal, os, sys
+import numpy as np
+
+################################################################################
+# wig_store.py
+#
+# Read fixedStep and variableStep wig files, e.g. the phyloP and phastCons
+# wigFix files, as blocks of per-base scores and fetch the scores of sets of
+# intervals, either streaming the wig files or from a store of per-chromosome
+# binary score arrays that can be memory-mapped and sliced.
+#
+# Each chromosome's scores are written in file order as a flat float32 or
+# float16 array, alongside a block index of each fixedStep block's 1-based
+# start, length and offset into the array, so an interval is found by binary
+# search over the block starts.
+#
+# To convert a directory of wigFix files:
+#  ./wig_store.py $HOME/research/common/data/phylop $HOME/research/common/data/phylop/store
+################################################################################
+
+store_version = 1
+
+################################################################################
+# main
+################################################################################
+def main():
+    usage = 'usage: %prog [options] <wig dir|wig file,wig file2,...> <store dir>'
+    parser = OptionParser(usage)
+    parser.add_option('-g', dest='glob_pattern', default='chr*', help='Pattern for wig files in a wig directory [Default: %default]')
+    parser.add_option('-t', dest='dtype', default='float32', help='Score type to store [float16|float32] [Default: %default]')
+    (options,args) = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error('Must provide wig files and store directory')
+    else:
+        if os.path.isdir(args[0]):
+            wig_files = sorted(glob.glob('%s/%s' % (args[0],options.glob_pattern)))
+        else:
+            wig_files = args[0].split(',')
+        store_dir = args[1]
+
+    if options.dtype not in ['float16', 'float32']:
+        parser.error('Score type must be float16 or float32')
+
+    write_store(wig_files, store_dir, options.dtype)
+
+
+################################################################################
+# interval_scores
+#
+# Yield (chrom, interval index, start, scores) tuples for the covered parts
+# of the 1-based, inclusive intervals in chrom_intervals, a dict mapping
+# chromosomes to (starts, ends) arrays, from a WigStore or by streaming a
+# list of wig files.
+################################################################################
+def interval_scores(track, chrom_intervals):
+    if isinstance(track, WigStore):
+        return track.interval_scores(chrom_intervals)
+    else:
+        return sweep_scores(wig_files_blocks(track), chrom_intervals)
+
+
+################################################################################
+# read_wig_blocks
+#
+# Yield (chrom, start, scores) tuples for the contiguous blocks of a
+# fixedStep or variableStep wig file, with 1-based starts and numpy arrays of
+# per-base scores.
+################################################################################
+def read_wig_blocks(wig_file):
+    if wig_file[-3:] == '.gz':
+        wig_f = gzip.open(wig_file)
+    elif os.path.isfile(wig_file):
+        wig_f = open(wig_file)
+    else:
+        wig_f = gzip.open(wig_file+'.gz')
+
+    header = None
+    section_lines = []
+
+    for line in wig_f:
+        if line[0] in 'fv':
+            if section_lines:
+                for block in wig_section_blocks(header, section_lines):
+                    yield block
+            header = line
+            section_lines = []
+
+        elif line[0] in 'bt#':
+            # browser, track, comment lines
+            continue
+
+        else:
+            section_lines.append(line)
+
+    if section_lines:
+        for block in wig_section_blocks(header, section_lines):
+            yield block
+
+    wig_f.close()
+
+
+################################################################################
+# sweep_scores
+#
+# Yield (chrom, interval index, start, scores) tuples for the parts of the
+# (chrom, start, scores) blocks overlapping the 1-based, inclusive intervals
+# in chrom_intervals, a dict mapping chromosomes to (starts, ends) arrays.
+#
+# Intervals are sorted by start with the running maximum of their ends, so
+# the intervals overlapping a block are found by two binary searches and
+# blocks may arrive in any order.
+################################################################################
+def sweep_scores(blocks, chrom_intervals):
+    chrom_sorted = {}
+    for chrom in chrom_intervals:
+        starts = np.asarray(chrom_intervals[chrom][0], dtype='int64')
+        ends = np.asarray(chrom_intervals[chrom][1], dtype='int64')
+        order = np.argsort(starts, kind='mergesort')
+        chrom_sorted[chrom] = (order, starts[order], ends[order], np.maximum.accumulate(ends[order]))
+
+    for chrom, block_start, block_scores in blocks:
+        if chrom not in chrom_sorted:
+            continue
+
+        order, starts, ends, max_ends = chrom_sorted[chrom]
+        block_end = block_start + len(block_scores) - 1
+
+        # intervals starting by the block end whose ends may reach it
+        lo = np.searchsorted(max_ends, block_start, 'left')
+        hi = np.searchsorted(starts, block_end, 'right')
+        hits = lo + np.nonzero(ends[lo:hi] >= block_start)[0]
+
+        ostarts = np.maximum(starts[hits], block_start)
+        oends = np.minimum(ends[hits], block_end)
+        for j in range(len(hits)):
+            yield chrom, order[hits[j]], ostarts[j], block_scores[ostarts[j]-block_start:oends[j]-block_start+1]
+
+
+################################################################################
+# wig_files_blocks
+#
+# Yield the blocks of each of the wig files in turn.
+################################################################################
+def wig_files_blocks(wig_files):
+    for wig_file in wig_files:
+        print >> sys.stderr, 'Processing %s ...' % wig_file,
+        for block in read_wig_blocks(wig_file):
+            yield block
+        print >> sys.stderr, 'Done'
+
+
+################################################################################
+# wig_section_blocks
+#
+# Return a list of (chrom, start, scores) blocks for the data lines following
+# a fixedStep or variableStep header line, expanding spans to per-base scores.
+################################################################################
+def wig_section_blocks(header, section_lines):
+    a = header.split()
+    kv = dict([field.split('=') for field in a[1:]])
+    chrom = kv['chrom']
+    span = int(kv.get('span',1))
+
+    blocks = []
+
+    if a[0] == 'fixedStep':
+        start = int(kv['start'])
+        step = int(kv.get('step',1))
+        scores = np.fromstring(''.join(section_lines), dtype='float64', sep=' ')
+
+        if step == span:
+            blocks.append((chrom, start, np.repeat(scores, span)))
+        elif span < step:
+            for i in range(len(scores)):
+                blocks.append((chrom, start+i*step, np.repeat(scores[i], span)))
+        else:
+            raise ValueError('Overlapping fixedStep spans are not supported: %s' % header.rstrip())
+
+    elif a[0] == 'variableStep':
+        pos_scores = np.fromstring(''.join(section_lines), dtype='float64', sep=' ').reshape((-1,2))
+        positions = pos_scores[:,0].astype('int64')
+        scores = pos_scores[:,1]
+
+        # split into runs of adjacent spans
+        run_bounds = np.concatenate([[0], np.nonzero(np.diff(positions) != span)[0]+1, [len(positions)]])
+        for r in range(len(run_bounds)-1):
+            rs, re = run_bounds[r], run_bounds[r+1]
+            blocks.append((chrom, positions[rs], np.repeat(scores[rs:re], span)))
+
+    else:
+        raise ValueError('Unrecognized wig section header: %s' % header.rstrip())
+
+    return blocks
+
+
+################################################################################
+# write_store
+#
+# Convert the wig files into a store in store_dir.
+################################################################################
+def write_store(wig_files, store_dir, dtype='float32'):
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+
+    chrom_outs = {}
+    chrom_blocks = {}
+
+    for chrom, block_start, block_scores in wig_files_blocks(wig_files):
+        if chrom not in chrom_outs:
+            chrom_outs[chrom] = open('%s/%s.bin' % (store_dir,chrom), 'wb')
+            chrom_blocks[chrom] = ([], [], [], 0)
+
+        starts, lengths, offsets, offset = chrom_blocks[chrom]
+        starts.append(block_start)
+        lengths.append(len(block_scores))
+        offsets.append(offset)
+        chrom_blocks[chrom] = (starts, lengths, offsets, offset+len(block_scores))
+
+        chrom_outs[chrom].write(block_scores.astype(dtype).tostring())
+
+    for chrom in chrom_outs:
+        chrom_outs[chrom].close()
+
+    # index blocks by start
+    index = {'version':store_version, 'dtype':dtype, 'chroms':{}}
+    for chrom in chrom_blocks:
+        starts, lengths, offsets, offset = chrom_blocks[chrom]
+        blocks = np.array([starts, lengths, offsets], dtype='int64').T
+        blocks = blocks[np.argsort(blocks[:,0], kind='mergesort')]
+        index['chroms'][chrom] = blocks.tostring()
+
+    index_out = open('%s/index' % store_dir, 'wb')
+    marshal.dump(index, index_out, 2)
+    index_out.close()
+
+
+################################################################################
+# WigStore
+#
+# Read access to a store written by write_store.
+################################################################################
+class WigStore:
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+        index = marshal.load(open('%s/index' % store_dir, 'rb'))
+        if index.get('version') != store_version:
+            raise ValueError('Unsupported wig store version in %s' % store_dir)
+
+        self.dtype = index['dtype']
+        self.chrom_blocks = {}
+        for chrom in index['chroms']:
+            self.chrom_blocks[chrom] = np.frombuffer(index['chroms'][chrom], dtype='int64').reshape((-1,3))
+
+        self.chrom_scores = {}
+
+    def __contains__(self, chrom):
+        return chrom in self.chrom_blocks
+
+    ############################################################################
+    # interval_scores
+    #
+    # Yield (chrom, interval index, start, scores) tuples for the covered
+    # parts of the 1-based, inclusive intervals in chrom_intervals, a dict
+    # mapping chromosomes to (starts, ends) arrays.
+    ############################################################################
+    def interval_scores(self, chrom_intervals):
+        for chrom in sorted(chrom_intervals):
+            if chrom not in self.chrom_blocks:
+                continue
+
+            starts, ends = chrom_intervals[chrom]
+            for i in range(len(starts)):
+                for block_start, block_scores in self.blocks(chrom, starts[i], ends[i]):
+                    yield chrom, i, block_start, block_scores
+
+    ############################################################################
+    # blocks
+    #
+    # Return a list of (start, scores) tuples for the parts of the blocks
+    # overlapping the 1-based, inclusive interval [start, end] on chrom, in
+    # order, with scores as views of the memory-mapped array.
+    ############################################################################
+    def blocks(self, chrom, start, end):
+        if chrom not in self.chrom_blocks:
+            return []
+
+        blocks = self.chrom_blocks[chrom]
+        scores = self.scores_map(chrom)
+
+        # the last block starting at or before start may overlap it
+        bi = max(0, np.searchsorted(blocks[:,0], start, 'right') - 1)
+
+        interval_blocks = []
+        while bi < len(blocks) and blocks[bi,0] <= end:
+            block_start, block_len, block_offset = blocks[bi]
+            ostart = max(start, block_start)
+            oend = min(end, block_start + block_len - 1)
+            if ostart <= oend:
+                offset = block_offset + ostart - block_start
+                interval_blocks.append((ostart, scores[offset:offset+oend-ostart+1]))
+            bi += 1
+
+        return interval_blocks
+
+    ############################################################################
+    # scores
+    #
+    # Return an array of the scores at the covered positions of the 1-based,
+    # inclusive interval [start, end] on chrom.
+    ############################################################################
+    def scores(self, chrom, start, end):
+        interval_blocks = self.blocks(chrom, start, end)
+        if len(interval_blocks) == 1:
+            return interval_blocks[0][1]
+        elif interval_blocks:
+            return np.concatenate([block_scores for (block_start, block_scores) in interval_blocks])
+        else:
+            return np.zeros(0, dtype=self.dtype)
+
+    ############################################################################
+    # scores_map
+    #
+    # Return the memory-mapped score array of chrom.
+    ############################################################################
+    def scores_map(self, chrom):
+        if chrom not in self.chrom_scores:
+            self.chrom_scores[chrom] = np.memmap('%s/%s.bin' % (self.store_dir,chrom), dtype=self.dtype, mode='r')
+        return self.chrom_scores[chrom]
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+    main()